@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+import tempfile
+from urllib.parse import unquote_plus
+from aws_clients import BUCKET_NAME, get_s3_client
+from instrumentation import instrumented
+from segmented_transcribe import run_ffmpeg
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Audio extracted from video recordings is stored in the patient folder under
+# output/audio/, e.g. id_<patient>/220206-143000.mp4 ->
+# id_<patient>/output/audio/220206-143000.ogg, tagged with the ETag of the
+# recording it was extracted from.
+AUDIO_PREFIX = "output/audio/"
+
+# "ogg" (Opus) is a fraction of the size of "flac"; use flac if the ffmpeg
+# build has no libopus.
+TRANSCODE_FORMAT = os.environ.get("TRANSCODE_FORMAT", "ogg")
+TRANSCODE_SAMPLE_RATE = 16000
+OPUS_BITRATE = os.environ.get("TRANSCODE_OPUS_BITRATE", "32k")
+
+# Formats Transcribe reads directly, by file extension and by content type.
+AUDIO_EXTENSIONS = {"mp3": "mp3", "m4a": "m4a", "wav": "wav", "flac": "flac", "ogg": "ogg"}
+AUDIO_CONTENT_TYPES = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/mp4": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/m4a": "m4a",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+    "audio/flac": "flac",
+    "audio/ogg": "ogg"
+}
+VIDEO_EXTENSIONS = {"mp4", "mov", "webm"}
+AUDIO_OUTPUT_TYPES = {"ogg": "audio/ogg", "flac": "audio/flac"}
+
+
+def recording_kind(file_name, content_type=""):
+    """
+    Returns "audio" for recordings Transcribe can read as they are, "video"
+    for recordings whose audio track has to be extracted first, or None.
+    """
+    extension = os.path.splitext(file_name)[1].lower().lstrip(".")
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if extension in AUDIO_EXTENSIONS or content_type in AUDIO_CONTENT_TYPES:
+        return "audio"
+    if extension in VIDEO_EXTENSIONS or content_type.startswith("video/"):
+        return "video"
+    return None
+
+
+def audio_key(patient_id, file_name, audio_format=TRANSCODE_FORMAT):
+    base_name, _ = os.path.splitext(file_name)
+    return f"id_{patient_id}/{AUDIO_PREFIX}{base_name}.{audio_format}"
+
+
+def transcode_audio(input_path, output_path, audio_format=TRANSCODE_FORMAT):
+    """
+    Extracts the audio track as mono speech-rate audio (Opus in Ogg, or FLAC).
+    """
+    if audio_format == "ogg":
+        codec = ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip"]
+    elif audio_format == "flac":
+        codec = ["-c:a", "flac", "-sample_fmt", "s16"]
+    else:
+        raise ValueError(f"Unsupported audio format: {audio_format}")
+    run_ffmpeg(["-y", "-i", input_path, "-vn", "-ac", "1", "-ar", str(TRANSCODE_SAMPLE_RATE)] + codec + [output_path])
+    return output_path
+
+
+def find_audio(s3_client, bucket, patient_id, file_name, source_etag):
+    """
+    Returns the key of the audio extracted from this version of the recording,
+    or None if it has not been extracted yet.
+    """
+    key = audio_key(patient_id, file_name)
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.ClientError:
+        return None
+    if head.get("Metadata", {}).get("source-etag") != source_etag.strip('"'):
+        return None
+    return key
+
+
+def ensure_audio(s3_client, bucket, patient_id, file_name):
+    """
+    Extracts the audio of id_<patient_id>/<file_name> into the patient folder
+    unless it already is. Returns the audio key.
+    """
+    source_key = f"id_{patient_id}/{file_name}"
+    source_etag = s3_client.head_object(Bucket=bucket, Key=source_key)["ETag"].strip('"')
+    key = find_audio(s3_client, bucket, patient_id, file_name, source_etag)
+    if key is not None:
+        return key
+
+    key = audio_key(patient_id, file_name)
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_path = os.path.join(work_dir, os.path.basename(file_name))
+        output_path = os.path.join(work_dir, os.path.basename(key))
+        s3_client.download_file(bucket, source_key, source_path)
+        transcode_audio(source_path, output_path)
+        logger.info(
+            "Extracted audio of %s: %d -> %d bytes",
+            source_key, os.path.getsize(source_path), os.path.getsize(output_path)
+        )
+        s3_client.upload_file(
+            output_path,
+            bucket,
+            key,
+            ExtraArgs={
+                "ContentType": AUDIO_OUTPUT_TYPES[TRANSCODE_FORMAT],
+                "Metadata": {"source-etag": source_etag}
+            }
+        )
+    return key
+
+
+@instrumented("audio_transcode")
+def lambda_handler(event, context):
+    """
+    Ingestion stage for S3 ObjectCreated events: extracts the audio of video
+    recordings uploaded to a patient folder (id_<patient>/<name>.mp4), so that
+    transcription can start on the audio right away.
+    """
+    s3_client = get_s3_client()
+    extracted = []
+    for record in event.get("Records", []):
+        key = unquote_plus(record["s3"]["object"]["key"])
+        parts = key.split("/")
+        if len(parts) != 2 or not parts[0].startswith("id_") or recording_kind(parts[1]) != "video":
+            continue
+        try:
+            extracted.append(ensure_audio(s3_client, BUCKET_NAME, parts[0][len("id_"):], parts[1]))
+        except Exception:
+            logger.exception("Could not extract audio of %s", key)
+    if extracted:
+        # Imported here: the manifest module uses recording_kind from this one.
+        from patient_manifest import record_objects
+        record_objects(s3_client, BUCKET_NAME, extracted)
+    return {"statusCode": 200, "body": json.dumps({"extracted": extracted})}
@@ -0,0 +1,91 @@
+import os
+import threading
+from instrumentation import instrument_client
+
+# Shared configuration for all Lambda handlers. Values come from the function's
+# environment so the same code can be deployed against any bucket/region.
+REGION = os.environ.get("AWS_REGION", "eu-west-1")
+BUCKET_NAME = os.environ.get("BUCKET_NAME", "BUCKET_NAME")
+BUCKET_REGION = os.environ.get("BUCKET_REGION", REGION)
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "eu-west-1")
+BEDROCK_ENDPOINT_URL = os.environ.get(
+    "BEDROCK_ENDPOINT_URL", f"https://bedrock-runtime.{BEDROCK_REGION}.amazonaws.com"
+)
+
+# Connection pool tuning. The pool is sized for the thread pools used by the
+# handlers (batch deletes, parallel summaries); keep-alive lets warm invocations
+# reuse the TLS connections opened by earlier ones.
+MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "50"))
+CONNECT_TIMEOUT = int(os.environ.get("AWS_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = int(os.environ.get("AWS_READ_TIMEOUT", "60"))
+BEDROCK_READ_TIMEOUT = int(os.environ.get("BEDROCK_READ_TIMEOUT", "300"))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name, region_name=None, endpoint_url=None, read_timeout=READ_TIMEOUT, max_attempts=3):
+    """
+    Returns a boto3 client for the service, created on first use and reused by
+    every later call in the same container. boto3 itself is imported lazily so
+    that requests which never touch AWS (e.g. CORS preflights) skip its import cost.
+    """
+    key = (service_name, region_name, endpoint_url, read_timeout, max_attempts)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            import boto3
+            from botocore.config import Config
+
+            config = Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                connect_timeout=CONNECT_TIMEOUT,
+                read_timeout=read_timeout,
+                tcp_keepalive=True,
+                retries={"max_attempts": max_attempts, "mode": "standard"}
+            )
+            client = instrument_client(boto3.client(
+                service_name,
+                region_name=region_name,
+                endpoint_url=endpoint_url,
+                config=config
+            ))
+            _clients[key] = client
+    return client
+
+
+def get_s3_client():
+    return get_client("s3", region_name=BUCKET_REGION, endpoint_url=S3_ENDPOINT_URL)
+
+
+def get_transcribe_client():
+    return get_client("transcribe", region_name=REGION)
+
+
+def get_bedrock_runtime_client(region_name=BEDROCK_REGION):
+    # Model calls are retried by bedrock_invoke.py (with backoff and failover
+    # to other regions), so the client itself makes a single attempt.
+    return get_client(
+        "bedrock-runtime",
+        region_name=region_name,
+        endpoint_url=BEDROCK_ENDPOINT_URL if region_name == BEDROCK_REGION else None,
+        read_timeout=BEDROCK_READ_TIMEOUT,
+        max_attempts=1
+    )
+
+
+def get_bedrock_client():
+    return get_client("bedrock", region_name=BEDROCK_REGION)
+
+
+def get_lambda_client():
+    return get_client("lambda", region_name=REGION)
+
+
+def get_sqs_client():
+    return get_client("sqs", region_name=REGION)
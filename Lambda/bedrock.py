@@ -1,11 +1,377 @@
+import os
 import json
-import boto3
 import logging
+import time
+from contextlib import closing
+from itertools import chain
+from aws_clients import BUCKET_NAME, get_s3_client
+from bedrock_cache import ResultCache, cache_key
+from bedrock_invoke import BedrockInvoker, BedrockUnavailable, failover_endpoints
+from image_preprocess import ImagePreprocessor
+from incremental_summary import incremental_summary
+from instrumentation import instrumented, log_event, record, stage
+from map_reduce import map_reduce_summarize
+from pdf_ingest import page_blocks, pdf_content_blocks, pdf_documents
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", 'eu.anthropic.claude-3-5-sonnet-20240620-v1:0')
+
+
+def sse_event(event_name, data):
+    """
+    Formats a single Server-Sent Events frame.
+    """
+    return f"event: {event_name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_text_deltas(client, body):
+    """
+    Invokes the model with invoke_model_with_response_stream (client is a
+    BedrockInvoker) and yields (event_type, data) tuples as they arrive:
+      - ("delta", text) for every text delta of the completion
+      - ("stop", {"stop_reason": ..., "usage": {...}}) once the message ends
+    """
+    response = client.invoke_model_with_response_stream(body)
+    usage = {}
+    stop_reason = None
+    # Closing the stream (also when the caller stops reading early) releases
+    # the invoker's concurrency slot.
+    try:
+        for event in response["body"]:
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            message = json.loads(chunk["bytes"].decode("utf-8"))
+            message_type = message.get("type")
+            if message_type == "message_start":
+                usage.update(message.get("message", {}).get("usage", {}))
+            elif message_type == "content_block_delta":
+                text = message.get("delta", {}).get("text")
+                if text:
+                    yield "delta", text
+            elif message_type == "message_delta":
+                stop_reason = message.get("delta", {}).get("stop_reason")
+                usage.update(message.get("usage", {}))
+    finally:
+        response["body"].close()
+    yield "stop", {"stop_reason": stop_reason, "usage": usage}
+
+
+def record_usage(usage):
+    """
+    Adds the token usage of a model call to the invocation's metrics.
+    """
+    record("InputTokens", usage.get("input_tokens"))
+    record("OutputTokens", usage.get("output_tokens"))
+
+
+def stream_frames(client, payload, patient_id=None, bypass_cache=False, image_stats=None):
+    """
+    Yields the SSE frames of a streaming request as the model produces them:
+    one "delta" frame per text delta (client is a BedrockInvoker), then a
+    "done" frame with the full result (the same shape as the buffered
+    invoke_model body), the cache status, time-to-first-token and total
+    latency. A cached result is sent as a single delta. If the stream cannot
+    be started the buffered invocation is used instead; BedrockUnavailable is
+    raised before any frame is yielded, so the caller can still answer 503.
+    Closing the generator early releases the model call.
+    """
+    key = cache_key(MODEL_ID, payload)
+    cache_info = {"status": "bypass" if bypass_cache else "miss", "key": key}
+    if not bypass_cache:
+        cached, status = RESULT_CACHE.lookup(key, patient_id)
+        if cached is not None:
+            cache_info["status"] = status
+            yield sse_event("delta", {"text": result_text(cached)})
+            yield sse_event("done", {"result": cached, "cache": cache_info, "images": image_stats})
+            return
+
+    start = time.monotonic()
+    body = json.dumps(payload).encode("utf-8")
+    record("BedrockPayloadBytes", len(body), "Bytes")
+    with closing(stream_text_deltas(client, body)) as events:
+        try:
+            first = next(events)
+        except BedrockUnavailable:
+            raise
+        except Exception:
+            logger.exception("Streaming invocation failed; falling back to buffered mode.")
+            first = None
+
+        if first is None:
+            result = invoke_buffered(client, payload)
+            timing = {}
+            yield sse_event("delta", {"text": result_text(result)})
+        else:
+            first_token_ms = None
+            text_parts = []
+            stop_info = {}
+            with stage("bedrock.stream"):
+                for event_type, data in chain([first], events):
+                    if event_type == "delta":
+                        if first_token_ms is None:
+                            first_token_ms = int((time.monotonic() - start) * 1000)
+                        text_parts.append(data)
+                        yield sse_event("delta", {"text": data})
+                    else:
+                        stop_info = data
+            total_ms = int((time.monotonic() - start) * 1000)
+            record("TimeToFirstToken", first_token_ms, "Milliseconds")
+            record_usage(stop_info.get("usage", {}))
+            logger.info("Streaming completed in %d ms (first token after %s ms)", total_ms, first_token_ms)
+            result = message_result("".join(text_parts), stop_info.get("stop_reason"), stop_info.get("usage", {}))
+            timing = {"time_to_first_token_ms": first_token_ms, "total_ms": total_ms}
+
+    if not bypass_cache:
+        RESULT_CACHE.store(key, patient_id, result)
+    yield sse_event("done", dict(timing, result=result, cache=cache_info, images=image_stats))
+
+
+def invoke_buffered(client, payload):
+    """
+    Invokes the model with invoke_model (client is a BedrockInvoker) and
+    returns the raw response body.
+    """
+    body = json.dumps(payload).encode("utf-8")
+    record("BedrockPayloadBytes", len(body), "Bytes")
+    response = client.invoke_model(body)
+    result = response["body"].read().decode("utf-8")
+    usage = json.loads(result).get("usage", {})
+    record_usage(usage)
+    log_event("bedrock result", resultBytes=len(result), usage=usage)
+    return result
+
+
+class RequestError(ValueError):
+    """
+    A request that cannot be served as sent (answered with 400).
+    """
+
+
+def request_max_tokens(body):
+    """
+    The request's max_tokens, defaulting to 100 if invalid.
+    """
+    try:
+        return int(body.get("max_tokens", 100))
+    except (ValueError, TypeError):
+        logger.warning("Invalid max_tokens value provided; defaulting to 100.")
+        return 100
+
+
+def build_request(body):
+    """
+    Builds the Bedrock payload of a single-call request: the prompt, the
+    images and the PDFs of pdf_keys (ingested server-side), with the images
+    preprocessed unless "preprocess_images" is false.
+    Returns (payload, image_stats).
+    """
+    system_instructions = body.get("system_instructions", "")
+    prompt = body.get("prompt", "")   # may be empty
+    images = body.get("images", [])     # list
+    pdf_keys = body.get("pdf_keys", [])  # PDFs in the patient folder, ingested server-side
+
+    # Build user content (text + images) for the user message
+    user_content = []
+
+    # If a text prompt is provided, add it
+    if prompt and prompt.strip():
+        user_content.append({
+            "type": "text",
+            "text": prompt.strip()
+        })
+
+    # If images are provided, add them
+    for img in images:
+        img_data = img.get("data")
+        if img_data:
+            media_type = img.get("media_type", "image/jpeg")
+            user_content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": media_type,
+                    "data": img_data
+                }
+            })
+        else:
+            logger.warning("An image was provided without data. Skipping.")
+
+    # If PDF keys are provided, extract their text layers (rasterizing only
+    # scanned pages) from S3 instead of receiving page images from the browser
+    if pdf_keys:
+        patient_id = body.get("patientID")
+        if not patient_id:
+            raise RequestError("patientID is required with pdf_keys.")
+        with stage("pdf_ingest"):
+            user_content.extend(pdf_content_blocks(get_s3_client(), BUCKET_NAME, patient_id, pdf_keys))
+
+    # Downscale/re-encode images and drop blank and duplicate pages
+    # (unless the request opts out with "preprocess_images": false)
+    image_stats = None
+    if body.get("preprocess_images", True):
+        preprocessor = ImagePreprocessor()
+        with stage("image_preprocess"):
+            user_content = preprocessor.process_blocks(user_content)
+        image_stats = preprocessor.report()
+        logger.info("Image preprocessing: %s", image_stats)
+
+    # Ensure we have something to send as a user message
+    if not user_content:
+        logger.error("No valid user content provided in request body.")
+        raise RequestError("No valid user content provided in request body.")
+
+    # Build the payload for the Bedrock model (text/images as one user message)
+    return build_payload(system_instructions, user_content, request_max_tokens(body)), image_stats
+
+
+def build_payload(system_instructions, user_content, max_tokens):
+    """
+    Builds the Bedrock request body for a single user message.
+    Note that system instructions are sent as a separate field rather than part of the messages.
+    """
+    payload = {
+        "anthropic_version": "bedrock-2023-05-31",  # Update version if needed
+        "system": system_instructions,
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": user_content}],
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "stop_sequences": []
+    }
+
+    # If system instructions exist, include them as a separate parameter.
+    if system_instructions and system_instructions.strip():
+        payload["system"] = system_instructions.strip()
+    return payload
+
+
+def message_result(text, stop_reason=None, usage=None):
+    """
+    Wraps text in the same shape as an invoke_model response body.
+    """
+    return json.dumps({
+        "type": "message",
+        "role": "assistant",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": stop_reason,
+        "usage": usage or {}
+    }, ensure_ascii=False)
+
+
+def result_text(result):
+    """
+    Extracts the concatenated text blocks from a model result body.
+    """
+    parsed = json.loads(result)
+    return "".join(block.get("text", "") for block in parsed.get("content", []) if block.get("type") == "text")
+
+
+def cached_text_invoke(client, system_instructions, patient_id):
+    """
+    Returns invoke(content, max_tokens) -> text for the multi-call modes,
+    with every call served from the result cache when possible.
+    """
+    def invoke(content, tokens):
+        payload = build_payload(system_instructions, content, tokens)
+        result, _, _ = RESULT_CACHE.get_or_compute(
+            cache_key(MODEL_ID, payload), patient_id, lambda: (invoke_buffered(client, payload), None)
+        )
+        return result_text(result)
+    return invoke
+
+
+def summarize_map_reduce(body, client, max_tokens):
+    """
+    Map-reduce mode for inputs that do not fit one model call. Sources are the
+    request's "transcripts" ([{"name", "text", "date"?}]) and "pdf_keys"; the
+    request's prompt is used for the reduce pass. Returns (result, stats).
+    """
+    patient_id = body.get("patientID")
+    system_instructions = body.get("system_instructions", "")
+
+    sources = [
+        {"name": transcript.get("name") or f"transcript {index}", "date": transcript.get("date"), "text": transcript.get("text", "")}
+        for index, transcript in enumerate(body.get("transcripts", []), start=1)
+    ]
+    preprocessor = ImagePreprocessor() if body.get("preprocess_images", True) else None
+    if body.get("pdf_keys"):
+        if not patient_id:
+            raise RequestError("patientID is required with pdf_keys.")
+        for file_name, pages in pdf_documents(get_s3_client(), BUCKET_NAME, patient_id, body["pdf_keys"]):
+            blocks = [page_blocks(file_name, page) for page in pages]
+            if preprocessor:
+                blocks = [preprocessor.process_blocks(page) for page in blocks]
+            sources.append({"name": file_name, "pages": blocks})
+
+    invoke = cached_text_invoke(client, system_instructions, patient_id)
+
+    # Progress is logged and, when the client passes a job_id, written to
+    # id_<patient>/output/Summary/jobs/<job_id>.progress so it can be polled.
+    job_id = body.get("job_id")
+
+    def progress(stage, done, total):
+        logger.info("Map-reduce progress: %s %d/%d", stage, done, total)
+        if patient_id and job_id:
+            try:
+                get_s3_client().put_object(
+                    Bucket=BUCKET_NAME,
+                    Key=f"id_{patient_id}/output/Summary/jobs/{job_id}.progress",
+                    Body=json.dumps({"stage": stage, "done": done, "total": total}).encode("utf-8"),
+                    ContentType="application/json"
+                )
+            except Exception:
+                logger.warning("Could not write map-reduce progress", exc_info=True)
+
+    summary, stats = map_reduce_summarize(
+        sources,
+        invoke,
+        reduce_prompt=body.get("prompt", ""),
+        max_tokens=max_tokens,
+        progress=progress
+    )
+    if preprocessor:
+        stats["images"] = preprocessor.report()
+    return message_result(summary), stats
+
+
+def summarize_incremental(body, client, max_tokens):
+    """
+    Incremental mode: updates the patient's running summary with the
+    request's "pdf_keys" and "transcript_keys" that it does not incorporate
+    yet (see incremental_summary.py); "rebuild": true regenerates it from all
+    of its sources. Returns (result, info).
+    """
+    patient_id = body.get("patientID")
+    if not patient_id:
+        raise ValueError("patientID is required in incremental mode.")
+    system_instructions = body.get("system_instructions", "")
+    summary, info = incremental_summary(
+        get_s3_client(),
+        BUCKET_NAME,
+        str(patient_id),
+        list(body.get("pdf_keys", [])) + list(body.get("transcript_keys", [])),
+        cached_text_invoke(client, system_instructions, patient_id),
+        MODEL_ID,
+        system_instructions,
+        body.get("prompt", ""),
+        max_tokens,
+        rebuild=bool(body.get("rebuild")),
+        preprocessor=ImagePreprocessor() if body.get("preprocess_images", True) else None
+    )
+    return message_result(summary), info
+
+
+RESULT_CACHE = ResultCache(get_s3_client, BUCKET_NAME)
+
+# Shared by all requests (and threads) of the container, so its concurrency
+# limits reflect the throttling every request has seen.
+INVOKER = BedrockInvoker(failover_endpoints(MODEL_ID))
+
+@instrumented("bedrock")
 def lambda_handler(event, context):
     # Handle preflight OPTIONS request if needed
     if event.get("httpMethod") == "OPTIONS":
@@ -19,107 +385,91 @@ def lambda_handler(event, context):
             "body": json.dumps("OK")
         }
 
+    # Model calls give up (with a 503) before the function times out.
+    INVOKER.set_deadline(context)
+
     try:
         # Parse the incoming request body
         body = json.loads(event.get("body", "{}"))
-        logger.info("Request body: %s", body)
-
-        # Extract system instructions, prompt, and images
-        system_instructions = body.get("system_instructions", "")
-        prompt = body.get("prompt", "")   # may be empty
-        images = body.get("images", [])     # list
-
-        # Build messages array (do NOT include system instructions here)
-        messages = []
-
-        # Build user content (text + images) for the user message
-        user_content = []
+        log_event(
+            "bedrock request",
+            images=len(body.get("images", [])),
+            pdfKeys=len(body.get("pdf_keys", [])),
+            bodyBytes=len(event.get("body") or ""),
+            mode=body.get("mode"),
+            stream=bool(body.get("stream"))
+        )
 
-        # If a text prompt is provided, add it
-        if prompt and prompt.strip():
-            user_content.append({
-                "type": "text",
-                "text": prompt.strip()
-            })
+        # Read max_tokens from the request body, defaulting to 100 if invalid
+        max_tokens = request_max_tokens(body)
 
-        # If images are provided, add them
-        for img in images:
-            img_data = img.get("data")
-            if img_data:
-                media_type = img.get("media_type", "image/jpeg")
-                user_content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": media_type,
-                        "data": img_data
-                    }
-                })
-            else:
-                logger.warning("An image was provided without data. Skipping.")
-
-        # Ensure we have something to send as a user message
-        if not user_content:
-            logger.error("No valid user content provided in request body.")
+        # Map-reduce mode: chunk large histories, summarize the chunks in
+        # parallel and combine them with the request's prompt
+        if body.get("mode") == "map_reduce":
+            try:
+                result, stats = summarize_map_reduce(body, INVOKER, max_tokens)
+            except RequestError as e:
+                return {
+                    "statusCode": 400,
+                    "headers": {"Access-Control-Allow-Origin": "*"},
+                    "body": json.dumps({"error": str(e)})
+                }
             return {
-                "statusCode": 400,
+                "statusCode": 200,
                 "headers": {"Access-Control-Allow-Origin": "*"},
-                "body": json.dumps({"error": "No valid user content provided in request body."})
+                "body": json.dumps({"result": result, "map_reduce": stats})
             }
 
-        # Add the user message with text/images
-        messages.append({
-            "role": "user",
-            "content": user_content
-        })
+        # Incremental mode: only new or changed sources are sent to the model,
+        # together with the patient's previous summary
+        if body.get("mode") == "incremental":
+            result, info = summarize_incremental(body, INVOKER, max_tokens)
+            return {
+                "statusCode": 200,
+                "headers": {"Access-Control-Allow-Origin": "*"},
+                "body": json.dumps({"result": result, "incremental": info})
+            }
 
-        # Read max_tokens from the request body, defaulting to 100 if invalid
-        max_tokens = body.get("max_tokens", 100)
+        # Single call. API Gateway buffers Lambda responses, so "stream"
+        # requests are answered in buffered mode here; bedrock_stream.py
+        # serves them incrementally behind a response-streaming Function URL.
         try:
-            max_tokens = int(max_tokens)
-        except (ValueError, TypeError):
-            logger.warning("Invalid max_tokens value provided; defaulting to 100.")
-            max_tokens = 100
-
-        # Build the payload for the Bedrock model.
-        # Note that system instructions are sent as a separate field rather than part of the messages.
-        payload = {
-            "anthropic_version": "bedrock-2023-05-31",  # Update version if needed
-            "system": system_instructions,
-            "max_tokens": max_tokens,
-            "messages": messages,
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "stop_sequences": []
-        }
+            payload, image_stats = build_request(body)
+        except RequestError as e:
+            return {
+                "statusCode": 400,
+                "headers": {"Access-Control-Allow-Origin": "*"},
+                "body": json.dumps({"error": str(e)})
+            }
 
-        # If system instructions exist, include them as a separate parameter.
-        if system_instructions and system_instructions.strip():
-            payload["system"] = system_instructions.strip()
+        # Identical payloads are served from the result cache unless bypassed.
+        # An optional patientID enables the persistent tier in the patient folder.
+        key = cache_key(MODEL_ID, payload)
+        if body.get("bypass_cache"):
+            result = invoke_buffered(INVOKER, payload)
+            cache_status = "bypass"
+        else:
+            result, cache_status, _ = RESULT_CACHE.get_or_compute(
+                key, body.get("patientID"), lambda: (invoke_buffered(INVOKER, payload), None)
+            )
+        logger.info("Result cache status: %s (key %s)", cache_status, key)
+        cache_info = {"status": cache_status, "key": key}
 
-        # Create the Bedrock runtime client for the Ireland region
-        client = boto3.client(
-            'bedrock-runtime',
-            region_name='eu-west-1',
-            endpoint_url='https://bedrock-runtime.eu-west-1.amazonaws.com'
-        )
-        logger.info("Invoking Bedrock model with payload: %s", payload)
-        
-        response = client.invoke_model(
-            modelId='eu.anthropic.claude-3-5-sonnet-20240620-v1:0',
-            body=json.dumps(payload).encode("utf-8"),
-            contentType="application/json"
-        )
-        
-        result = response["body"].read().decode("utf-8")
-        logger.info("Bedrock result: %s", result)
-        
         return {
             "statusCode": 200,
             "headers": {"Access-Control-Allow-Origin": "*"},
-            "body": json.dumps({"result": result})
+            "body": json.dumps({"result": result, "cache": cache_info, "images": image_stats})
+        }
+
+    except BedrockUnavailable as e:
+        # Throttled or unavailable in every region: ask the client to retry later.
+        logger.warning("Bedrock unavailable: %s", e)
+        retry_after = max(1, int(e.retry_after or 5))
+        return {
+            "statusCode": 503,
+            "headers": {"Access-Control-Allow-Origin": "*", "Retry-After": str(retry_after)},
+            "body": json.dumps({"error": "The model is busy, please try again shortly.", "retryAfter": retry_after})
         }
-    
     except Exception as e:
         logger.exception("Error invoking Bedrock model:")
         return {
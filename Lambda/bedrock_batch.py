@@ -0,0 +1,296 @@
+import os
+import json
+import logging
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from aws_clients import BUCKET_NAME, get_bedrock_client, get_s3_client
+from bedrock import MODEL_ID, build_payload
+from image_preprocess import ImagePreprocessor
+from instrumentation import instrumented
+from patient_manifest import CONFLICT_ERRORS, record_objects
+from pdf_ingest import pdf_content_blocks
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# IAM role that Bedrock assumes to read the input and write the output.
+BATCH_ROLE_ARN = os.environ.get("BEDROCK_BATCH_ROLE_ARN", "")
+BATCH_PREFIX = "batch/"
+
+# Job states whose output can be collected. A partially completed job has an
+# output record for every input, with "error" set on the ones that failed.
+COLLECTABLE_STATUSES = ("Completed", "PartiallyCompleted")
+
+
+def list_patient_ids(s3_client, bucket):
+    """
+    Returns the IDs of all id_<patient>/ folders in the bucket.
+    """
+    patient_ids = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix="id_", Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            patient_ids.append(common_prefix["Prefix"][len("id_"):-1])
+    return patient_ids
+
+
+def list_patient_sources(s3_client, bucket, patient_id):
+    """
+    Returns (pdf_names, transcript_keys) for the files directly under the
+    patient folder (derived artifacts and output/ are skipped).
+    """
+    prefix = f"id_{patient_id}/"
+    pdf_names, transcript_keys = [], []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            name = obj["Key"][len(prefix):]
+            if name.lower().endswith(".pdf"):
+                pdf_names.append(name)
+            elif name.lower().endswith(".json"):
+                transcript_keys.append(obj["Key"])
+    return sorted(pdf_names), sorted(transcript_keys)
+
+
+def read_transcript_text(s3_client, bucket, key):
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    transcript_json = json.loads(response['Body'].read().decode('utf-8'))
+    transcript_list = transcript_json.get('results', {}).get('transcripts', [])
+    return transcript_list[0]['transcript'] if transcript_list else ""
+
+
+def build_patient_payload(s3_client, bucket, patient_id, system_instructions, prompt, max_tokens):
+    """
+    Builds the same payload lambda_handler in bedrock.py would build for this
+    patient's transcripts and PDFs, or None if the patient has no sources.
+    """
+    pdf_names, transcript_keys = list_patient_sources(s3_client, bucket, patient_id)
+    if not pdf_names and not transcript_keys:
+        return None
+
+    user_content = []
+    if prompt and prompt.strip():
+        user_content.append({"type": "text", "text": prompt.strip()})
+    for key in transcript_keys:
+        text = read_transcript_text(s3_client, bucket, key)
+        if text:
+            user_content.append({"type": "text", "text": f"[{key.split('/')[-1]}]\n{text}"})
+    if pdf_names:
+        user_content.extend(pdf_content_blocks(s3_client, bucket, patient_id, pdf_names))
+    user_content = ImagePreprocessor().process_blocks(user_content)
+    return build_payload(system_instructions, user_content, max_tokens)
+
+
+class BedrockBatchBackend:
+    """
+    Runs batch jobs with Bedrock batch inference. Records are read from and
+    written to S3 under batch/<job_name>/.
+    Note that Bedrock enforces a minimum number of records per job.
+    """
+
+    def __init__(self, s3_client, bedrock_client, bucket, role_arn, model_id=MODEL_ID):
+        self.s3_client = s3_client
+        self.bedrock_client = bedrock_client
+        self.bucket = bucket
+        self.role_arn = role_arn
+        self.model_id = model_id
+
+    def submit(self, job_name, records):
+        input_key = f"{BATCH_PREFIX}{job_name}/input/records.jsonl"
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=input_key,
+            Body="".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"),
+            ContentType="application/jsonl"
+        )
+        response = self.bedrock_client.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{self.bucket}/{input_key}"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{self.bucket}/{BATCH_PREFIX}{job_name}/output/"}}
+        )
+        return response["jobArn"]
+
+    def status(self, job_id):
+        return self.bedrock_client.get_model_invocation_job(jobIdentifier=job_id)["status"]
+
+    def results(self, job_id):
+        """
+        Yields the output records ({"recordId", "modelOutput" | "error"}).
+        Bedrock writes them to <output uri>/<job id>/records.jsonl.out.
+        """
+        job = self.bedrock_client.get_model_invocation_job(jobIdentifier=job_id)
+        output_uri = job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"]
+        output_prefix = output_uri.split(f"s3://{self.bucket}/", 1)[1]
+        output_key = f"{output_prefix.rstrip('/')}/{job_id.split('/')[-1]}/records.jsonl.out"
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=output_key)
+        for line in response["Body"].iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for Bedrock batch inference. Records are written to
+    <directory>/<job_name>.jsonl; the job "runs" on submit by calling
+    invoke(model_input) -> model output dict for every record, and the output
+    is written to <directory>/<job_name>.jsonl.out in the Bedrock format. Like
+    Bedrock, a job with failed records ends PartiallyCompleted.
+    """
+
+    def __init__(self, directory, invoke):
+        self.directory = directory
+        self.invoke = invoke
+
+    def submit(self, job_name, records):
+        os.makedirs(self.directory, exist_ok=True)
+        input_path = os.path.join(self.directory, f"{job_name}.jsonl")
+        with open(input_path, "w", encoding="utf-8") as input_file:
+            for record in records:
+                input_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        with open(input_path, encoding="utf-8") as input_file, \
+                open(input_path + ".out", "w", encoding="utf-8") as output_file:
+            for line in input_file:
+                record = json.loads(line)
+                try:
+                    record["modelOutput"] = self.invoke(record["modelInput"])
+                except Exception as e:
+                    record["error"] = {"errorMessage": str(e)}
+                output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return job_name
+
+    def status(self, job_id):
+        if not os.path.exists(os.path.join(self.directory, f"{job_id}.jsonl.out")):
+            return "InProgress"
+        return "PartiallyCompleted" if any("error" in record for record in self.results(job_id)) else "Completed"
+
+    def results(self, job_id):
+        with open(os.path.join(self.directory, f"{job_id}.jsonl.out"), encoding="utf-8") as output_file:
+            for line in output_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def submit_batch(s3_client, bucket, backend, job_name, system_instructions, prompt, max_tokens, patient_ids=None):
+    """
+    Builds one model request per patient and submits them as a single batch job.
+    Returns {"job_id", "records", "skipped"}.
+    """
+    if patient_ids is None:
+        patient_ids = list_patient_ids(s3_client, bucket)
+
+    records, skipped = [], []
+    for patient_id in patient_ids:
+        try:
+            payload = build_patient_payload(s3_client, bucket, patient_id, system_instructions, prompt, max_tokens)
+        except Exception:
+            logger.exception("Could not build batch request for patient %s", patient_id)
+            payload = None
+        if payload is None:
+            skipped.append(patient_id)
+            continue
+        records.append({"recordId": f"id_{patient_id}", "modelInput": payload})
+
+    if not records:
+        raise ValueError("No patients with transcripts or PDFs to summarize.")
+    logger.info("Submitting batch job %s with %d records (%d skipped)", job_name, len(records), len(skipped))
+    job_id = backend.submit(job_name, records)
+    return {"job_id": job_id, "records": len(records), "skipped": skipped}
+
+
+def result_counts(result):
+    """
+    The result with its lists (patient IDs and keys) replaced by their
+    lengths, for the logs.
+    """
+    return {name: len(value) if isinstance(value, list) else value for name, value in result.items()}
+
+
+def collect_batch(s3_client, bucket, backend, job_id):
+    """
+    Writes every successful result of a completed (or partially completed)
+    job to the patient's output/Summary/ folder as batch-<job>.txt. Collecting
+    twice writes nothing new: the keys depend only on the job and the record,
+    and existing summaries are never overwritten.
+    Returns {"status", "written", "existing", "failed"}, failed holding the
+    recordIds of the records the model could not answer.
+    """
+    status = backend.status(job_id)
+    if status not in COLLECTABLE_STATUSES:
+        return {"status": status, "written": [], "existing": [], "failed": []}
+
+    job_name = job_id.split("/")[-1]
+    written, existing, failed = [], [], []
+    for record in backend.results(job_id):
+        record_id = record["recordId"]
+        output = record.get("modelOutput")
+        if not output or "error" in record:
+            logger.error("Batch record failed: %s", record.get("error"))
+            failed.append(record_id)
+            continue
+        text = "".join(block.get("text", "") for block in output.get("content", []) if block.get("type") == "text")
+        summary_key = f"{record_id}/output/Summary/batch-{job_name}.txt"
+        try:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=summary_key,
+                Body=text.encode("utf-8"),
+                ContentType="text/plain; charset=utf-8",
+                Metadata={"batch-job": job_name},
+                IfNoneMatch="*"
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in CONFLICT_ERRORS:
+                raise
+            existing.append(summary_key)
+            continue
+        written.append(summary_key)
+    if written:
+        record_objects(s3_client, bucket, written)
+    if failed:
+        logger.warning("Batch job %s: %d records failed", job_name, len(failed))
+    return {"status": status, "written": written, "existing": existing, "failed": failed}
+
+
+@instrumented("bedrock_batch")
+def lambda_handler(event, context):
+    """
+    Overnight batch summaries, e.g. triggered by EventBridge schedules:
+      {"action": "submit", "system_instructions", "prompt", "max_tokens", "patients"?}
+      {"action": "collect", "job_id"}
+    """
+    try:
+        s3_client = get_s3_client()
+        backend = BedrockBatchBackend(s3_client, get_bedrock_client(), BUCKET_NAME, BATCH_ROLE_ARN)
+        action = event.get("action")
+
+        if action == "submit":
+            if not event.get("prompt"):
+                raise ValueError("Missing prompt")
+            job_name = event.get("job_name") or "summaries-" + datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+            result = submit_batch(
+                s3_client,
+                BUCKET_NAME,
+                backend,
+                job_name,
+                event.get("system_instructions", ""),
+                event["prompt"],
+                int(event.get("max_tokens", 4096)),
+                event.get("patients")
+            )
+        elif action == "collect":
+            if not event.get("job_id"):
+                raise ValueError("Missing job_id")
+            result = collect_batch(s3_client, BUCKET_NAME, backend, event["job_id"])
+        else:
+            raise ValueError(f"Unknown action: {action}")
+
+        logger.info("Batch %s result: %s", action, result_counts(result))
+        return {"statusCode": 200, "body": json.dumps(result)}
+
+    except Exception as e:
+        logger.exception("Error in batch summaries")
+        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
@@ -0,0 +1,254 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# Defaults for the in-memory (warm container) tier
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Cache entries are stored with a non-.json suffix so "*.json" listings of the
+# patient folder (transcripts) never pick them up.
+CACHE_PREFIX = "output/Summary/cache/"
+CACHE_SUFFIX = ".cache"
+
+
+def _digest(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_complete(result):
+    """
+    Only results the model finished (stop_reason "end_turn") are cached; one
+    cut off at max_tokens would otherwise be served, truncated, to every
+    later identical request.
+    """
+    try:
+        return json.loads(result).get("stop_reason") == "end_turn"
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def cache_key(model_id, payload):
+    """
+    Builds a content-addressed key for a Bedrock payload.
+    Text is whitespace-normalized and base64 images are replaced by the digest
+    of their data, so the key only depends on what the model actually sees.
+    """
+    messages = []
+    for message in payload.get("messages", []):
+        content = []
+        for block in message.get("content", []):
+            if block.get("type") == "text":
+                content.append({"type": "text", "text": " ".join(block.get("text", "").split())})
+            elif block.get("type") == "image":
+                source = block.get("source", {})
+                content.append({
+                    "type": "image",
+                    "media_type": source.get("media_type"),
+                    "sha256": _digest(source.get("data", ""))
+                })
+            else:
+                content.append(block)
+        messages.append({"role": message.get("role"), "content": content})
+
+    normalized = {
+        "model_id": model_id,
+        "system": " ".join((payload.get("system") or "").split()),
+        "messages": messages,
+        "max_tokens": payload.get("max_tokens"),
+        "temperature": payload.get("temperature"),
+        "top_p": payload.get("top_p"),
+        "stop_sequences": payload.get("stop_sequences", [])
+    }
+    return _digest(json.dumps(normalized, sort_keys=True, ensure_ascii=False))
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with a TTL and entry-count / byte-size limits.
+    Values are strings; their UTF-8 length is used for the size accounting.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (stored_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, size, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, stored_at=None):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (stored_at or time.time(), size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, the others wait for its result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Returns (value, leader) where leader is False for coalesced callers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "value": None, "error": None}
+                self._calls[key] = call
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["value"], False
+
+        try:
+            call["value"] = fn()
+            return call["value"], True
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["event"].set()
+
+
+class ResultCache:
+    """
+    Two-tier cache for model results:
+      - an in-memory LRU that survives across warm invocations of the container
+      - a persistent tier in S3 under id_<patient>/output/Summary/cache/
+    Identical concurrent requests are coalesced so only one model call runs.
+    """
+
+    def __init__(self, s3_client_factory, bucket, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self._s3_client_factory = s3_client_factory
+        self.bucket = bucket
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(max_entries, max_bytes, ttl_seconds)
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def persistent_key(patient_id, key):
+        return f"id_{patient_id}/{CACHE_PREFIX}{key}{CACHE_SUFFIX}"
+
+    def _get_persistent(self, patient_id, key):
+        s3_client = self._s3_client_factory()
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=self.persistent_key(patient_id, key))
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        except Exception:
+            logger.warning("Could not read cache entry %s for patient %s", key, patient_id, exc_info=True)
+            return None
+        entry = json.loads(response["Body"].read().decode("utf-8"))
+        stored_at = entry.get("stored_at", 0)
+        if time.time() - stored_at > self.ttl_seconds:
+            return None
+        return entry.get("result"), stored_at
+
+    def _put_persistent(self, patient_id, key, result):
+        try:
+            self._s3_client_factory().put_object(
+                Bucket=self.bucket,
+                Key=self.persistent_key(patient_id, key),
+                Body=json.dumps({"stored_at": time.time(), "result": result}, ensure_ascii=False).encode("utf-8"),
+                ContentType="application/json"
+            )
+        except Exception:
+            logger.warning("Could not write cache entry %s for patient %s", key, patient_id, exc_info=True)
+
+    def lookup(self, key, patient_id):
+        """
+        Returns (result, status) from the memory tier ("memory_hit") or the
+        patient's persistent tier ("s3_hit"), or (None, None).
+        """
+        result = self.memory.get(key)
+        if result is not None:
+            return result, "memory_hit"
+        if patient_id:
+            persisted = self._get_persistent(patient_id, key)
+            if persisted is not None and is_complete(persisted[0]):
+                self.memory.put(key, persisted[0], stored_at=persisted[1])
+                return persisted[0], "s3_hit"
+        return None, None
+
+    def store(self, key, patient_id, result):
+        """
+        Caches a result the model finished. Returns whether it was cached.
+        """
+        if not is_complete(result):
+            logger.info("Not caching result %s: the model did not finish it", key)
+            return False
+        self.memory.put(key, result)
+        if patient_id:
+            self._put_persistent(patient_id, key, result)
+        return True
+
+    def get_or_compute(self, key, patient_id, compute):
+        """
+        Returns (result, status, extra). status is one of "memory_hit",
+        "s3_hit", "miss" or "coalesced". compute() must return a
+        (result, extra) tuple; extra is passed through only to the caller that
+        actually ran the model. Results the model did not finish are returned
+        but not cached.
+        """
+        result = self.memory.get(key)
+        if result is not None:
+            return result, "memory_hit", None
+
+        def load_or_run():
+            cached, status = self.lookup(key, patient_id)
+            if cached is not None:
+                return cached, status, None
+            computed, extra = compute()
+            self.store(key, patient_id, computed)
+            return computed, "miss", extra
+
+        (result, status, extra), leader = self._flight.do(key, load_or_run)
+        if not leader:
+            return result, "coalesced", None
+        return result, status, extra
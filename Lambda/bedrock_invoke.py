@@ -0,0 +1,328 @@
+import os
+import time
+import random
+import logging
+import threading
+from aws_clients import BEDROCK_REGION, get_bedrock_runtime_client
+from instrumentation import log_event, record, stage
+
+logger = logging.getLogger()
+
+# Model calls go through BedrockInvoker, which
+#   - retries throttled and transient failures with exponential backoff and
+#     full jitter, waiting at least as long as a Retry-After header asks,
+#   - limits the calls in flight per endpoint with an AIMD limiter shared by
+#     all threads of the container: while the limit is in use it grows by one
+#     per `limit` successful calls, and it halves on a throttle (once per
+#     round of calls: throttles of calls started before the last cut are
+#     ignored),
+#   - fails over along an ordered list of (region, model ID) endpoints: the
+#     primary (BEDROCK_REGION and the model ID of bedrock.py), then
+#     BEDROCK_FAILOVER_ENDPOINTS ("us-east-1=us.anthropic...,eu-central-1";
+#     entries without a model ID use the primary one). An endpoint that keeps
+#     throttling is skipped for ENDPOINT_COOLDOWN seconds,
+#   - gives up with BedrockUnavailable (a 503 for the client) once the
+#     invocation's deadline (set_deadline) is DEADLINE_MARGIN seconds away,
+#     whether it is waiting for a concurrency slot or between retries, or
+#     when every endpoint stayed throttled or unavailable. Errors that
+#     retrying cannot fix (validation, or access denied on every endpoint)
+#     are raised as they are.
+ATTEMPTS_PER_ENDPOINT = int(os.environ.get("BEDROCK_ATTEMPTS_PER_ENDPOINT", "3"))
+MAX_RETRY_WAIT = float(os.environ.get("BEDROCK_MAX_RETRY_WAIT", "20"))
+BASE_DELAY = 0.5
+MAX_DELAY = 8
+INITIAL_CONCURRENCY = int(os.environ.get("BEDROCK_INITIAL_CONCURRENCY", "4"))
+MAX_CONCURRENCY = int(os.environ.get("BEDROCK_MAX_CONCURRENCY", "16"))
+ENDPOINT_COOLDOWN = 30
+DEADLINE_MARGIN = float(os.environ.get("BEDROCK_DEADLINE_MARGIN", "3"))
+
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException")
+RETRYABLE_ERRORS = ("ModelNotReadyException", "ServiceUnavailableException", "InternalServerException")
+# The model is not available (or not enabled) in the endpoint's region:
+# move on to the next endpoint right away.
+FAILOVER_ERRORS = ("AccessDeniedException", "ResourceNotFoundException")
+
+
+class BedrockUnavailable(Exception):
+    """
+    Raised when every endpoint was throttled or unavailable within the retry
+    budget. retry_after is a suggested wait in seconds.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, base=BASE_DELAY, maximum=MAX_DELAY):
+    """
+    Exponential backoff with full jitter, in seconds.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def error_code(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code", "")
+
+
+def retry_after(error):
+    """
+    The Retry-After header of a failed call in seconds, or None.
+    """
+    headers = getattr(error, "response", {}).get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    try:
+        return max(0.0, float(headers["retry-after"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def classify(error):
+    """
+    Returns "throttle", "retry" or "failover" for errors worth another
+    attempt, or None for errors that would fail anywhere (e.g. validation).
+    """
+    code = error_code(error)
+    if code in THROTTLING_ERRORS:
+        return "throttle"
+    if code in RETRYABLE_ERRORS:
+        return "retry"
+    if code in FAILOVER_ERRORS:
+        return "failover"
+    if not code:
+        from botocore.exceptions import ConnectionError as BotocoreConnectionError, ReadTimeoutError
+        if isinstance(error, (BotocoreConnectionError, ReadTimeoutError)):
+            return "retry"
+    return None
+
+
+def failover_endpoints(primary_model_id, value=None):
+    """
+    The ordered [(region, model_id)] endpoints: the primary one, then those
+    of BEDROCK_FAILOVER_ENDPOINTS.
+    """
+    if value is None:
+        value = os.environ.get("BEDROCK_FAILOVER_ENDPOINTS", "")
+    endpoints = [(BEDROCK_REGION, primary_model_id)]
+    for entry in value.split(","):
+        region, _, model_id = entry.strip().partition("=")
+        endpoint = (region.strip(), model_id.strip() or primary_model_id)
+        if endpoint[0] and endpoint not in endpoints:
+            endpoints.append(endpoint)
+    return endpoints
+
+
+class AdaptiveLimiter:
+    """
+    Thread-safe AIMD limit on the number of calls in flight.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=1, maximum=MAX_CONCURRENCY,
+                 decrease=0.5, clock=time.monotonic):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.clock = clock
+        self.in_flight = 0
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        """
+        Waits for a free slot, until deadline (a clock() time) at the latest.
+        Returns the time the call started.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                timeout = None if deadline is None else deadline - self.clock()
+                if timeout is not None and timeout <= 0:
+                    raise BedrockUnavailable("Timed out waiting for a Bedrock concurrency slot", 1)
+                self._condition.wait(timeout)
+            self.in_flight += 1
+            return self.clock()
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        """
+        Called before release(). Grows the limit only while all of it is in use.
+        """
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def on_throttle(self, started):
+        """
+        Cuts the limit for a throttled call that started at `started`. Calls
+        that were already in flight at the last cut do not cut it again.
+        """
+        with self._condition:
+            if self._last_decrease is None or started >= self._last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = self.clock()
+
+
+class HeldStream:
+    """
+    The event stream of a call that holds a concurrency slot. The slot is
+    released once, when the stream is exhausted, fails or is closed; callers
+    that stop reading early (a client disconnect, an error) must close it.
+    """
+
+    def __init__(self, events, release):
+        self._events = events
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            yield from self._events
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            close = getattr(self._events, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+
+class BedrockInvoker:
+    """
+    Invokes models through the ordered endpoints with retries, backoff and
+    per-endpoint concurrency limits. client_factory(region) returns the
+    bedrock-runtime client of a region; sleep and clock can be replaced in tests.
+    """
+
+    def __init__(self, endpoints, client_factory=get_bedrock_runtime_client,
+                 attempts_per_endpoint=ATTEMPTS_PER_ENDPOINT, max_retry_wait=MAX_RETRY_WAIT,
+                 delay=backoff_delay, sleep=time.sleep, clock=time.monotonic):
+        self.endpoints = list(endpoints)
+        self.client_factory = client_factory
+        self.attempts_per_endpoint = attempts_per_endpoint
+        self.max_retry_wait = max_retry_wait
+        self.delay = delay
+        self.sleep = sleep
+        self.clock = clock
+        self.limiters = {endpoint: AdaptiveLimiter(clock=clock) for endpoint in self.endpoints}
+        self.deadline = None
+        self._cooling_until = {}
+        self._lock = threading.Lock()
+
+    def set_deadline(self, context, margin=DEADLINE_MARGIN):
+        """
+        Makes the calls of this invocation (context is the Lambda context, or
+        None for no deadline) give up margin seconds before it times out.
+        """
+        remaining = getattr(context, "get_remaining_time_in_millis", None)
+        self.deadline = None if remaining is None else self.clock() + remaining() / 1000 - margin
+
+    def ordered_endpoints(self):
+        """
+        The endpoints in their configured order, those cooling down after
+        repeated throttles last.
+        """
+        now = self.clock()
+        with self._lock:
+            cooling = {endpoint: until for endpoint, until in self._cooling_until.items() if until > now}
+        return (
+            [endpoint for endpoint in self.endpoints if endpoint not in cooling]
+            + sorted(cooling, key=cooling.get)
+        )
+
+    def _cool_down(self, endpoint):
+        with self._lock:
+            self._cooling_until[endpoint] = self.clock() + ENDPOINT_COOLDOWN
+
+    def _call(self, operation, body, hold_slot=False):
+        """
+        Runs client.<operation>(modelId, body) until an endpoint succeeds.
+        Returns (response, limiter); with hold_slot the caller releases the
+        limiter's slot.
+        """
+        waited = 0.0
+        attempt = 0
+        last_error = None
+        suggested_wait = None
+        transient = False
+        for index, endpoint in enumerate(self.ordered_endpoints()):
+            region, model_id = endpoint
+            limiter = self.limiters[endpoint]
+            if index > 0:
+                record("BedrockFailovers", 1)
+                log_event("bedrock failover", level=logging.WARNING, region=region, modelId=model_id,
+                          error=error_code(last_error) or type(last_error).__name__)
+            for endpoint_attempt in range(self.attempts_per_endpoint):
+                started = limiter.acquire(self.deadline)
+                try:
+                    response = getattr(self.client_factory(region), operation)(
+                        modelId=model_id,
+                        body=body,
+                        contentType="application/json"
+                    )
+                except Exception as error:
+                    limiter.release()
+                    kind = classify(error)
+                    if kind is None:
+                        raise
+                    last_error = error
+                    suggested_wait = retry_after(error)
+                    transient = transient or kind != "failover"
+                    if kind == "throttle":
+                        record("BedrockThrottles", 1)
+                        limiter.on_throttle(started)
+                else:
+                    limiter.on_success()
+                    if not hold_slot:
+                        limiter.release()
+                    return response, limiter
+
+                if kind == "failover":
+                    break
+                if endpoint_attempt == self.attempts_per_endpoint - 1:
+                    if kind == "throttle":
+                        self._cool_down(endpoint)
+                    break
+                wait = max(self.delay(attempt), suggested_wait or 0)
+                out_of_time = self.deadline is not None and self.clock() + wait > self.deadline
+                if waited + wait > self.max_retry_wait or out_of_time:
+                    raise BedrockUnavailable(f"Bedrock is unavailable: {last_error}", suggested_wait or wait) from last_error
+                record("BedrockRetries", 1)
+                logger.info("Retrying %s in %s after %s (%.2fs)", operation, region, error_code(last_error) or last_error, wait)
+                self.sleep(wait)
+                waited += wait
+                attempt += 1
+        if not transient:
+            # Every endpoint refused the model (e.g. AccessDenied): waiting will not help.
+            raise last_error
+        raise BedrockUnavailable(f"Bedrock is unavailable: {last_error}", suggested_wait) from last_error
+
+    def invoke_model(self, body):
+        """
+        invoke_model on the first endpoint that answers. Returns the response.
+        """
+        with stage("bedrock.invoke"):
+            response, _ = self._call("invoke_model", body)
+        return response
+
+    def invoke_model_with_response_stream(self, body):
+        """
+        invoke_model_with_response_stream on the first endpoint that answers.
+        Only starting the stream is retried; the call keeps its concurrency
+        slot until the stream (a HeldStream) is consumed or closed.
+        """
+        with stage("bedrock.invoke"):
+            response, limiter = self._call("invoke_model_with_response_stream", body, hold_slot=True)
+        return dict(response, body=HeldStream(response["body"], limiter.release))
+
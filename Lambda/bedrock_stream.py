@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import logging
+from itertools import chain
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bedrock
+from bedrock_invoke import BedrockUnavailable
+from instrumentation import instrumented
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Streaming mode of bedrock.py. API Gateway (and a plain Python Lambda
+# handler) buffers the whole response, so streamed completions are served by
+# this small HTTP server running behind the AWS Lambda Web Adapter, on a
+# Function URL in RESPONSE_STREAM invoke mode (AWS_LWA_INVOKE_MODE=
+# response_stream). Each SSE frame is written as one HTTP chunk and flushed
+# as soon as the model produces it. Requests take the same body as
+# bedrock.py's single-call mode.
+PORT = int(os.environ.get("AWS_LWA_PORT", os.environ.get("PORT", "8080")))
+HOST = os.environ.get("HOST", "127.0.0.1")
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "OPTIONS, POST",
+    "Access-Control-Allow-Headers": "Content-Type, x-api-key"
+}
+
+
+class AdapterContext:
+    """
+    The parts of the Lambda context the handlers use, from the
+    x-amzn-lambda-context header the web adapter forwards.
+    """
+
+    def __init__(self, deadline_ms):
+        self.deadline_ms = deadline_ms
+
+    def get_remaining_time_in_millis(self):
+        return max(0, self.deadline_ms - int(time.time() * 1000))
+
+
+def adapter_context(header):
+    """
+    Returns the invocation's context, or None when the header is missing
+    (e.g. when the server runs locally).
+    """
+    try:
+        return AdapterContext(int(json.loads(header)["deadline"]))
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def send_json(request, status_code, body, headers=None):
+    data = json.dumps(body).encode("utf-8")
+    request.send_response(status_code)
+    for name, value in dict(CORS_HEADERS, **(headers or {})).items():
+        request.send_header(name, value)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(data)))
+    request.end_headers()
+    request.wfile.write(data)
+    return {"statusCode": status_code}
+
+
+def write_chunk(stream, data):
+    """
+    Writes one chunk of a chunked response and flushes it to the client.
+    """
+    stream.write(b"%x\r\n%s\r\n" % (len(data), data))
+    stream.flush()
+
+
+@instrumented("bedrock_stream")
+def serve_stream(request, context):
+    """
+    Answers one streaming request (request is the BaseHTTPRequestHandler):
+    200 with a text/event-stream of "delta" frames and a final "done" frame,
+    400 for invalid requests, 503 with Retry-After when the model is
+    unavailable, 500 for other errors. Returns {"statusCode"} for the invocation's metrics.
+    """
+    # Model calls give up (with a 503) before the function times out.
+    bedrock.INVOKER.set_deadline(context)
+    try:
+        body = json.loads(request.rfile.read(int(request.headers.get("Content-Length") or 0)) or b"{}")
+        payload, image_stats = bedrock.build_request(body)
+    except ValueError as e:
+        return send_json(request, 400, {"error": str(e)})
+    except Exception as e:
+        logger.exception("Error preparing the Bedrock request:")
+        return send_json(request, 500, {"error": str(e)})
+
+    frames = bedrock.stream_frames(
+        bedrock.INVOKER, payload, body.get("patientID"), bool(body.get("bypass_cache")), image_stats
+    )
+    try:
+        try:
+            # The status line depends on whether the model call can start.
+            first = next(frames)
+        except BedrockUnavailable as e:
+            logger.warning("Bedrock unavailable: %s", e)
+            retry_after = max(1, int(e.retry_after or 5))
+            return send_json(request, 503, {"error": "The model is busy, please try again shortly.", "retryAfter": retry_after},
+                             {"Retry-After": str(retry_after)})
+        except Exception as e:
+            logger.exception("Error invoking Bedrock model:")
+            return send_json(request, 500, {"error": str(e)})
+
+        request.send_response(200)
+        for name, value in CORS_HEADERS.items():
+            request.send_header(name, value)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Cache-Control", "no-cache")
+        request.send_header("Transfer-Encoding", "chunked")
+        request.end_headers()
+        try:
+            for frame in chain([first], frames):
+                write_chunk(request.wfile, frame.encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("The client disconnected during the stream.")
+            return {"statusCode": 499}
+        except Exception as e:
+            logger.exception("Streaming failed after the response started.")
+            write_chunk(request.wfile, bedrock.sse_event("error", {"error": str(e)}).encode("utf-8"))
+        write_chunk(request.wfile, b"")
+        return {"statusCode": 200}
+    finally:
+        # Releases the model call when the client went away mid-stream.
+        frames.close()
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        for name, value in CORS_HEADERS.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        # Readiness check of the web adapter.
+        send_json(self, 200, {"status": "ready"})
+
+    def do_POST(self):
+        serve_stream(self, adapter_context(self.headers.get("x-amzn-lambda-context")))
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def main():
+    server = ThreadingHTTPServer((HOST, PORT), StreamHandler)
+    logger.info("Serving streamed completions on %s:%d", HOST, PORT)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,4 @@
+#!/bin/sh
+# Handler of the streaming function: the Lambda Web Adapter layer forwards
+# each invocation to this server.
+exec python bedrock_stream.py
@@ -0,0 +1,150 @@
+"""
+Cold- and warm-invocation cost of the AWS clients of the handlers, compared
+across git revisions (e.g. before and after the shared clients of
+aws_clients.py).
+
+The Lambda/ folder of every revision is extracted to a temporary directory
+and its presigned_urls and delete handlers are invoked against moto's S3,
+with every S3 call sleeping --s3-latency-ms first. Placeholder bucket and
+region literals of old revisions ('BUCKET_NAME', 'BUCKET_REGION') are
+replaced by the benchmark's, as a deployment would. Per revision and
+operation it reports the import time of the handler in a new interpreter
+(importMs), the first invocation (firstMs, which creates the clients) and the
+median of the others (p50Ms). Connection reuse is not measured: moto answers
+in-process, without TLS connections.
+
+Usage (from Lambda/):
+    python benchmarks/bench_clients.py 0475821 HEAD --iterations 50
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tarfile
+import tempfile
+import statistics
+import subprocess
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+
+from benchmarks.bench_handlers import BUCKET, ENVIRONMENT, PATIENT, FakeContext, percentile  # noqa: E402
+
+PLACEHOLDERS = [
+    (re.compile(r"""(=\s*)(['"])BUCKET_NAME\2"""), rf"\1'{BUCKET}'"),
+    (re.compile(r"""(region_name=)(['"])BUCKET_REGION\2"""), rf"\1'{ENVIRONMENT['BUCKET_REGION']}'")
+]
+OPERATIONS = {
+    "presign_single": ("presigned_urls", {"httpMethod": "GET", "queryStringParameters": {"patientId": PATIENT, "fileName": "0.pdf"}}),
+    "presign_list": ("presigned_urls", {"httpMethod": "GET", "queryStringParameters": {"patientId": PATIENT, "fileName": "*.pdf"}}),
+    "delete_file": ("delete", {"httpMethod": "DELETE", "queryStringParameters": {"patientId": PATIENT, "fileName": "{index}.pdf"}})
+}
+
+
+def extract(revision, directory):
+    """
+    Writes the Lambda/ folder of the revision to directory, with the
+    placeholder literals replaced.
+    """
+    archive = subprocess.run(["git", "archive", "--prefix=Lambda/", f"{revision}:Lambda"], cwd=os.path.dirname(LAMBDA_DIR), capture_output=True, check=True).stdout
+    path = os.path.join(directory, "archive.tar")
+    with open(path, "wb") as output_file:
+        output_file.write(archive)
+    with tarfile.open(path) as tar:
+        tar.extractall(directory, filter="data")
+    source_dir = os.path.join(directory, "Lambda")
+    for name in os.listdir(source_dir):
+        if name.endswith(".py"):
+            with open(os.path.join(source_dir, name)) as source_file:
+                source = source_file.read()
+            for pattern, replacement in PLACEHOLDERS:
+                source = pattern.sub(replacement, source)
+            with open(os.path.join(source_dir, name), "w") as source_file:
+                source_file.write(source)
+    return source_dir
+
+
+def run_operation(args):
+    """
+    Invokes one operation --iterations times in this interpreter (started in
+    the extracted folder) and prints its timings as JSON.
+    """
+    import io
+    import boto3
+    from contextlib import redirect_stdout
+    from moto import mock_aws
+
+    # The handlers come from the extracted revision, not from this tree.
+    sys.path.insert(0, os.getcwd())
+    module_name, event = OPERATIONS[args.run]
+    with mock_aws():
+        # Clients created by the handlers inherit the latency from the session.
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call.*.*", lambda **kwargs: time.sleep(args.s3_latency_ms / 1000))
+        s3 = boto3.client("s3", region_name=ENVIRONMENT["BUCKET_REGION"])
+        s3.create_bucket(Bucket=BUCKET)
+        for index in range(args.iterations + 20):
+            s3.put_object(Bucket=BUCKET, Key=f"id_{PATIENT}/{index}.pdf", Body=b"%PDF-1.4 benchmark")
+
+        started = time.perf_counter()
+        module = __import__(module_name)
+        import_ms = (time.perf_counter() - started) * 1000
+        times = []
+        for index in range(args.iterations):
+            request = json.loads(json.dumps(event).replace("{index}", str(index)))
+            started = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                response = module.lambda_handler(request, FakeContext())
+            times.append((time.perf_counter() - started) * 1000)
+            if response.get("statusCode") != 200:
+                raise RuntimeError(f"Unexpected response: {str(response)[:500]}")
+    print(json.dumps({"inProcessImportMs": round(import_ms, 2), "times": times}))
+
+
+def measure(source_dir, operation, args):
+    module_name = OPERATIONS[operation][0]
+    env = dict(os.environ, **ENVIRONMENT)
+    code = f"import time; started = time.perf_counter(); import {module_name}; print((time.perf_counter() - started) * 1000)"
+    imports = [float(subprocess.run([sys.executable, "-c", code], cwd=source_dir, env=env, capture_output=True,
+                                    text=True, check=True).stdout.strip().splitlines()[-1])
+               for _ in range(args.import_repeats)]
+    command = [sys.executable, os.path.abspath(__file__), "--run", operation,
+               "--iterations", str(args.iterations), "--s3-latency-ms", str(args.s3_latency_ms)]
+    output = subprocess.run(command, cwd=source_dir, env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise SystemExit(f"{operation} failed:\n{output.stderr[-4000:]}")
+    times = json.loads(output.stdout.strip().splitlines()[-1])["times"]
+    return {
+        "importMs": round(statistics.median(imports), 2),
+        "firstMs": round(times[0], 2),
+        "p50Ms": round(percentile(times[1:], 0.50), 2),
+        "p95Ms": round(percentile(times[1:], 0.95), 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("revisions", nargs="*", default=["HEAD"])
+    parser.add_argument("--operations", nargs="+", choices=sorted(OPERATIONS), default=sorted(OPERATIONS))
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--s3-latency-ms", type=float, default=5)
+    parser.add_argument("--import-repeats", type=int, default=5)
+    parser.add_argument("--run", choices=sorted(OPERATIONS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        os.environ.update(ENVIRONMENT)
+        return run_operation(args)
+
+    for revision in args.revisions:
+        with tempfile.TemporaryDirectory() as directory:
+            source_dir = extract(revision, directory)
+            for operation in args.operations:
+                result = dict(revision=revision, operation=operation, **measure(source_dir, operation, args))
+                print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
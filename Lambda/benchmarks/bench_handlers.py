@@ -0,0 +1,376 @@
+"""
+End-to-end benchmark of the API handlers against local stand-ins.
+
+Runs the lambda_handler of presigned_urls, delete, upload, bedrock and
+transcribe with realistic requests: S3 and Transcribe are moto's in-memory
+implementations and Bedrock is a fake client; every call to them sleeps for a
+configurable latency first, like a call over the network would. Scenarios:
+  - presigned_urls: listing a patient folder of --files files (wildcard
+    listing from the manifest, listing with a manifest rebuild, one file),
+  - delete: deleting patient folders of --files files,
+  - upload: --upload-mb uploads through the handler, initiating a multipart
+    upload of a long recording,
+  - bedrock: a request with --images scanned page images (preprocessed,
+    then sent to the fake model), and the same request served from the cache,
+  - transcribe: starting a job, its completion event and the status request.
+
+Each scenario runs in a fresh interpreter, so the peak RSS is its own. The
+first invocation of every operation is reported separately (firstMs) from the
+latency percentiles of the others; coldImportMs is the import time of the
+handler module in a new interpreter. Stage timings are the medians of the
+metrics the handlers emit (instrumentation.py).
+
+Usage (from Lambda/):
+    python benchmarks/bench_handlers.py --files 5000 --images 40 --output results.json
+
+Prints one JSON line per scenario; --output also writes them, with the run's
+settings, to a JSON file that later runs can be compared against.
+"""
+import os
+import io
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+
+SCENARIOS = ("presigned_urls", "delete", "upload", "bedrock", "transcribe")
+BUCKET = "benchmark-bucket"
+PATIENT = "1000"
+ENVIRONMENT = {
+    "BUCKET_NAME": BUCKET,
+    "AWS_REGION": "us-east-1",
+    "BUCKET_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_LAMBDA_FUNCTION_NAME": "benchmark",
+    "LOG_SAMPLE_RATE": "0"
+}
+
+
+class FakeContext:
+    """
+    The parts of the Lambda context the handlers use.
+    """
+    function_name = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def add_latency(client, milliseconds):
+    """
+    Makes every API call of a boto3 client sleep first.
+    """
+    def sleep(**kwargs):
+        time.sleep(milliseconds / 1000)
+    client.meta.events.register("before-call.*.*", sleep)
+    return client
+
+
+def make_page(rng, width=1654, height=2339):
+    """
+    A JPEG of a scanned A4 page at 200 dpi: lines of dark "words" on a
+    slightly noisy paper background.
+    """
+    from PIL import Image, ImageDraw
+
+    image = Image.new("L", (width, height), 250)
+    draw = ImageDraw.Draw(image)
+    y = 150
+    while y < height - 150:
+        x = 120
+        while x < width - 200:
+            word = rng.randint(40, 160)
+            draw.rectangle([x, y, x + word, y + 22], fill=rng.randint(20, 80))
+            x += word + rng.randint(15, 30)
+        y += rng.randint(40, 60)
+    noise = Image.effect_noise((width, height), 12).point(lambda value: value // 8)
+    image = Image.composite(image, noise, Image.new("L", (width, height), 230))
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def populate_folder(s3, patient_id, count, rng):
+    """
+    Writes a patient folder like the app produces: recordings with their
+    transcripts and extracted audio, documents, images and summaries.
+    """
+    keys = [f"id_{patient_id}/", f"id_{patient_id}/output/", f"id_{patient_id}/output/Summary/"]
+    index = 0
+    while len(keys) < count:
+        stamp = f"2201{index % 28 + 1:02d}-{index:06d}"
+        kind = rng.random()
+        if kind < 0.2:
+            keys += [f"id_{patient_id}/{stamp}.mp4", f"id_{patient_id}/{stamp}.json",
+                     f"id_{patient_id}/{stamp}.turns.jsonl", f"id_{patient_id}/output/audio/{stamp}.ogg"]
+        elif kind < 0.6:
+            keys.append(f"id_{patient_id}/{stamp}.pdf")
+        elif kind < 0.85:
+            keys.append(f"id_{patient_id}/{stamp}.jpg")
+        else:
+            keys.append(f"id_{patient_id}/output/Summary/{stamp}.txt")
+        index += 1
+    keys = keys[:count]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"" if key.endswith("/") else b"%PDF-1.4 benchmark")
+    return keys
+
+
+class Recorder:
+    """
+    Runs handler invocations and collects, per operation, their latency, the
+    request and response sizes and the stage timings they emit.
+    """
+
+    def __init__(self):
+        self.operations = {}
+
+    def call(self, operation, handler, event):
+        request_bytes = len(json.dumps(event))
+        output = io.StringIO()
+        started = time.perf_counter()
+        with redirect_stdout(output):
+            response = handler(event, FakeContext())
+        elapsed = (time.perf_counter() - started) * 1000
+        samples = self.operations.setdefault(operation, {"ms": [], "request": [], "response": [], "stages": {}})
+        samples["ms"].append(elapsed)
+        samples["request"].append(request_bytes)
+        samples["response"].append(len(response.get("body") or ""))
+        for line in output.getvalue().splitlines():
+            if not line.startswith("{") or '"_aws"' not in line:
+                continue
+            metrics = json.loads(line)
+            for name in metrics:
+                if name.endswith(".ms"):
+                    values = metrics[name] if isinstance(metrics[name], list) else [metrics[name]]
+                    samples["stages"].setdefault(name[:-3], []).append(sum(values))
+        return response
+
+    def report(self):
+        report = {}
+        for operation, samples in self.operations.items():
+            first, warm = samples["ms"][0], samples["ms"][1:] or samples["ms"]
+            report[operation] = {
+                "count": len(samples["ms"]),
+                "firstMs": round(first, 2),
+                "p50Ms": round(percentile(warm, 0.50), 2),
+                "p95Ms": round(percentile(warm, 0.95), 2),
+                "p99Ms": round(percentile(warm, 0.99), 2),
+                "meanMs": round(statistics.fmean(warm), 2),
+                "requestBytes": max(samples["request"]),
+                "responseBytes": max(samples["response"]),
+                "stagesMs": {name: round(statistics.median(values), 2) for name, values in sorted(samples["stages"].items())}
+            }
+        return report
+
+
+def check(response, *statuses):
+    if response.get("statusCode") not in statuses:
+        raise RuntimeError(f"Unexpected response: {str(response)[:500]}")
+    return response
+
+
+def run_presigned_urls(args, s3, recorder):
+    import presigned_urls
+
+    keys = populate_folder(s3, PATIENT, args.files, random.Random(1))
+    single = next(key for key in keys if key.endswith(".mp4")).split("/")[-1]
+    query = {"patientId": PATIENT, "fileName": "*.pdf,*.mp4", "limit": "1000"}
+    for _ in range(args.iterations):
+        check(recorder.call("list", presigned_urls.lambda_handler, {"httpMethod": "GET", "queryStringParameters": query}), 200)
+    for _ in range(max(1, args.iterations // 4)):
+        event = {"httpMethod": "GET", "queryStringParameters": dict(query, refresh="true")}
+        check(recorder.call("list_refresh", presigned_urls.lambda_handler, event), 200)
+    for _ in range(args.iterations):
+        event = {"httpMethod": "GET", "queryStringParameters": {"patientId": PATIENT, "fileName": single}}
+        check(recorder.call("single", presigned_urls.lambda_handler, event), 200)
+    return {"files": len(keys)}
+
+
+def run_delete(args, s3, recorder):
+    import delete
+
+    patients = [f"{PATIENT}{index}" for index in range(args.iterations)]
+    for patient_id in patients:
+        populate_folder(s3, patient_id, args.files, random.Random(patient_id))
+    for patient_id in patients:
+        event = {"httpMethod": "DELETE", "queryStringParameters": {"patientId": patient_id}}
+        check(recorder.call("delete_folder", delete.lambda_handler, event), 200)
+    return {"files": args.files}
+
+
+def run_upload(args, s3, recorder):
+    import upload
+
+    data = base64.b64encode(os.urandom(int(args.upload_mb * 2 ** 20))).decode("ascii")
+    for index in range(args.iterations):
+        body = {"id": PATIENT, "fileName": f"scan-{index}.pdf", "contentType": "application/pdf", "file": data}
+        check(recorder.call("put_base64", upload.lambda_handler, {"httpMethod": "POST", "body": json.dumps(body)}), 200)
+    for index in range(args.iterations):
+        body = {"id": PATIENT, "action": "initiate", "fileName": f"visit-{index}.mp4",
+                "contentType": "video/mp4", "size": 2 * 2 ** 30}
+        check(recorder.call("multipart_initiate", upload.lambda_handler, {"httpMethod": "POST", "body": json.dumps(body)}), 200)
+    return {"uploadBytes": len(data) * 3 // 4}
+
+
+def run_bedrock(args, s3, recorder):
+    import bedrock
+    from bedrock_invoke import BedrockInvoker
+    from benchmarks.fake_bedrock import FakeBedrockRuntime
+
+    fake = FakeBedrockRuntime(latency=args.bedrock_latency_ms / 1000, per_kb=args.bedrock_ms_per_kb / 1000,
+                              throttle_rate=args.bedrock_throttle_rate, seed=3)
+    bedrock.INVOKER = BedrockInvoker(bedrock.INVOKER.endpoints, client_factory=lambda region: fake)
+    rng = random.Random(3)
+    images = [{"media_type": "image/jpeg", "data": base64.b64encode(make_page(rng)).decode("ascii")} for _ in range(args.images)]
+    body = {"patientID": PATIENT, "system_instructions": "You summarize medical records.",
+            "prompt": "Summarize the attached documents.", "images": images, "max_tokens": 2000}
+    for index in range(args.iterations):
+        event = {"httpMethod": "POST", "body": json.dumps(dict(body, bypass_cache=True, prompt=f"{body['prompt']} ({index})"))}
+        check(recorder.call("invoke", bedrock.lambda_handler, event), 200)
+    for _ in range(args.iterations):
+        check(recorder.call("cached", bedrock.lambda_handler, {"httpMethod": "POST", "body": json.dumps(body)}), 200)
+    return {"images": len(images), "imageBytes": sum(len(image["data"]) * 3 // 4 for image in images)}
+
+
+def run_transcribe(args, s3, recorder):
+    import transcribe
+
+    transcript = {"results": {"transcripts": [{"transcript": "המטופל מדווח על כאבים בגב התחתון " * 200}], "items": []}}
+    for index in range(args.iterations):
+        file_name = f"2201{index % 28 + 1:02d}-{index:06d}.mp3"
+        s3.put_object(Bucket=BUCKET, Key=f"id_{PATIENT}/{file_name}", Body=os.urandom(64 * 1024), ContentType="audio/mpeg")
+        event = {"httpMethod": "POST", "body": json.dumps({"patientID": PATIENT, "fileName": file_name})}
+        job_id = json.loads(check(recorder.call("start", transcribe.lambda_handler, event), 202)["body"])["jobId"]
+        s3.put_object(Bucket=BUCKET, Key=f"{job_id}.json", Body=json.dumps(transcript).encode("utf-8"))
+        recorder.call("complete", transcribe.lambda_handler, {"Records": [{"s3": {"object": {"key": f"{job_id}.json"}}}]})
+        event = {"httpMethod": "GET", "queryStringParameters": {"jobId": job_id}}
+        check(recorder.call("status", transcribe.lambda_handler, event), 200)
+    return {"jobs": args.iterations}
+
+
+RUNNERS = {
+    "presigned_urls": run_presigned_urls,
+    "delete": run_delete,
+    "upload": run_upload,
+    "bedrock": run_bedrock,
+    "transcribe": run_transcribe
+}
+
+
+def run_scenario(args):
+    """
+    Runs one scenario in this interpreter and prints its result as JSON.
+    """
+    from moto import mock_aws
+
+    with mock_aws():
+        import aws_clients
+
+        s3 = aws_clients.get_s3_client()
+        s3.create_bucket(Bucket=BUCKET)
+        # The handlers share these cached clients, so they see the latency too.
+        add_latency(s3, args.s3_latency_ms)
+        add_latency(aws_clients.get_transcribe_client(), args.transcribe_latency_ms)
+        add_latency(aws_clients.get_lambda_client(), args.s3_latency_ms)
+
+        recorder = Recorder()
+        details = RUNNERS[args.run](args, s3, recorder)
+        result = {"scenario": args.run, "operations": recorder.report(), "peakRssMb": round(peak_rss_mb(), 1)}
+        result.update(details)
+        print(json.dumps(result))
+
+
+def cold_import_ms(module, repeats):
+    """
+    Median time to import the handler module in a new interpreter.
+    """
+    code = f"import time; started = time.perf_counter(); import {module}; print((time.perf_counter() - started) * 1000)"
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], cwd=LAMBDA_DIR, env=dict(os.environ, **ENVIRONMENT),
+                                capture_output=True, text=True, check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return round(statistics.median(times), 2)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=LAMBDA_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--files", type=int, default=5000, help="files per patient folder")
+    parser.add_argument("--upload-mb", type=float, default=6)
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--s3-latency-ms", type=float, default=5)
+    parser.add_argument("--transcribe-latency-ms", type=float, default=30)
+    parser.add_argument("--bedrock-latency-ms", type=float, default=300)
+    parser.add_argument("--bedrock-ms-per-kb", type=float, default=0.05)
+    parser.add_argument("--bedrock-throttle-rate", type=float, default=0, help="fraction of model calls throttled")
+    parser.add_argument("--import-repeats", type=int, default=5)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--run", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        os.environ.update(ENVIRONMENT)
+        return run_scenario(args)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("run", "output", "scenarios")}
+    results = []
+    for scenario in args.scenarios:
+        command = [sys.executable, os.path.abspath(__file__), "--run", scenario]
+        for key, value in settings.items():
+            command += [f"--{key.replace('_', '-')}", str(value)]
+        output = subprocess.run(command, cwd=LAMBDA_DIR, env=dict(os.environ, **ENVIRONMENT),
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            raise SystemExit(f"Scenario {scenario} failed:\n{output.stderr[-4000:]}")
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        result["coldImportMs"] = cold_import_ms(scenario, args.import_repeats)
+        results.append(result)
+        print(json.dumps(result), flush=True)
+
+    if args.output:
+        report = {
+            "createdAt": int(time.time()),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": settings,
+            "results": results
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark of map-reduce summarization against a single model call.
+
+Summarizes 1 to N synthetic transcripts both ways against a stub model whose
+latency is a fixed overhead plus a cost per input token and per output token
+(output tokens dominate, as with the real model). Map calls answer with a
+quarter of their input, up to map_max_tokens; the final call answers with
+max_tokens. The stub's delays are multiplied by --time-scale so a run takes
+seconds; reported times are scaled back to model time. A single call whose
+input exceeds --context-tokens is reported as not fitting.
+
+Usage (from Lambda/):
+    python benchmarks/bench_map_reduce.py --documents 1 5 20 80 --document-tokens 10000
+
+Prints one JSON line per document count.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import map_reduce  # noqa: E402
+
+
+class StubModel:
+    """
+    invoke(content_blocks, max_tokens) for map_reduce_summarize. Counts the
+    calls and the input and output tokens.
+    """
+
+    def __init__(self, overhead, input_ms, output_ms, time_scale):
+        self.overhead = overhead
+        self.input_ms = input_ms
+        self.output_ms = output_ms
+        self.time_scale = time_scale
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, blocks, max_tokens):
+        input_tokens = sum(map_reduce.estimate_tokens(block) for block in blocks)
+        output_tokens = min(max_tokens, max(1, input_tokens // 4))
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+        latency = self.overhead + (input_tokens * self.input_ms + output_tokens * self.output_ms) / 1000
+        time.sleep(latency * self.time_scale)
+        return "סיכום " * (output_tokens * map_reduce.CHARS_PER_TOKEN // 6)
+
+
+def make_sources(count, tokens):
+    sentence = "המטופל מדווח על כאבים בגב התחתון שהחמירו בשבוע האחרון. "
+    text = sentence * (tokens * map_reduce.CHARS_PER_TOKEN // len(sentence) + 1)
+    return [{"name": f"2401{index % 28 + 1:02d}-{index:04d}.json", "text": text} for index in range(count)]
+
+
+def run(args, count):
+    sources = make_sources(count, args.document_tokens)
+    stub = StubModel(args.overhead, args.input_ms, args.output_ms, args.time_scale)
+    started = time.perf_counter()
+    _, stats = map_reduce.map_reduce_summarize(
+        sources, stub, "סכם את תיק המטופל.", chunk_tokens=args.chunk_tokens,
+        max_tokens=args.max_tokens, max_workers=args.workers
+    )
+    map_reduce_seconds = (time.perf_counter() - started) / args.time_scale
+    result = {
+        "documents": count,
+        "inputTokens": sum(map_reduce.estimate_tokens({"text": source["text"]}) for source in sources),
+        "mapReduce": {"seconds": round(map_reduce_seconds, 1), "calls": stub.calls, "chunks": stats["chunks"],
+                      "reduceLevels": stats["reduce_levels"], "inputTokens": stub.input_tokens,
+                      "outputTokens": stub.output_tokens}
+    }
+
+    blocks = [block for _, chunk in map_reduce.build_chunks(sources, float("inf")) for block in chunk]
+    single_tokens = sum(map_reduce.estimate_tokens(block) for block in blocks)
+    if single_tokens > args.context_tokens:
+        result["singleCall"] = {"fits": False, "inputTokens": single_tokens}
+        return result
+    stub = StubModel(args.overhead, args.input_ms, args.output_ms, args.time_scale)
+    started = time.perf_counter()
+    stub(blocks, args.max_tokens)
+    result["singleCall"] = {"fits": True, "seconds": round((time.perf_counter() - started) / args.time_scale, 1),
+                            "inputTokens": stub.input_tokens, "outputTokens": stub.output_tokens}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, nargs="+", default=[1, 5, 20, 80])
+    parser.add_argument("--document-tokens", type=int, default=10000, help="tokens per transcript")
+    parser.add_argument("--chunk-tokens", type=int, default=map_reduce.DEFAULT_CHUNK_TOKENS)
+    parser.add_argument("--max-tokens", type=int, default=4096, help="tokens of the final summary")
+    parser.add_argument("--workers", type=int, default=map_reduce.MAX_MAP_WORKERS)
+    parser.add_argument("--context-tokens", type=int, default=200000, help="input limit of a single call")
+    parser.add_argument("--overhead", type=float, default=0.5, help="fixed seconds per call")
+    parser.add_argument("--input-ms", type=float, default=0.02, help="model milliseconds per input token")
+    parser.add_argument("--output-ms", type=float, default=15, help="model milliseconds per output token")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="fraction of the model time actually slept")
+    args = parser.parse_args()
+
+    for count in args.documents:
+        print(json.dumps(run(args, count)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark of segmented transcription against a local fake backend.
+
+Generates a synthetic recording (tone bursts separated by short silences),
+then transcribes it with transcribe_segmented at several segment sizes. The
+fake backend sleeps for a fixed job overhead plus a time proportional to the
+segment's audio duration, like a Transcribe job does, and returns one word per
+second with alternating speakers so the stitching step does real work.
+
+Usage (from Lambda/):
+    python benchmarks/bench_segmented_transcribe.py --duration 1800 --concurrency 8
+
+Prints one JSON line per run.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import segmented_transcribe  # noqa: E402
+
+
+def make_recording(path, duration, burst=20, gap=1):
+    """
+    Writes a mono recording of `duration` seconds: `burst` seconds of tone
+    followed by `gap` seconds of silence, repeated.
+    """
+    period = burst + gap
+    expression = f"if(lt(mod(t,{period}),{burst}),0.5*sin(2*PI*440*t),0)"
+    segmented_transcribe.run_ffmpeg([
+        "-y", "-f", "lavfi", "-i", f"aevalsrc='{expression}':s=16000:d={duration}",
+        "-ac", "1", "-c:a", "flac", path
+    ])
+
+
+def flac_duration(path):
+    """
+    Reads the duration of a FLAC file from its STREAMINFO block.
+    """
+    with open(path, "rb") as flac_file:
+        header = flac_file.read(42)
+    if header[:4] != b"fLaC":
+        raise ValueError(f"{path} is not a FLAC file")
+    info = int.from_bytes(header[18:26], "big")
+    sample_rate = info >> 44
+    total_samples = info & ((1 << 36) - 1)
+    return total_samples / sample_rate
+
+
+class FakeTranscribeBackend:
+    """
+    Stands in for TranscribeBackend. Latency is overhead + realtime_factor *
+    segment duration; the speaker changes every 20 seconds of the recording.
+    """
+
+    def __init__(self, overhead, realtime_factor):
+        self.overhead = overhead
+        self.realtime_factor = realtime_factor
+
+    def transcribe(self, job_name, segment_path):
+        duration = flac_duration(segment_path)
+        time.sleep(self.overhead + self.realtime_factor * duration)
+        items = []
+        for second in range(int(duration)):
+            items.append({
+                "type": "pronunciation",
+                "start_time": f"{second:.3f}",
+                "end_time": f"{second + 0.4:.3f}",
+                "alternatives": [{"confidence": "0.99", "content": f"w{second}"}],
+                "speaker_label": f"spk_{(second // 20) % 2}"
+            })
+        return {"jobName": job_name, "results": {"items": items}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=int, default=1800, help="recording length in seconds")
+    parser.add_argument("--overhead", type=float, default=0.5, help="fixed seconds per fake job")
+    parser.add_argument("--realtime-factor", type=float, default=0.01,
+                        help="fake job seconds per second of audio")
+    parser.add_argument("--concurrency", type=int, default=segmented_transcribe.SEGMENT_CONCURRENCY)
+    parser.add_argument("--segment-seconds", type=int, nargs="+", default=None,
+                        help="segment sizes to run (default: whole file, then 1/2, 1/4, ... of it)")
+    args = parser.parse_args()
+
+    segment_sizes = args.segment_seconds or [args.duration // count for count in (1, 2, 4, 8, 16)]
+    backend = FakeTranscribeBackend(args.overhead, args.realtime_factor)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        media_path = os.path.join(work_dir, "recording.flac")
+        make_recording(media_path, args.duration)
+
+        baseline = None
+        for segment_seconds in segment_sizes:
+            started = time.monotonic()
+            transcript, stats = segmented_transcribe.transcribe_segmented(
+                media_path,
+                backend,
+                "bench",
+                work_dir,
+                max_concurrency=args.concurrency,
+                target_seconds=segment_seconds
+            )
+            elapsed = time.monotonic() - started
+            baseline = baseline or elapsed
+            print(json.dumps({
+                "benchmark": "segmented_transcribe",
+                "duration_seconds": args.duration,
+                "segment_seconds": segment_seconds,
+                "segments": stats["segments"],
+                "concurrency": args.concurrency,
+                "elapsed_seconds": round(elapsed, 3),
+                "transcribe_seconds": round(stats["transcribe_ms"] / 1000, 3),
+                "speedup": round(baseline / elapsed, 2),
+                "words": len(transcript["results"]["items"])
+            }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Memory and latency of reading a Transcribe output JSON.
+
+Compares, on synthetic Transcribe outputs of increasing size:
+  - load: json.loads of the whole output (what fetch_transcript_from_s3 did),
+  - stream: iter_transcript_items + build_turns,
+  - turns: reading the stored .turns.jsonl file.
+
+Usage (from Lambda/):
+    python benchmarks/bench_transcript_turns.py --words 10000 50000 200000
+
+Prints one JSON line per (size, method).
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transcript_turns import build_turns, iter_transcript_items  # noqa: E402
+
+WORDS = ["המטופל", "מדווח", "על", "כאבים", "בגב", "התחתון", "מזה", "שבועיים", "ללא", "חום"]
+
+
+def write_transcribe_output(path, word_count, seed=0):
+    """
+    Writes a Transcribe output with speaker labels: word items with speaker
+    labels, punctuation, speaker_labels.segments and audio_segments.
+    """
+    rng = random.Random(seed)
+    items, segments, words = [], [], []
+    speaker, segment, start = 0, None, 0.0
+    for _ in range(word_count):
+        if rng.random() < 0.03:
+            speaker = 1 - speaker
+        content = rng.choice(WORDS)
+        label = f"spk_{speaker}"
+        times = {"start_time": f"{start:.3f}", "end_time": f"{start + 0.35:.3f}"}
+        items.append({"id": len(items), "type": "pronunciation",
+                      "alternatives": [{"confidence": "0.987", "content": content}],
+                      "speaker_label": label, **times})
+        if segment is None or segment["speaker_label"] != label:
+            segment = {"speaker_label": label, "start_time": times["start_time"], "items": []}
+            segments.append(segment)
+        segment["end_time"] = times["end_time"]
+        segment["items"].append({"speaker_label": label, **times})
+        words.append(content)
+        if rng.random() < 0.1:
+            items.append({"id": len(items), "type": "punctuation",
+                          "alternatives": [{"confidence": "0.0", "content": "."}]})
+        start += 0.45
+
+    output = {
+        "jobName": "benchmark",
+        "accountId": "000000000000",
+        "status": "COMPLETED",
+        "results": {
+            "transcripts": [{"transcript": " ".join(words)}],
+            "speaker_labels": {"channel_label": "ch_0", "speakers": 2, "segments": segments},
+            "items": items,
+            "audio_segments": [
+                {"id": index, "transcript": "", "start_time": s["start_time"], "end_time": s["end_time"],
+                 "speaker_label": s["speaker_label"], "items": []}
+                for index, s in enumerate(segments)
+            ]
+        }
+    }
+    with open(path, "w", encoding="utf-8") as output_file:
+        json.dump(output, output_file, ensure_ascii=False)
+
+
+def read_loaded(path):
+    with open(path, "rb") as transcript_file:
+        transcript_json = json.loads(transcript_file.read().decode("utf-8"))
+    return build_turns(transcript_json["results"]["items"])
+
+
+def read_streamed(path):
+    with open(path, "rb") as transcript_file:
+        return build_turns(iter_transcript_items(transcript_file))
+
+
+def read_turns_file(path):
+    with open(path, "rb") as turns_file:
+        return [json.loads(line) for line in turns_file if line.strip()]
+
+
+def measure(function, path, repeat):
+    """
+    Returns (result, best time, peak memory). Memory is traced in a separate
+    run, since tracing slows allocation-heavy code down several times.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(path)
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    function(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--words", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for word_count in args.words:
+            path = os.path.join(work_dir, f"{word_count}.json")
+            write_transcribe_output(path, word_count)
+            turns = read_streamed(path)
+            turns_path = path + ".turns.jsonl"
+            with open(turns_path, "w", encoding="utf-8") as turns_file:
+                for turn in turns:
+                    turns_file.write(json.dumps(turn, ensure_ascii=False) + "\n")
+
+            for method, function, source in (("load", read_loaded, path),
+                                             ("stream", read_streamed, path),
+                                             ("turns", read_turns_file, turns_path)):
+                result, seconds, peak = measure(function, source, args.repeat)
+                assert result == turns
+                print(json.dumps({
+                    "benchmark": "transcript_turns",
+                    "words": word_count,
+                    "method": method,
+                    "input_bytes": os.path.getsize(source),
+                    "turns": len(result),
+                    "seconds": round(seconds, 4),
+                    "peak_memory_bytes": peak
+                }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Local stand-ins for a bedrock-runtime client, for the benchmarks, the tests
+and session_pipeline.py's local runner. Not deployed with the handlers.
+"""
+import json
+import time
+import random
+import threading
+
+
+class FakeBedrockRuntime:
+    """
+    Local stand-in for a bedrock-runtime client. Every call waits latency
+    seconds (plus per_kb seconds per KB of request body); a throttle_rate
+    fraction of calls, and calls beyond `capacity` in flight, raise error_code
+    instead (with a Retry-After header when retry_after is set). Streamed
+    responses wait chunk_delay seconds before every chunk. Counts its calls,
+    errors and the most calls it saw in flight.
+    """
+
+    def __init__(self, latency=0.0, per_kb=0.0, throttle_rate=0.0, capacity=None,
+                 error_code="ThrottlingException", retry_after=None, seed=None, sleep=time.sleep,
+                 chunk_delay=0.0, text=None):
+        self.latency = latency
+        self.per_kb = per_kb
+        self.throttle_rate = throttle_rate
+        self.capacity = capacity
+        self.error_code = error_code
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.sleep = sleep
+        self.chunk_delay = chunk_delay
+        self.text = text or "סיכום: המטופל מדווח על כאבים בגב התחתון. " * 20
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.streams = []
+        self._lock = threading.Lock()
+
+    def _error(self, operation):
+        from botocore.exceptions import ClientError
+
+        headers = {} if self.retry_after is None else {"retry-after": str(self.retry_after)}
+        return ClientError({
+            "Error": {"Code": self.error_code, "Message": "Too many requests, please wait before trying again."},
+            "ResponseMetadata": {"HTTPStatusCode": 429, "HTTPHeaders": headers}
+        }, operation)
+
+    def _answer(self, operation, body):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            rejected = (self.capacity is not None and self.in_flight > self.capacity) \
+                or self.random.random() < self.throttle_rate
+            if rejected:
+                self.errors += 1
+                self.in_flight -= 1
+        if rejected:
+            raise self._error(operation)
+        try:
+            self.sleep(self.latency + self.per_kb * len(body) / 1024)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        usage = {"input_tokens": len(body) // 4, "output_tokens": 400}
+        return self.text, usage
+
+    def invoke_model(self, modelId, body, contentType=None, **kwargs):
+        text, usage = self._answer("InvokeModel", body)
+        result = {
+            "id": "msg_fake",
+            "type": "message",
+            "role": "assistant",
+            "model": modelId,
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": usage
+        }
+        return {"body": FakeStreamingBody(json.dumps(result).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, modelId, body, contentType=None, **kwargs):
+        text, usage = self._answer("InvokeModelWithResponseStream", body)
+        messages = [{"type": "message_start", "message": {"usage": {"input_tokens": usage["input_tokens"]}}}]
+        messages += [{"type": "content_block_delta", "delta": {"text": word + " "}} for word in text.split()]
+        messages.append({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                         "usage": {"output_tokens": usage["output_tokens"]}})
+        stream = FakeStreamingBody(
+            events=[{"chunk": {"bytes": json.dumps(message).encode("utf-8")}} for message in messages],
+            chunk_delay=self.chunk_delay,
+            sleep=self.sleep
+        )
+        self.streams.append(stream)
+        return {"body": stream}
+
+
+class FakeStreamingBody:
+    """
+    The body of a fake response: read() returns data (invoke_model), and
+    iterating yields the events (invoke_model_with_response_stream), waiting
+    chunk_delay seconds before each. chunks_read counts the events handed out.
+    """
+
+    def __init__(self, data=b"", events=(), chunk_delay=0.0, sleep=time.sleep):
+        self.data = data
+        self.events = list(events)
+        self.chunk_delay = chunk_delay
+        self.sleep = sleep
+        self.chunks_read = 0
+        self.closed = False
+
+    def read(self):
+        return self.data
+
+    def __iter__(self):
+        for event in self.events:
+            if self.closed:
+                return
+            if self.chunk_delay:
+                self.sleep(self.chunk_delay)
+            self.chunks_read += 1
+            yield event
+
+    def close(self):
+        self.closed = True
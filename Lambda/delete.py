@@ -1,99 +1,351 @@
 import json
-import boto3
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from aws_clients import BUCKET_NAME, get_lambda_client, get_s3_client
+from instrumentation import instrumented, record
+from patient_manifest import METADATA_SUFFIX, drop_manifest, forget_objects, load_manifest, split_key
+from search_index import index_objects
+from transcript_turns import turns_key
 
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET,DELETE,OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type,Authorization"
+}
+
+# Prefix deletes are pipelined: every page of up to 1000 keys is deleted with
+# one delete_objects call while the listing continues, with at most
+# DELETE_WORKERS calls in flight.
+DELETE_WORKERS = 8
+RETRYABLE_ERRORS = ("InternalError", "SlowDown", "ServiceUnavailable")
+MAX_RETRIES = 3
+
+# Deletes that do not finish within the invocation (minus this margin) are
+# handed off to a background job, tracked under JOBS_PREFIX.
+TIME_MARGIN_MS = 10000
+JOBS_PREFIX = "delete-jobs/"
+PROGRESS_INTERVAL = 5
+
+
+class PrefixDeleter:
+    """
+    Deletes everything under a set of prefixes. should_stop() is checked
+    before each page is listed; when it returns True no new pages are
+    started and the result is marked incomplete. on_progress(result) is
+    called after every deleted page.
+    """
+
+    def __init__(self, s3, bucket, workers=DELETE_WORKERS, should_stop=None, on_progress=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.workers = workers
+        self.should_stop = should_stop or (lambda: False)
+        self.on_progress = on_progress
+
+    def _delete_chunk(self, keys):
+        """
+        Deletes up to 1000 keys, retrying the keys that failed with a
+        transient error. Returns the per-key errors that remain.
+        """
+        failed = []
+        for attempt in range(MAX_RETRIES + 1):
+            response = self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+            retry = []
+            for error in response.get('Errors', []):
+                if error.get('Code') in RETRYABLE_ERRORS and attempt < MAX_RETRIES:
+                    retry.append(error['Key'])
+                else:
+                    failed.append({'Key': error['Key'], 'Code': error.get('Code'), 'Message': error.get('Message')})
+            if not retry:
+                break
+            keys = retry
+            time.sleep(0.2 * 2 ** attempt)
+        return failed
+
+    def delete_prefixes(self, prefixes):
+        """
+        Returns {"deleted", "errors": [{Key, Code, Message}], "complete"}.
+        """
+        result = {"deleted": 0, "errors": [], "complete": True}
+        paginator = self.s3.get_paginator('list_objects_v2')
+
+        def collect(done):
+            for future in done:
+                keys, failed = future.result()
+                result["deleted"] += len(keys) - len(failed)
+                result["errors"].extend(failed)
+                if self.on_progress:
+                    self.on_progress(result)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for prefix in prefixes:
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                    keys = [obj['Key'] for obj in page.get('Contents', [])]
+                    if keys:
+                        pending.add(executor.submit(lambda chunk: (chunk, self._delete_chunk(chunk)), keys))
+                    if len(pending) >= self.workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    if self.should_stop():
+                        result["complete"] = False
+                        break
+                if not result["complete"]:
+                    break
+            done, _ = wait(pending)
+            collect(done)
+        return result
+
+
+def response(status_code, body):
+    headers = dict(CORS_HEADERS)
+    if status_code < 300:
+        headers["Content-Type"] = "application/json"
+    return {"statusCode": status_code, "headers": headers, "body": json.dumps(body)}
+
+
+def job_key(job_id):
+    return f"{JOBS_PREFIX}{job_id}.json"
+
+
+def read_job(s3, job_id):
+    try:
+        record = s3.get_object(Bucket=BUCKET_NAME, Key=job_key(job_id))
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(record['Body'].read().decode('utf-8'))
+
+
+def write_job(s3, job):
+    job['updatedAt'] = int(time.time())
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=job_key(job['jobId']),
+        Body=json.dumps(job).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def start_background_job(s3, job, function_name):
+    """
+    Records the job and continues it in an asynchronous invocation of this
+    function. Deleting is idempotent, so the invocation simply lists the
+    prefixes again.
+    """
+    write_job(s3, job)
+    get_lambda_client().invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'run_delete', 'jobId': job['jobId']}).encode('utf-8')
+    )
+
+
+def out_of_time(context):
+    return lambda: context is not None and context.get_remaining_time_in_millis() < TIME_MARGIN_MS
+
+
+def derived_keys(s3, bucket, key):
+    """
+    Returns the keys derived from key, which are deleted with it: the ones
+    linked in its manifest entry (transcript, speaker turns, extracted audio),
+    the speaker turns of a transcript and the metadata sidecars of all of them. Rasterized
+    PDF pages live under <key>.pages/ and are deleted as a prefix.
+    """
+    keys = [key]
+    if key.endswith(".json"):
+        keys.append(turns_key(key))
+    patient_id, relative_key = split_key(key)
+    try:
+        manifest = load_manifest(s3, bucket, patient_id)
+    except Exception as e:
+        print("Could not read the manifest of patient:", patient_id, str(e))
+        manifest = None
+    if manifest:
+        derived = manifest["files"].get(relative_key, {}).get("derived", {})
+        keys.extend(f"id_{patient_id}/{derived_key}" for derived_key in derived.values())
+    keys.extend([value + METADATA_SUFFIX for value in keys])
+    return [value for value in dict.fromkeys(keys) if value != key]
+
+
+def drop_manifests(s3, prefixes):
+    """
+    Removes the manifests of deleted patient folders (id_<patient>/ prefixes).
+    """
+    for prefix in prefixes:
+        drop_manifest(s3, BUCKET_NAME, prefix[len("id_"):-1])
+
+
+def run_delete_job(s3, job_id, context):
+    """
+    Background part of a large delete. Hands off to a new invocation again if
+    this one runs out of time.
+    """
+    job = read_job(s3, job_id)
+    if job is None or job['status'] != 'IN_PROGRESS':
+        print("Delete job is not in progress:", job_id)
+        return {"statusCode": 200, "body": json.dumps({"jobId": job_id})}
+
+    deleted_before = job['deleted']
+    errors_before = job.get('errors', [])
+    last_write = [time.time()]
+
+    def on_progress(result):
+        if time.time() - last_write[0] >= PROGRESS_INTERVAL:
+            job.update(deleted=deleted_before + result['deleted'], errors=(errors_before + result['errors'])[:100])
+            write_job(s3, job)
+            last_write[0] = time.time()
+
+    deleter = PrefixDeleter(s3, BUCKET_NAME, should_stop=out_of_time(context), on_progress=on_progress)
+    result = deleter.delete_prefixes(job['prefixes'])
+    job.update(deleted=deleted_before + result['deleted'], errors=(errors_before + result['errors'])[:100])
+    job['failedCount'] = job.get('failedCount', 0) + len(result['errors'])
+
+    if not result['complete']:
+        job['invocations'] = job.get('invocations', 1) + 1
+        start_background_job(s3, job, context.function_name)
+    else:
+        job['status'] = 'FAILED' if job['failedCount'] else 'COMPLETED'
+        drop_manifests(s3, job['prefixes'])
+        write_job(s3, job)
+        print("Delete job finished:", job_id, job['status'], job['deleted'])
+    return {"statusCode": 200, "body": json.dumps({"jobId": job_id})}
+
+
+@instrumented("delete")
 def lambda_handler(event, context):
+    """
+    - DELETE ?patientId=&fileName=: deletes one file of a patient.
+    - DELETE ?patientId= or ?patientIds=1,2,3: deletes the whole folder of
+      each patient. Deletes that do not finish within this invocation (or
+      all of them, with async=true) continue in a background job and return
+      202 with its jobId.
+    - GET ?jobId=: progress of a background delete job.
+    """
     try:
         # --- CORS Preflight Handling ---
         if event.get('httpMethod', '') == 'OPTIONS':
             return {
                 "statusCode": 200,
-                "headers": {
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "DELETE,OPTIONS",
-                    "Access-Control-Allow-Headers": "Content-Type,Authorization"
-                },
+                "headers": CORS_HEADERS,
                 "body": ""
             }
-        
+
+        s3 = get_s3_client()
+
+        # --- Background delete job (asynchronous self-invocation) ---
+        if event.get('action') == 'run_delete':
+            return run_delete_job(s3, event['jobId'], context)
+
         # 1. Parse request parameters (from pathParameters or queryStringParameters)
         patient_id = None
         file_name = None
+        params = event.get('queryStringParameters') or {}
 
         if event.get('pathParameters'):
             patient_id = event['pathParameters'].get('patientId')
             file_name = event['pathParameters'].get('fileName')
 
-        if event.get('queryStringParameters'):
-            qs_params = event['queryStringParameters']
+        if params:
             if not patient_id:
-                patient_id = qs_params.get('patientId')
+                patient_id = params.get('patientId')
             if not file_name:
                 # support both "fileName" and "filename"
-                file_name = qs_params.get('fileName') or qs_params.get('filename')
+                file_name = params.get('fileName') or params.get('filename')
+
+        # --- Progress of a background delete ---
+        if event.get('httpMethod') == 'GET':
+            job = read_job(s3, params.get('jobId', '')) if params.get('jobId') else None
+            if job is None:
+                return response(404, {"message": "Unknown delete job"})
+            return response(200, job)
+
+        patient_ids = [patient_id] if patient_id else []
+        if params.get('patientIds'):
+            patient_ids.extend(value.strip() for value in params['patientIds'].split(',') if value.strip())
 
         # Ensure patient_id is provided
-        if not patient_id:
+        if not patient_ids:
             raise ValueError("Missing patientId")
+        if any('/' in value for value in patient_ids):
+            raise ValueError("Invalid patientId")
+
+        bucket = BUCKET_NAME
 
-        bucket = 'BUCKET_NAME'
-        # Specify the correct region for the S3 bucket
-        s3 = boto3.client('s3', region_name='BUCKET_REGION')
-        
         if file_name:
+            if len(patient_ids) > 1:
+                raise ValueError("fileName can only be used with a single patientId")
             # Delete a single file
-            s3_key = f"id_{patient_id}/{file_name}"
+            s3_key = f"id_{patient_ids[0]}/{file_name}"
             print("Request received: Deleting file/object with key:", s3_key)
-            response = s3.delete_object(
+            # Looked up first: the manifest entry goes away with the object.
+            derived = derived_keys(s3, bucket, s3_key)
+            delete_response = s3.delete_object(
                 Bucket=bucket,
                 Key=s3_key
             )
-            print("Delete response:", response)
-        else:
-            # Delete a directory recursively (all objects with the prefix id_{patient_id}/)
-            prefix = f"id_{patient_id}/"
-            print("Request received: Recursively deleting all objects with prefix:", prefix)
-            
-            paginator = s3.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-            
-            objects_to_delete = []
-            for page in pages:
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        objects_to_delete.append({'Key': obj['Key']})
-            
-            if objects_to_delete:
-                # S3 allows deleting up to 1000 objects per batch
-                for i in range(0, len(objects_to_delete), 1000):
-                    chunk = objects_to_delete[i:i+1000]
-                    delete_response = s3.delete_objects(
-                        Bucket=bucket,
-                        Delete={'Objects': chunk}
-                    )
-                    print(f"Deleted chunk ({i} to {i+len(chunk)}):", delete_response)
-            else:
-                print("No objects found with prefix:", prefix)
+            print("Delete response:", delete_response)
+            # Derived artifacts (sidecars, speaker turns, page rasters) go with their source.
+            deleter = PrefixDeleter(s3, bucket)
+            errors = deleter._delete_chunk(derived)
+            errors.extend(deleter.delete_prefixes([f"{s3_key}.pages/"])['errors'])
+            if errors:
+                print("Could not delete derived objects:", errors[:100])
+            deleted_keys = [s3_key] + derived
+            forget_objects(s3, bucket, deleted_keys)
+            # A deleted transcript or summary must not stay searchable. The
+            # file is already gone, so a failed index update is only logged.
+            try:
+                index_objects(s3, bucket, deleted_keys)
+            except Exception as e:
+                print("Could not update the search index:", str(e))
+            return response(200, {"message": "Delete operation completed successfully"})
 
-        # Return a success response with CORS headers
-        return {
-            "statusCode": 200,
-            "headers": {
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "DELETE,OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type,Authorization",
-                "Content-Type": "application/json"
-            },
-            "body": json.dumps({"message": "Delete operation completed successfully"})
+        # Delete directories recursively (all objects with the prefix id_{patient_id}/)
+        prefixes = [f"id_{value}/" for value in dict.fromkeys(patient_ids)]
+        print("Request received: Recursively deleting all objects with prefixes:", prefixes)
+        job = {
+            "jobId": uuid.uuid4().hex,
+            "prefixes": prefixes,
+            "status": "IN_PROGRESS",
+            "deleted": 0,
+            "errors": [],
+            "createdAt": int(time.time())
         }
 
+        if str(params.get('async', '')).lower() == 'true':
+            start_background_job(s3, job, context.function_name)
+            return response(202, {"message": "Delete started", "jobId": job['jobId'], "status": "IN_PROGRESS"})
+
+        result = PrefixDeleter(s3, bucket, should_stop=out_of_time(context)).delete_prefixes(prefixes)
+        print(f"Deleted {result['deleted']} objects ({len(result['errors'])} errors)")
+        record("DeletedObjects", result['deleted'])
+
+        if not result['complete']:
+            # Too large for one invocation: continue in the background.
+            job.update(deleted=result['deleted'], errors=result['errors'][:100], failedCount=len(result['errors']))
+            start_background_job(s3, job, context.function_name)
+            return response(202, {
+                "message": "Delete continues in the background",
+                "jobId": job['jobId'],
+                "status": "IN_PROGRESS",
+                "deleted": result['deleted']
+            })
+
+        drop_manifests(s3, prefixes)
+        if result['errors']:
+            return response(500, {
+                "message": f"{len(result['errors'])} objects could not be deleted",
+                "deleted": result['deleted'],
+                "errors": result['errors'][:100]
+            })
+
+        # Return a success response with CORS headers
+        return response(200, {"message": "Delete operation completed successfully", "deleted": result['deleted']})
+
     except Exception as e:
         print("Error:", str(e))
-        return {
-            "statusCode": 500,
-            "headers": {
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "DELETE,OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type,Authorization"
-            },
-            "body": json.dumps({"message": str(e)})
-        }
+        return response(500, {"message": str(e)})
@@ -0,0 +1,195 @@
+import re
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+from aws_clients import BUCKET_NAME, get_s3_client
+from audio_transcode import recording_kind
+from instrumentation import instrumented
+from patient_manifest import METADATA_SUFFIX, attach_metadata, load_manifest
+from pdf_ingest import MIN_TEXT_CHARS
+from segmented_transcribe import run_ffmpeg
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Ingestion stage: extracts the metadata of every document and recording
+# uploaded to a patient folder once, so listings can show page counts and
+# durations without anyone downloading the files:
+#   PDFs:       {"pageCount", "textPages", "hasTextLayer"}
+#   recordings: {"duration", "audioCodec", "audioChannels", "sampleRate", "videoCodec"?}
+# plus {"size", "contentType", "sourceEtag"} for both. It is stored in the
+# sidecar <key>.meta and in the file's manifest entry (patient_manifest.py).
+PROBE_URL_EXPIRES = 300
+BACKFILL_WORKERS = 4
+CHANNEL_LAYOUTS = {"mono": 1, "stereo": 2, "quad": 4}
+
+
+def is_document(file_name, content_type=""):
+    return file_name.lower().endswith(".pdf") or (content_type or "").startswith("application/pdf")
+
+
+def pdf_metadata(pdf_bytes, min_text_chars=MIN_TEXT_CHARS):
+    """
+    Counts the pages of a PDF and the pages with a text layer (pages with
+    less text are scanned images, as in pdf_ingest).
+    """
+    import pymupdf  # provided by the Lambda layer
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as document:
+        text_pages = sum(1 for page in document if len(page.get_text("text").strip()) >= min_text_chars)
+        return {"pageCount": document.page_count, "textPages": text_pages, "hasTextLayer": text_pages > 0}
+
+
+def channel_count(layout):
+    layout = layout.strip()
+    if layout in CHANNEL_LAYOUTS:
+        return CHANNEL_LAYOUTS[layout]
+    match = re.match(r"(\d+) channels", layout) or re.match(r"(\d+)\.(\d+)", layout)
+    if not match:
+        return None
+    return sum(int(group) for group in match.groups())
+
+
+def parse_media_info(output):
+    """
+    Reads duration and stream details from the input description ffmpeg prints.
+    """
+    output = output.split("Stream mapping:")[0]
+    metadata = {}
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if match:
+        metadata["duration"] = round(int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3)), 2)
+    audio = re.search(r"Stream #0:\d+.*?: Audio: (\w+)[^,]*, (\d+) Hz, ([^,]+)", output)
+    if audio:
+        metadata.update(
+            audioCodec=audio.group(1),
+            sampleRate=int(audio.group(2)),
+            audioChannels=channel_count(audio.group(3))
+        )
+    video = re.search(r"Stream #0:\d+.*?: Video: (\w+)", output)
+    if video:
+        metadata["videoCodec"] = video.group(1)
+    return metadata
+
+
+def media_metadata(source):
+    """
+    Probes a recording (a local path or URL). Only the container headers are
+    read: ffmpeg stops before decoding anything.
+    """
+    return parse_media_info(run_ffmpeg(["-i", source, "-map", "0:a:0?", "-t", "0", "-f", "null", "-"]))
+
+
+def extract_metadata(s3_client, bucket, key, head):
+    """
+    Returns the metadata of the object at key (as of head), or None for files
+    that are neither PDFs nor recordings.
+    """
+    file_name = key.split("/")[-1]
+    content_type = head.get("ContentType", "")
+    if is_document(file_name, content_type):
+        pdf_bytes = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=head["ETag"])["Body"].read()
+        details = pdf_metadata(pdf_bytes)
+    elif recording_kind(file_name, content_type) is not None:
+        # ffmpeg reads the headers through a presigned URL with range
+        # requests instead of downloading the whole recording.
+        url = s3_client.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=PROBE_URL_EXPIRES
+        )
+        details = media_metadata(url)
+    else:
+        return None
+    return dict(details, size=head["ContentLength"], contentType=content_type, sourceEtag=head["ETag"].strip('"'))
+
+
+def process_object(s3_client, bucket, key):
+    """
+    Extracts and stores the metadata of id_<patient>/<file>, unless its
+    sidecar is already up to date. Returns the metadata, or None.
+    """
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    try:
+        sidecar = s3_client.get_object(Bucket=bucket, Key=key + METADATA_SUFFIX)
+        metadata = json.loads(sidecar["Body"].read().decode("utf-8"))
+        if metadata.get("sourceEtag") != head["ETag"].strip('"'):
+            metadata = None
+    except s3_client.exceptions.NoSuchKey:
+        metadata = None
+
+    if metadata is None:
+        metadata = extract_metadata(s3_client, bucket, key, head)
+        if metadata is None:
+            return None
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key + METADATA_SUFFIX,
+            Body=json.dumps(metadata).encode("utf-8"),
+            ContentType="application/json"
+        )
+        logger.info("Extracted metadata of %s: %s", key, metadata)
+    attach_metadata(s3_client, bucket, key, head, metadata)
+    return metadata
+
+
+def ingest_keys(event):
+    """
+    Returns the object keys of S3 ObjectCreated notifications or EventBridge
+    "Object Created" events.
+    """
+    if event.get("source") == "aws.s3":
+        return [event["detail"]["object"]["key"]]
+    return [unquote_plus(record["s3"]["object"]["key"]) for record in event.get("Records", [])]
+
+
+def backfill_patient(s3_client, patient_id):
+    """
+    Extracts the metadata of every file of a patient that has none yet.
+    """
+    manifest = load_manifest(s3_client, BUCKET_NAME, patient_id)
+    keys = [
+        f"id_{patient_id}/{relative_key}"
+        for relative_key, entry in manifest["files"].items()
+        if "/" not in relative_key and "metadata" not in entry
+        and (is_document(relative_key) or recording_kind(relative_key) is not None)
+    ]
+
+    def process(key):
+        try:
+            return key, process_object(s3_client, BUCKET_NAME, key) is not None
+        except Exception:
+            logger.exception("Could not extract metadata of %s", key)
+            return key, False
+
+    with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as executor:
+        return [key for key, done in executor.map(process, keys) if done]
+
+
+@instrumented("file_metadata")
+def lambda_handler(event, context):
+    """
+    - S3 ObjectCreated events (notifications or EventBridge) for files in a
+      patient folder (id_<patient>/<name>.pdf|.mp4|.mp3|...): extracts and
+      stores their metadata.
+    - {"patientId"}: extracts the metadata of the patient's files that have
+      none yet, e.g. for files uploaded before this stage existed.
+    """
+    s3_client = get_s3_client()
+    if event.get("patientId"):
+        extracted = backfill_patient(s3_client, str(event["patientId"]))
+        return {"statusCode": 200, "body": json.dumps({"extracted": extracted})}
+
+    extracted = []
+    for key in ingest_keys(event):
+        parts = key.split("/")
+        if len(parts) != 2 or not parts[0].startswith("id_") or parts[1].endswith(METADATA_SUFFIX):
+            continue
+        try:
+            if process_object(s3_client, BUCKET_NAME, key) is not None:
+                extracted.append(key)
+        except Exception:
+            logger.exception("Could not extract metadata of %s", key)
+    return {"statusCode": 200, "body": json.dumps({"extracted": extracted})}
@@ -0,0 +1,210 @@
+import io
+import os
+import re
+import base64
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+# Pixel and byte budget per image. Claude downsamples anything with a long edge
+# above ~1568px anyway, so larger images only cost upload time.
+MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1568"))
+MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(600 * 1024)))
+JPEG_QUALITIES = (85, 75, 65, 50)
+
+# Only byte-identical images are dropped as duplicates by default. Setting
+# IMAGE_NEAR_DUPLICATE_THRESHOLD (e.g. 0.05) also drops pages whose difference
+# hashes differ in at most that fraction of bits (documents scanned twice);
+# similar-looking forms with different handwritten values can then be lost. The
+# hash is computed on a 32x32 grid: coarser grids cannot tell dense text pages
+# apart.
+HASH_SIZE = 32
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("IMAGE_NEAR_DUPLICATE_THRESHOLD") or 0) or None
+
+# The text block right before an image that only labels it ("[scan.pdf - page 3]"
+# from pdf_ingest.py, or "Image 3") is dropped together with the image.
+IMAGE_LABEL = re.compile(r"\s*(\[[^\]\n]*\]|Image \d+:?)\s*")
+
+# A page is blank when fewer than this fraction of its pixels carry ink.
+BLANK_INK_FRACTION = 0.001
+INK_THRESHOLD = 230
+
+
+def difference_hash(image, size=HASH_SIZE):
+    """
+    Perceptual difference hash (size * size bits) of a PIL image.
+    """
+    pixels = image.convert("L").resize((size + 1, size)).tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def is_blank(image):
+    thumbnail = image.convert("L").resize((256, 256))
+    histogram = thumbnail.histogram()
+    ink = sum(histogram[:INK_THRESHOLD])
+    return ink < BLANK_INK_FRACTION * 256 * 256
+
+
+def is_image_label(block):
+    return block.get("type") == "text" and IMAGE_LABEL.fullmatch(block.get("text", "")) is not None
+
+
+def fit_to_budget(image, raw_size, max_edge=MAX_EDGE, max_bytes=MAX_BYTES):
+    """
+    Downscales the image to max_edge and re-encodes it as JPEG until it fits
+    max_bytes. Returns (data, media_type), or None when the original should be
+    kept (it already fits both budgets, or re-encoding would not make it smaller).
+    """
+    if max(image.size) <= max_edge and raw_size <= max_bytes:
+        return None
+
+    if max(image.size) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    data = None
+    for quality in JPEG_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        data = buffer.getvalue()
+        if len(data) <= max_bytes:
+            break
+    if len(data) >= raw_size:
+        # Re-encoding did not help (e.g. a small PNG of clean text); keep the original
+        return None
+    return data, "image/jpeg"
+
+
+class ImagePreprocessor:
+    """
+    Prepares the image blocks of a Bedrock request: drops blank pages and exact
+    duplicates (and near-duplicates when near_duplicate_threshold is set), and
+    downscales/re-encodes the rest to the pixel and byte budget. Keeps
+    per-request statistics in .stats.
+    """
+
+    def __init__(self, max_edge=MAX_EDGE, max_bytes=MAX_BYTES, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.max_edge = max_edge
+        self.max_bytes = max_bytes
+        self.near_duplicate_distance = None if near_duplicate_threshold is None \
+            else int(near_duplicate_threshold * HASH_SIZE * HASH_SIZE)
+        self._digests = set()
+        self._hashes = []
+        self._pillow = None
+        self.stats = {
+            "images_in": 0,
+            "images_out": 0,
+            "dropped_duplicate": 0,
+            "dropped_near_duplicate": 0,
+            "dropped_blank": 0,
+            "resized": 0,
+            "bytes_in": 0,
+            "bytes_out": 0
+        }
+
+    def process_block(self, block):
+        """
+        Returns the (possibly re-encoded) image block, or None if it was dropped.
+        """
+        source = block["source"]
+        try:
+            raw = base64.b64decode(source["data"])
+        except (ValueError, TypeError):
+            logger.warning("Could not decode image; sending it unchanged.")
+            return block
+        self.stats["images_in"] += 1
+        self.stats["bytes_in"] += len(raw)
+
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest in self._digests:
+            self.stats["dropped_duplicate"] += 1
+            return None
+        self._digests.add(digest)
+
+        from PIL import Image  # Pillow, provided by the Lambda layer
+
+        try:
+            image = Image.open(io.BytesIO(raw))
+            image.load()
+        except Exception:
+            logger.warning("Could not open image; sending it unchanged.", exc_info=True)
+            self.stats["images_out"] += 1
+            self.stats["bytes_out"] += len(raw)
+            return block
+
+        if is_blank(image):
+            self.stats["dropped_blank"] += 1
+            return None
+
+        if self.near_duplicate_distance is not None:
+            image_hash = difference_hash(image)
+            if any(bin(image_hash ^ seen).count("1") <= self.near_duplicate_distance for seen in self._hashes):
+                self.stats["dropped_near_duplicate"] += 1
+                return None
+            self._hashes.append(image_hash)
+
+        fitted = fit_to_budget(image, len(raw), self.max_edge, self.max_bytes)
+        if fitted is None:
+            self.stats["images_out"] += 1
+            self.stats["bytes_out"] += len(raw)
+            return block
+
+        data, media_type = fitted
+        self.stats["resized"] += 1
+        self.stats["images_out"] += 1
+        self.stats["bytes_out"] += len(data)
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": base64.b64encode(data).decode("ascii")
+            }
+        }
+
+    def has_pillow(self):
+        """
+        Checks once whether Pillow can be imported.
+        """
+        if self._pillow is None:
+            try:
+                from PIL import Image  # noqa: F401 (provided by the Lambda layer)
+                self._pillow = True
+            except ImportError:
+                logger.warning("Pillow is not available; skipping image preprocessing.")
+                self._pillow = False
+        return self._pillow
+
+    def process_blocks(self, blocks):
+        """
+        Runs every image block through process_block, keeping text blocks as-is.
+        Images that cannot be decoded are passed through unchanged. A dropped
+        image takes its label block (IMAGE_LABEL, right before it) with it.
+        Without Pillow the blocks are returned unchanged and not counted.
+        """
+        if not any(block.get("type") == "image" for block in blocks) or not self.has_pillow():
+            return blocks
+        processed = []
+        for block in blocks:
+            if block.get("type") == "image":
+                block = self.process_block(block)
+                if block is None and processed and is_image_label(processed[-1]):
+                    processed.pop()
+            if block is not None:
+                processed.append(block)
+        return processed
+
+    def report(self):
+        stats = dict(self.stats)
+        stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+        stats["images_saved"] = stats["images_in"] - stats["images_out"]
+        return stats
@@ -0,0 +1,231 @@
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from map_reduce import CHARS_PER_TOKEN, DEFAULT_CHUNK_TOKENS, build_chunks, estimate_tokens, map_reduce_summarize
+from patient_manifest import CONFLICT_ERRORS, record_objects
+from pdf_ingest import page_blocks, patient_pdf_key, pdf_documents
+from transcript_turns import load_turns, turns_text
+
+logger = logging.getLogger()
+
+# Incremental history summaries: the running summary of a patient and a
+# ledger of the sources it already incorporates ({relative key: ETag}) are
+# kept in id_<patient>/output/Summary/history.ledger (not .json, so transcript
+# listings never pick it up). A request only sends the new or changed sources
+# to the model, together with the previous summary. The summary is rebuilt
+# from all of its sources on request, when the instructions or the model
+# changed, or when one of its sources was deleted (its content cannot be
+# taken out of the summary).
+LEDGER_NAME = "output/Summary/history.ledger"
+LEDGER_VERSION = 1
+HEAD_WORKERS = 16
+MAX_HISTORY = 20
+
+DEFAULT_UPDATE_PROMPT = (
+    "לפניך סיכום הרקע הקיים של המטופל, ואחריו מסמכים ותמלולים חדשים או מעודכנים. "
+    "עדכן את הסיכום כך שישלב את המידע החדש במקומו הכרונולוגי, בלי להשמיט מידע "
+    "מהסיכום הקיים, והחזר את הסיכום המלא המעודכן באותו מבנה."
+)
+CHANGED_SOURCES_NOTE = "המקורות הבאים עודכנו, ותוכנם מחליף את הגרסה הקודמת שלהם בסיכום: "
+
+
+def ledger_key(patient_id):
+    return f"id_{patient_id}/{LEDGER_NAME}"
+
+
+def instructions_digest(model_id, system_instructions, prompt):
+    """
+    Identifies what a summary was generated with; a summary made with other
+    instructions is rebuilt rather than updated.
+    """
+    text = json.dumps([model_id, system_instructions, prompt], ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def read_ledger(s3_client, bucket, patient_id):
+    """
+    Returns (ledger, etag); both are None if the patient has no ledger yet. A
+    ledger of an older version is returned as None with its etag.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=ledger_key(patient_id))
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    ledger = json.loads(response["Body"].read().decode("utf-8"))
+    if ledger.get("version") != LEDGER_VERSION:
+        return None, response["ETag"]
+    return ledger, response["ETag"]
+
+
+def write_ledger(s3_client, bucket, patient_id, ledger, etag):
+    """
+    Writes the ledger if it is still at etag (or still missing, when etag is
+    None). Returns False if a concurrent request updated it first.
+    """
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=ledger_key(patient_id),
+            Body=json.dumps(ledger, ensure_ascii=False).encode("utf-8"),
+            ContentType="application/json",
+            **condition
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in CONFLICT_ERRORS:
+            return False
+        raise
+    record_objects(s3_client, bucket, [ledger_key(patient_id)])
+    return True
+
+
+def current_etags(s3_client, bucket, patient_id, relative_keys):
+    """
+    Returns {relative key: ETag} of the keys that exist.
+    """
+    def head(relative_key):
+        try:
+            response = s3_client.head_object(Bucket=bucket, Key=f"id_{patient_id}/{relative_key}")
+        except s3_client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return relative_key, None
+            raise
+        return relative_key, response["ETag"].strip('"')
+
+    with ThreadPoolExecutor(max_workers=min(HEAD_WORKERS, len(relative_keys) or 1)) as executor:
+        return {key: etag for key, etag in executor.map(head, relative_keys) if etag is not None}
+
+
+def load_sources(s3_client, bucket, patient_id, relative_keys, preprocessor=None):
+    """
+    Reads PDFs (text layers and scanned pages) and transcripts (speaker
+    turns) into map_reduce sources, in chronological (file name) order.
+    """
+    pdf_keys = [key for key in relative_keys if key.lower().endswith(".pdf")]
+    transcript_keys = [key for key in relative_keys if key.lower().endswith(".json")]
+    unsupported = sorted(set(relative_keys) - set(pdf_keys) - set(transcript_keys))
+    if unsupported:
+        raise ValueError(f"Only PDFs and transcripts can be summarized: {', '.join(unsupported)}")
+
+    sources = []
+    if pdf_keys:
+        for file_name, pages in pdf_documents(s3_client, bucket, patient_id, pdf_keys):
+            blocks = [page_blocks(file_name, page) for page in pages]
+            if preprocessor:
+                blocks = [preprocessor.process_blocks(page) for page in blocks]
+            sources.append({"name": file_name, "pages": blocks})
+
+    def transcript(relative_key):
+        turns = load_turns(s3_client, bucket, f"id_{patient_id}/{relative_key}")
+        return {"name": relative_key.split("/")[-1], "text": turns_text(turns)}
+
+    with ThreadPoolExecutor(max_workers=min(HEAD_WORKERS, len(transcript_keys) or 1)) as executor:
+        sources.extend(executor.map(transcript, transcript_keys))
+    return sorted(sources, key=lambda source: source["name"])
+
+
+def summarize_sources(sources, invoke, prompt, max_tokens, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    """
+    Summarizes sources with one model call when they fit the chunk budget,
+    with map_reduce_summarize otherwise. Returns (summary, stats).
+    """
+    chunks = build_chunks(sources, chunk_tokens)
+    blocks = [block for _, chunk_blocks in chunks for block in chunk_blocks]
+    if sum(estimate_tokens(block) for block in blocks) <= chunk_tokens:
+        return invoke([{"type": "text", "text": prompt}] + blocks, max_tokens), {"chunks": len(chunks), "calls": 1}
+    summary, stats = map_reduce_summarize(sources, invoke, reduce_prompt=prompt, chunk_tokens=chunk_tokens, max_tokens=max_tokens)
+    return summary, stats
+
+
+def update_summary(previous, sources, changed_names, invoke, prompt, max_tokens,
+                   update_prompt=DEFAULT_UPDATE_PROMPT, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    """
+    Folds new and changed sources into the previous summary. Sources too
+    large for one call are first condensed with map_reduce_summarize.
+    Returns (summary, stats).
+    """
+    text = f"{prompt.rstrip()}\n\n{update_prompt}\n\n[סיכום קיים]\n{previous}"
+    if changed_names:
+        text += "\n\n" + CHANGED_SOURCES_NOTE + ", ".join(changed_names)
+    chunks = build_chunks(sources, chunk_tokens)
+    blocks = [block for _, chunk_blocks in chunks for block in chunk_blocks]
+    stats = {"chunks": len(chunks), "calls": 1}
+    if sum(estimate_tokens(block) for block in blocks) + len(text) // CHARS_PER_TOKEN > chunk_tokens:
+        condensed, stats = map_reduce_summarize(sources, invoke, reduce_prompt=prompt, chunk_tokens=chunk_tokens)
+        blocks = [{"type": "text", "text": condensed}]
+    header = [{"type": "text", "text": text}, {"type": "text", "text": "[מקורות חדשים]"}]
+    return invoke(header + blocks, max_tokens), stats
+
+
+def incremental_summary(s3_client, bucket, patient_id, keys, invoke, model_id, system_instructions,
+                        prompt, max_tokens, rebuild=False, preprocessor=None):
+    """
+    Brings the patient's running summary up to date with keys (PDFs and
+    transcripts in the patient folder, added to the sources already in the
+    ledger). invoke(content_blocks, max_tokens) returns the model's text.
+    Returns (summary, info), info describing what was done:
+      {"mode": "unchanged" | "update" | "rebuild", "reason"?, "added",
+       "changed", "sources", "stored"}
+    """
+    requested = [patient_pdf_key(patient_id, key)[len(f"id_{patient_id}/"):] for key in keys]
+    ledger, ledger_etag = read_ledger(s3_client, bucket, patient_id)
+    known = (ledger or {}).get("sources", {})
+    wanted = list(dict.fromkeys(list(known) + requested))
+    if not wanted:
+        raise ValueError("No sources to summarize.")
+
+    etags = current_etags(s3_client, bucket, patient_id, wanted)
+    missing = [key for key in requested if key not in etags]
+    if missing:
+        raise ValueError(f"Files not found: {', '.join(missing)}")
+    deleted = [key for key in known if key not in etags]
+    added = [key for key in wanted if key not in known]
+    changed = [key for key in known if key in etags and etags[key] != known[key]]
+    digest = instructions_digest(model_id, system_instructions, prompt)
+
+    reason = None
+    if rebuild:
+        reason = "requested"
+    elif ledger is None:
+        reason = "no previous summary"
+    elif ledger.get("instructions") != digest:
+        reason = "instructions changed"
+    elif deleted:
+        reason = "sources deleted"
+
+    info = {"added": added, "changed": changed, "deleted": deleted}
+    if reason is None and not added and not changed:
+        info.update(mode="unchanged", sources=len(known), stored=True)
+        return ledger["summary"], info
+
+    if reason is not None:
+        sources = load_sources(s3_client, bucket, patient_id, list(etags), preprocessor)
+        summary, stats = summarize_sources(sources, invoke, prompt, max_tokens)
+        info.update(mode="rebuild", reason=reason)
+    else:
+        delta = added + changed
+        sources = load_sources(s3_client, bucket, patient_id, delta, preprocessor)
+        changed_names = [key.split("/")[-1] for key in changed]
+        summary, stats = update_summary(ledger["summary"], sources, changed_names, invoke, prompt, max_tokens)
+        info.update(mode="update")
+    logger.info("Incremental summary of patient %s: %s (%s)", patient_id, info["mode"], stats)
+
+    history = (ledger or {}).get("history", [])
+    history.append({"at": int(time.time()), "mode": info["mode"], "added": len(added), "changed": len(changed)})
+    new_ledger = {
+        "version": LEDGER_VERSION,
+        "patientId": patient_id,
+        "instructions": digest,
+        "model": model_id,
+        "summary": summary,
+        "sources": etags,
+        "updatedAt": int(time.time()),
+        "history": history[-MAX_HISTORY:]
+    }
+    info.update(sources=len(etags), stats=stats)
+    info["stored"] = write_ledger(s3_client, bucket, patient_id, new_ledger, ledger_etag)
+    if not info["stored"]:
+        logger.warning("The summary ledger of patient %s was updated concurrently; not storing this summary", patient_id)
+    return summary, info
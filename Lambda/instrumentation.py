@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger()
+
+# Shared instrumentation for the handlers:
+#   - log_event(): structured JSON log lines, redacted and bounded in size,
+#     with detail=True lines kept only for a sample of invocations;
+#   - stage() / record(): per-stage timings and counters, plus the latency of
+#     every AWS API call made through aws_clients (S3, Transcribe, Bedrock),
+#     emitted once per invocation as a CloudWatch embedded metric format (EMF)
+#     record on stdout.
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "PatientApp")
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() != "false"
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.05"))
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", "2000"))
+LOG_MAX_STRING = 200
+LOG_MAX_ITEMS = 20
+
+# Values of these keys are patient data (documents, transcripts, prompts,
+# file contents) and are replaced by their size; patient IDs are hashed.
+REDACTED_KEYS = {
+    "data", "file", "text", "transcript", "transcripts", "prompt", "system_instructions",
+    "content", "result", "bytes", "body", "summary"
+}
+HASHED_KEYS = {"patientid", "patient_id", "id", "ids", "patientids"}
+SECRET_PATTERN = re.compile(r"(X-Amz-Signature|X-Amz-Security-Token|X-Amz-Credential)=[^&\s\"]+")
+
+# The invocation of the handler running in this thread (bedrock_stream.py
+# serves concurrent requests from threads of one process). Threads without one,
+# such as ThreadPoolExecutor workers started by a handler, report to the only
+# active invocation; with several active, their timings are dropped rather
+# than credited to the wrong one.
+_current = ContextVar("instrumentation_invocation", default=None)
+_active = set()
+_active_lock = threading.Lock()
+
+
+def hash_value(value):
+    return "h:" + hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:10]
+
+
+def redact(value, key=None, depth=0):
+    """
+    Returns a copy of value that is safe and cheap to log: patient data is
+    replaced by its size, patient IDs are hashed, presigned URL credentials
+    are removed and long strings and collections are truncated.
+    """
+    normalized_key = (key or "").lower().replace("-", "_")
+    if normalized_key in HASHED_KEYS and value is not None:
+        if isinstance(value, (list, tuple)):
+            return [hash_value(item) for item in value[:LOG_MAX_ITEMS]]
+        return hash_value(value)
+    if normalized_key in REDACTED_KEYS and value not in (None, "", [], {}):
+        size = len(value) if isinstance(value, (str, bytes, list, dict)) else 1
+        return f"<redacted {type(value).__name__} of {size}>"
+    if isinstance(value, dict):
+        if depth >= 4:
+            return f"<dict of {len(value)}>"
+        items = list(value.items())
+        result = {str(k): redact(v, str(k), depth + 1) for k, v in items[:LOG_MAX_ITEMS]}
+        if len(items) > LOG_MAX_ITEMS:
+            result["..."] = f"+{len(items) - LOG_MAX_ITEMS} keys"
+        return result
+    if isinstance(value, (list, tuple)):
+        if depth >= 4:
+            return f"<list of {len(value)}>"
+        result = [redact(item, key, depth + 1) for item in value[:LOG_MAX_ITEMS]]
+        if len(value) > LOG_MAX_ITEMS:
+            result.append(f"+{len(value) - LOG_MAX_ITEMS} items")
+        return result
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str):
+        value = SECRET_PATTERN.sub(r"\1=<redacted>", value)
+        if len(value) > LOG_MAX_STRING:
+            return value[:LOG_MAX_STRING] + f"...(+{len(value) - LOG_MAX_STRING} chars)"
+    return value
+
+
+def request_summary(event):
+    """
+    A redacted description of an API Gateway or direct event.
+    """
+    body = event.get("body")
+    summary = {
+        "method": event.get("httpMethod"),
+        "path": event.get("path"),
+        "query": event.get("queryStringParameters"),
+        "bodyBytes": len(body) if isinstance(body, str) else None
+    }
+    if isinstance(body, str) and len(body) <= LOG_MAX_CHARS:
+        try:
+            summary["params"] = json.loads(body)
+        except ValueError:
+            pass
+    for key in ("action", "source", "detail-type"):
+        if key in event:
+            summary[key] = event[key]
+    if "Records" in event:
+        summary["records"] = len(event["Records"])
+    return summary
+
+
+class Invocation:
+    """
+    Timings and counters of one handler invocation.
+    """
+
+    def __init__(self, function, sampled):
+        self.function = function
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add_timing(self, name, milliseconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(round(milliseconds, 2))
+
+    def add_value(self, name, value, unit):
+        with self.lock:
+            total, _ = self.values.get(name, (0, unit))
+            self.values[name] = (total + value, unit)
+
+    def emf_record(self, status):
+        metrics = [{"Name": "Duration", "Unit": "Milliseconds"}]
+        record = {"Function": self.function, "Status": str(status), "sampled": self.sampled}
+        record["Duration"] = round((time.perf_counter() - self.started) * 1000, 2)
+        for name, values in self.timings.items():
+            metrics.append({"Name": f"{name}.ms", "Unit": "Milliseconds"})
+            record[f"{name}.ms"] = values if len(values) > 1 else values[0]
+            metrics.append({"Name": f"{name}.count", "Unit": "Count"})
+            record[f"{name}.count"] = len(values)
+        for name, (value, unit) in self.values.items():
+            metrics.append({"Name": name, "Unit": unit})
+            record[name] = value
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["Function"]],
+                "Metrics": metrics[:100]
+            }]
+        }
+        return record
+
+
+def current_invocation():
+    invocation = _current.get()
+    if invocation is None:
+        with _active_lock:
+            if len(_active) == 1:
+                invocation = next(iter(_active))
+    return invocation
+
+
+def is_sampled():
+    invocation = current_invocation()
+    return invocation is not None and invocation.sampled
+
+
+def log_event(message, level=logging.INFO, detail=False, **fields):
+    """
+    Logs one JSON line with the redacted fields, at most LOG_MAX_CHARS long.
+    detail=True lines are only written for sampled invocations.
+    """
+    if detail and not is_sampled():
+        return
+    if not logger.isEnabledFor(level):
+        return
+    line = json.dumps(dict(message=message, **redact(fields)), ensure_ascii=False, default=str)
+    if len(line) > LOG_MAX_CHARS:
+        line = line[:LOG_MAX_CHARS] + f"...(+{len(line) - LOG_MAX_CHARS} chars)"
+    logger.log(level, line)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a block as the stage name of the current invocation.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        invocation = current_invocation()
+        if invocation is not None:
+            invocation.add_timing(name, (time.perf_counter() - started) * 1000)
+
+
+def record(name, value, unit="Count"):
+    """
+    Adds value to the counter name ("Bytes", "Count", ...) of the current invocation.
+    """
+    invocation = current_invocation()
+    if invocation is not None and value is not None:
+        invocation.add_value(name, value, unit)
+
+
+def _before_call(model, context, **kwargs):
+    context["instrumentation_started"] = time.perf_counter()
+
+
+def _after_call(model, context, **kwargs):
+    started = context.get("instrumentation_started")
+    invocation = current_invocation()
+    if started is not None and invocation is not None:
+        service = model.service_model.service_id.hyphenize()
+        invocation.add_timing(f"{service}.{model.name}", (time.perf_counter() - started) * 1000)
+
+
+def instrument_client(client):
+    """
+    Times every API call of a boto3 client as a stage (e.g. "s3.HeadObject").
+    """
+    client.meta.events.register("before-call.*.*", _before_call)
+    client.meta.events.register("after-call.*.*", _after_call)
+    return client
+
+
+def instrumented(function_name):
+    """
+    Decorator for lambda_handler: collects the stage timings of each
+    invocation and emits them as one EMF record. A sample of invocations
+    (LOG_SAMPLE_RATE) also logs a redacted summary of the request.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            invocation = Invocation(function_name, random.random() < LOG_SAMPLE_RATE)
+            token = _current.set(invocation)
+            with _active_lock:
+                _active.add(invocation)
+            status = "error"
+            try:
+                log_event("request", detail=True, request=request_summary(event if isinstance(event, dict) else {}))
+                response = handler(event, context)
+                status = response.get("statusCode", 200) if isinstance(response, dict) else 200
+                return response
+            finally:
+                _current.reset(token)
+                with _active_lock:
+                    _active.discard(invocation)
+                if METRICS_ENABLED:
+                    # EMF records are picked up from stdout by CloudWatch Logs.
+                    sys.stdout.write(json.dumps(invocation.emf_record(status)) + "\n")
+                    sys.stdout.flush()
+        return wrapper
+    return decorator
@@ -0,0 +1,206 @@
+import re
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# Rough token estimates used for budgeting (Hebrew text averages ~3 chars/token;
+# Claude bills a page-sized image at roughly 1,600 tokens).
+CHARS_PER_TOKEN = 3
+IMAGE_TOKENS = 1600
+
+DEFAULT_CHUNK_TOKENS = 40000
+DEFAULT_MAP_MAX_TOKENS = 1500
+MAX_MAP_WORKERS = 4
+
+DEFAULT_MAP_PROMPT = (
+    "סכם את הקטע הבא מתוך תיק המטופל. היצמד אך ורק למידע המופיע בקטע, "
+    "שמור על תאריכים ועל הסדר הכרונולוגי, וציין בסוגריים מרובעים את המקור "
+    "(שם הקובץ והעמוד או המקטע) לכל פרט.\n\n"
+)
+DEFAULT_MERGE_PROMPT = (
+    "אחד את הסיכומים החלקיים הבאים לסיכום אחד. שמור על הסדר הכרונולוגי, "
+    "שמור על ציוני המקור בסוגריים מרובעים והסר כפילויות.\n\n"
+)
+
+
+def estimate_tokens(block):
+    if block.get("type") == "image":
+        return IMAGE_TOKENS
+    return len(block.get("text", "")) // CHARS_PER_TOKEN + 1
+
+
+def split_text(text, budget_tokens):
+    """
+    Splits text into pieces of at most budget_tokens, preferring paragraph,
+    then sentence, then hard character boundaries.
+    """
+    max_chars = budget_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text]
+
+    pieces = []
+    current = ""
+    for unit in re.split(r"(?<=[.!?\n])\s+", text):
+        while len(unit) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(unit[:max_chars])
+            unit = unit[max_chars:]
+        if len(current) + len(unit) + 1 > max_chars:
+            if current:
+                pieces.append(current)
+            current = unit
+        else:
+            current = f"{current} {unit}" if current else unit
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_document(name, pages, budget_tokens):
+    """
+    Packs a document's pages (each a list of content blocks) into chunks that
+    fit the token budget. Returns (label, blocks) tuples labelled by page range.
+    """
+    chunks = []
+    current, first_page, used = [], None, 0
+    for number, blocks in enumerate(pages, start=1):
+        cost = sum(estimate_tokens(block) for block in blocks)
+        if current and used + cost > budget_tokens:
+            chunks.append((f"{name}, pages {first_page}-{number - 1}", current))
+            current, used = [], 0
+        if not current:
+            first_page = number
+        current.extend(blocks)
+        used += cost
+    if current:
+        chunks.append((f"{name}, pages {first_page}-{len(pages)}", current))
+    return chunks
+
+
+def chunk_transcript(name, text, budget_tokens):
+    """
+    Splits a transcript into budgeted segments. Returns (label, blocks) tuples.
+    """
+    pieces = split_text(text, budget_tokens)
+    if len(pieces) == 1:
+        return [(name, [{"type": "text", "text": f"[{name}]\n{text}"}])]
+    return [
+        (f"{name}, segment {index}/{len(pieces)}", [{"type": "text", "text": f"[{name}, segment {index}/{len(pieces)}]\n{piece}"}])
+        for index, piece in enumerate(pieces, start=1)
+    ]
+
+
+def source_label(source):
+    """
+    The label of a source in the prompts: its name and, when known, its date.
+    """
+    return f"{source['name']}, {source['date']}" if source.get("date") else source["name"]
+
+
+def merged_label(labels):
+    """
+    The label of a merged partial summary: the span of the labels it covers.
+    """
+    return labels[0] if len(labels) == 1 else f"{labels[0]} … {labels[-1]}"
+
+
+def build_chunks(sources, budget_tokens=DEFAULT_CHUNK_TOKENS):
+    """
+    Turns sources into an ordered list of (label, blocks) chunks.
+    Each source is a dict with a "name", an optional sort "date" and either
+    "text" (a transcript) or "pages" (a list of per-page content block lists).
+    Sources are ordered chronologically by date, falling back to the name
+    (uploaded files are named by timestamp).
+    """
+    ordered = sorted(sources, key=lambda source: str(source.get("date") or source["name"]))
+    chunks = []
+    for source in ordered:
+        if "pages" in source:
+            chunks.extend(chunk_document(source_label(source), source["pages"], budget_tokens))
+        else:
+            chunks.extend(chunk_transcript(source_label(source), source.get("text", ""), budget_tokens))
+    return chunks
+
+
+def map_reduce_summarize(sources, invoke, reduce_prompt, map_prompt=DEFAULT_MAP_PROMPT,
+                         merge_prompt=DEFAULT_MERGE_PROMPT, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                         map_max_tokens=DEFAULT_MAP_MAX_TOKENS, max_tokens=4096,
+                         max_workers=MAX_MAP_WORKERS, progress=None):
+    """
+    Summarizes sources that do not fit one model call.
+
+    Map: every chunk is summarized in parallel (bounded by max_workers).
+    Reduce: the partial summaries, in chronological order and labelled with
+    their source and date, are combined with reduce_prompt. If they do not fit
+    the chunk budget they are first merged in groups with merge_prompt; a
+    merged summary is labelled with the span of sources it covers.
+
+    invoke(content_blocks, max_tokens) must return the model's text.
+    progress(stage, done, total) is called as chunks complete.
+    Returns (summary_text, stats).
+    """
+    chunks = build_chunks(sources, chunk_tokens)
+    if not chunks:
+        raise ValueError("No content to summarize.")
+    total = len(chunks)
+    stats = {"chunks": total, "reduce_levels": 0}
+    logger.info("Map-reduce summary over %d chunks", total)
+
+    done = 0
+    done_lock = threading.Lock()
+
+    def map_chunk(chunk):
+        nonlocal done
+        label, blocks = chunk
+        text = invoke([{"type": "text", "text": map_prompt}] + blocks, map_max_tokens)
+        with done_lock:
+            done += 1
+            current = done
+        if progress:
+            progress("map", current, total)
+        return [label], text.strip()
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, total))) as executor:
+        partials = list(executor.map(map_chunk, chunks))
+    stats["map_ms"] = int((time.monotonic() - start) * 1000)
+
+    # A partial is ([labels of the chunks it covers], text).
+    def labelled(partial):
+        return f"[{merged_label(partial[0])}]\n{partial[1]}"
+
+    def merge_group(group):
+        text = invoke([{"type": "text", "text": merge_prompt + "\n\n".join(labelled(partial) for partial in group)}],
+                      map_max_tokens)
+        return [label for labels, _ in group for label in labels], text.strip()
+
+    start = time.monotonic()
+    while sum(len(labelled(partial)) for partial in partials) // CHARS_PER_TOKEN > chunk_tokens and len(partials) > 1:
+        stats["reduce_levels"] += 1
+        groups, current, used = [], [], 0
+        for partial in partials:
+            cost = len(labelled(partial)) // CHARS_PER_TOKEN
+            if current and used + cost > chunk_tokens:
+                groups.append(current)
+                current, used = [], 0
+            current.append(partial)
+            used += cost
+        groups.append(current)
+        if len(groups) == len(partials):
+            break
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            partials = list(executor.map(merge_group, groups))
+        if progress:
+            progress("merge", stats["reduce_levels"], stats["reduce_levels"])
+
+    summary = invoke([{"type": "text", "text": reduce_prompt.rstrip() + "\n\n" + "\n\n".join(labelled(partial) for partial in partials)}], max_tokens)
+    stats["reduce_levels"] += 1
+    stats["reduce_ms"] = int((time.monotonic() - start) * 1000)
+    if progress:
+        progress("reduce", 1, 1)
+    return summary, stats
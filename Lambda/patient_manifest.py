@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from audio_transcode import AUDIO_OUTPUT_TYPES, AUDIO_PREFIX, recording_kind
+
+logger = logging.getLogger()
+
+# Every patient folder has an index of its files at id_<patient>/.manifest, so
+# listings are one GET instead of a list_objects_v2 scan of the folder:
+#   {"version", "patientId", "updatedAt",
+#    "files": {<key relative to id_<patient>/>: {"size", "contentType", "etag",
+#              "lastModified", "derived"?: {kind: key}, "source"?: key,
+#              "metadata"?: {...}}}}
+# Writers update it with conditional writes (If-Match on the ETag they read),
+# retrying when another writer got there first. A missing manifest is built by
+# scanning the folder; rebuild_manifest (also run from the command line)
+# repairs drift from writers that do not update it.
+MANIFEST_NAME = ".manifest"
+MANIFEST_VERSION = 1
+MAX_UPDATE_ATTEMPTS = 10
+CONFLICT_ERRORS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+# Metadata extracted at ingest (file_metadata.py) is kept in a sidecar object
+# <key>.meta and copied into the file's manifest entry.
+METADATA_SUFFIX = ".meta"
+SIDECAR_WORKERS = 16
+
+# Scratch artifacts that are not listed: folder markers, cached Bedrock results
+# and progress files, metadata sidecars, the search index (search_index.py),
+# rasterized PDF pages and the audio segments of segmented transcriptions.
+SCRATCH_SUFFIXES = ("/", ".cache", ".progress", ".search", METADATA_SUFFIX)
+SCRATCH_PARTS = (".pages/", "output/transcribe/segments/")
+
+
+def manifest_key(patient_id):
+    return f"id_{patient_id}/{MANIFEST_NAME}"
+
+
+def split_key(key):
+    """
+    Returns (patient_id, key relative to the patient folder), or (None, None)
+    for keys outside of the patient folders.
+    """
+    folder, _, relative_key = key.partition("/")
+    if not folder.startswith("id_") or not relative_key:
+        return None, None
+    return folder[len("id_"):], relative_key
+
+
+def is_indexed(relative_key):
+    if not relative_key or relative_key == MANIFEST_NAME or relative_key.endswith(SCRATCH_SUFFIXES):
+        return False
+    return not any(part in relative_key for part in SCRATCH_PARTS)
+
+
+def file_entry(size, etag, last_modified, content_type):
+    return {
+        "size": size,
+        "contentType": content_type,
+        "etag": etag.strip('"'),
+        "lastModified": last_modified.isoformat()
+    }
+
+
+def head_entry(head):
+    return file_entry(
+        head["ContentLength"], head["ETag"], head["LastModified"],
+        head.get("ContentType", "application/octet-stream")
+    )
+
+
+def link_derived(files):
+    """
+    Links each recording to the artifacts derived from it, by their naming
+    conventions: the transcript <name>.json, its speaker turns
+    <name>.turns.jsonl and the extracted audio output/audio/<name>.<format>.
+    """
+    for entry in files.values():
+        entry.pop("derived", None)
+        entry.pop("source", None)
+
+    for key, entry in files.items():
+        if "/" in key or recording_kind(key) is None:
+            continue
+        base_name, _ = os.path.splitext(key)
+        candidates = {
+            "transcript": f"{base_name}.json",
+            "turns": f"{base_name}.turns.jsonl"
+        }
+        candidates.update(
+            (f"audio.{audio_format}", f"{AUDIO_PREFIX}{base_name}.{audio_format}")
+            for audio_format in AUDIO_OUTPUT_TYPES
+        )
+        derived = {kind.split(".")[0]: derived_key for kind, derived_key in candidates.items() if derived_key in files}
+        if derived:
+            entry["derived"] = derived
+            for derived_key in derived.values():
+                files[derived_key]["source"] = key
+    return files
+
+
+def read_manifest(s3_client, bucket, patient_id):
+    """
+    Returns (manifest, etag). manifest is None if there is no manifest (etag
+    is None too) or if it is of an older version.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=manifest_key(patient_id))
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    manifest = json.loads(response["Body"].read().decode("utf-8"))
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None, response["ETag"]
+    return manifest, response["ETag"]
+
+
+def write_manifest(s3_client, bucket, patient_id, manifest, etag):
+    """
+    Writes the manifest if it is still at etag (or still missing, when etag is
+    None). Returns False if another writer changed it first.
+    """
+    manifest["updatedAt"] = int(time.time())
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=manifest_key(patient_id),
+            Body=json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+            ContentType="application/json",
+            **condition
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in CONFLICT_ERRORS:
+            return False
+        raise
+    return True
+
+
+def scan_manifest(s3_client, bucket, patient_id):
+    """
+    Builds the manifest from a listing of the patient folder. The listing has
+    no content types, so they are guessed from the file extensions. Metadata
+    is read back from the sidecars of the files that have one.
+    Returns (manifest, whether the folder exists).
+    """
+    prefix = f"id_{patient_id}/"
+    files = {}
+    sidecars = set()
+    exists = False
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            exists = True
+            relative_key = obj["Key"][len(prefix):]
+            if relative_key.endswith(METADATA_SUFFIX):
+                sidecars.add(relative_key[:-len(METADATA_SUFFIX)])
+            elif is_indexed(relative_key):
+                content_type = mimetypes.guess_type(relative_key)[0] or "application/octet-stream"
+                files[relative_key] = file_entry(obj["Size"], obj["ETag"], obj["LastModified"], content_type)
+
+    def read_sidecar(relative_key):
+        response = s3_client.get_object(Bucket=bucket, Key=prefix + relative_key + METADATA_SUFFIX)
+        return relative_key, json.loads(response["Body"].read().decode("utf-8"))
+
+    with ThreadPoolExecutor(max_workers=SIDECAR_WORKERS) as executor:
+        for relative_key, metadata in executor.map(read_sidecar, sidecars & set(files)):
+            if metadata.get("sourceEtag") == files[relative_key]["etag"]:
+                files[relative_key]["metadata"] = metadata
+    return {"version": MANIFEST_VERSION, "patientId": patient_id, "files": link_derived(files)}, exists
+
+
+def _retry_delay(attempt):
+    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def rebuild_manifest(s3_client, bucket, patient_id):
+    """
+    Replaces the manifest with one built from a scan of the patient folder.
+    Nothing is written for a folder that does not exist, so that listing an
+    unknown patient does not create its folder.
+    """
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        # A manifest of an older version is replaced too.
+        _, etag = read_manifest(s3_client, bucket, patient_id)
+        manifest, exists = scan_manifest(s3_client, bucket, patient_id)
+        if not exists or write_manifest(s3_client, bucket, patient_id, manifest, etag):
+            return manifest
+        _retry_delay(attempt)
+    raise RuntimeError(f"Could not rebuild the manifest of patient {patient_id}: too many concurrent updates")
+
+
+def load_manifest(s3_client, bucket, patient_id):
+    """
+    Returns the patient's manifest, building it first if there is none.
+    """
+    manifest, _ = read_manifest(s3_client, bucket, patient_id)
+    if manifest is None:
+        manifest = rebuild_manifest(s3_client, bucket, patient_id)
+    return manifest
+
+
+def update_manifest(s3_client, bucket, patient_id, mutate):
+    """
+    Applies mutate(files) to the patient's manifest with a conditional write,
+    re-reading and re-applying it if another writer updated the manifest
+    meanwhile. A missing manifest is built by a scan, which already includes
+    the change.
+    """
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        manifest, etag = read_manifest(s3_client, bucket, patient_id)
+        if manifest is None:
+            return rebuild_manifest(s3_client, bucket, patient_id)
+        mutate(manifest["files"])
+        link_derived(manifest["files"])
+        if write_manifest(s3_client, bucket, patient_id, manifest, etag):
+            return manifest
+        _retry_delay(attempt)
+    raise RuntimeError(f"Could not update the manifest of patient {patient_id}: too many concurrent updates")
+
+
+def _group_by_patient(keys):
+    groups = {}
+    for key in keys:
+        patient_id, relative_key = split_key(key)
+        if patient_id is not None and is_indexed(relative_key):
+            groups.setdefault(patient_id, []).append(key)
+    return groups
+
+
+def record_objects(s3_client, bucket, keys):
+    """
+    Adds (or refreshes) the entries of objects that were just written. Failures
+    are only logged: the manifest is repaired by rebuild_manifest.
+    """
+    for patient_id, patient_keys in _group_by_patient(keys).items():
+        try:
+            entries = {}
+            for key in patient_keys:
+                try:
+                    head = s3_client.head_object(Bucket=bucket, Key=key)
+                except s3_client.exceptions.ClientError:
+                    entries[split_key(key)[1]] = None  # Deleted meanwhile
+                    continue
+                entries[split_key(key)[1]] = head_entry(head)
+
+            def mutate(files):
+                for relative_key, entry in entries.items():
+                    if entry is None:
+                        files.pop(relative_key, None)
+                        continue
+                    previous = files.get(relative_key, {})
+                    if "metadata" in previous and previous["etag"] == entry["etag"]:
+                        files[relative_key] = dict(entry, metadata=previous["metadata"])
+                    else:
+                        files[relative_key] = dict(entry)
+
+            update_manifest(s3_client, bucket, patient_id, mutate)
+        except Exception:
+            logger.exception("Could not update the manifest of patient %s", patient_id)
+
+
+def attach_metadata(s3_client, bucket, key, head, metadata):
+    """
+    Stores the metadata extracted from an object (as of head) in its manifest
+    entry, adding the entry if the upload has not been recorded yet.
+    """
+    patient_id, relative_key = split_key(key)
+    entry = dict(head_entry(head), metadata=metadata)
+
+    def mutate(files):
+        current = files.get(relative_key)
+        if current is None or current["etag"] == entry["etag"]:
+            files[relative_key] = dict(entry)
+
+    update_manifest(s3_client, bucket, patient_id, mutate)
+
+
+def forget_objects(s3_client, bucket, keys):
+    """
+    Removes the entries of objects that were just deleted. Failures are only logged.
+    """
+    for patient_id, patient_keys in _group_by_patient(keys).items():
+        relative_keys = [split_key(key)[1] for key in patient_keys]
+
+        def mutate(files):
+            for relative_key in relative_keys:
+                files.pop(relative_key, None)
+
+        try:
+            update_manifest(s3_client, bucket, patient_id, mutate)
+        except Exception:
+            logger.exception("Could not update the manifest of patient %s", patient_id)
+
+
+def drop_manifest(s3_client, bucket, patient_id):
+    """
+    Deletes the manifest of a deleted patient folder, in case a concurrent
+    listing rebuilt it while the folder was being deleted.
+    """
+    s3_client.delete_object(Bucket=bucket, Key=manifest_key(patient_id))
+
+
+def main():
+    """
+    Repair tool: rebuilds the manifests of the given patients (or of all
+    patients with --all) from scans of their folders.
+    """
+    from aws_clients import BUCKET_NAME, get_s3_client
+
+    parser = argparse.ArgumentParser(description=main.__doc__.strip().split("\n")[0])
+    parser.add_argument("patient_ids", nargs="*")
+    parser.add_argument("--all", action="store_true", help="rebuild the manifests of every patient folder")
+    parser.add_argument("--bucket", default=BUCKET_NAME)
+    args = parser.parse_args()
+
+    s3_client = get_s3_client()
+    patient_ids = list(args.patient_ids)
+    if args.all:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=args.bucket, Prefix="id_", Delimiter="/"):
+            patient_ids.extend(prefix["Prefix"][len("id_"):-1] for prefix in page.get("CommonPrefixes", []))
+    if not patient_ids:
+        parser.error("give patient IDs or --all")
+
+    for patient_id in patient_ids:
+        before, _ = read_manifest(s3_client, args.bucket, patient_id)
+        after = rebuild_manifest(s3_client, args.bucket, patient_id)
+        before_keys = set((before or {}).get("files", {}))
+        after_keys = set(after["files"])
+        print(json.dumps({
+            "patientId": patient_id,
+            "files": len(after_keys),
+            "added": sorted(after_keys - before_keys),
+            "removed": sorted(before_keys - after_keys),
+            "hadManifest": before is not None
+        }, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import json
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# A page whose text layer has fewer characters than this is treated as scanned
+# and rasterized instead.
+MIN_TEXT_CHARS = 20
+RASTER_DPI = 110
+MAX_WORKERS = 8
+
+MANIFEST_NAME = "index.cache"
+
+
+def patient_pdf_key(patient_id, key):
+    """
+    Resolves a file name or key to a PDF key inside the patient's folder.
+    Raises ValueError for keys that point outside of it.
+    """
+    prefix = f"id_{patient_id}/"
+    if not key.startswith(prefix):
+        if key.startswith("id_"):
+            raise ValueError(f"PDF key {key} is outside the patient folder")
+        key = prefix + key.lstrip("/")
+    if ".." in key.split("/"):
+        raise ValueError(f"Invalid PDF key: {key}")
+    return key
+
+
+def derived_prefix(pdf_key, etag):
+    """
+    Derived per-page artifacts are stored next to the source PDF, keyed by its
+    ETag, e.g. id_1/report.pdf.pages/<etag>/page-0001.jpg
+    """
+    etag = etag.strip('"')
+    return f"{pdf_key}.pages/{etag}/"
+
+
+def extract_pages(pdf_bytes, min_text_chars=MIN_TEXT_CHARS, dpi=RASTER_DPI):
+    """
+    Splits a PDF into per-page artifacts: the text layer where one exists and a
+    JPEG rendering for scanned pages. Returns a list of dicts:
+      {"page": n, "type": "text", "text": ...}
+      {"page": n, "type": "image", "media_type": "image/jpeg", "bytes": ...}
+    """
+    import pymupdf  # provided by the Lambda layer
+
+    pages = []
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as document:
+        for index, page in enumerate(document, start=1):
+            text = page.get_text("text").strip()
+            if len(text) >= min_text_chars:
+                pages.append({"page": index, "type": "text", "text": text})
+            else:
+                pixmap = page.get_pixmap(dpi=dpi)
+                pages.append({
+                    "page": index,
+                    "type": "image",
+                    "media_type": "image/jpeg",
+                    "bytes": pixmap.tobytes("jpeg")
+                })
+    return pages
+
+
+def _load_cached_pages(s3_client, bucket, prefix):
+    """
+    Returns the cached pages under prefix, or None if the cache is missing or
+    incomplete (a page image was deleted), so that the PDF is extracted again.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=prefix + MANIFEST_NAME)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    manifest = json.loads(response["Body"].read().decode("utf-8"))
+    pages = []
+    for entry in manifest["pages"]:
+        if entry["type"] == "image":
+            try:
+                image = s3_client.get_object(Bucket=bucket, Key=entry["key"])
+            except s3_client.exceptions.NoSuchKey:
+                logger.warning("Cached page %s is missing; extracting the PDF again", entry["key"])
+                return None
+            entry = dict(entry, bytes=image["Body"].read())
+        pages.append(entry)
+    return pages
+
+
+def _store_pages(s3_client, bucket, prefix, pages):
+    manifest_pages = []
+    for page in pages:
+        if page["type"] == "image":
+            key = f"{prefix}page-{page['page']:04d}.jpg"
+            s3_client.put_object(Bucket=bucket, Key=key, Body=page["bytes"], ContentType="image/jpeg")
+            manifest_pages.append({
+                "page": page["page"],
+                "type": "image",
+                "media_type": page["media_type"],
+                "key": key
+            })
+        else:
+            manifest_pages.append(page)
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=prefix + MANIFEST_NAME,
+        Body=json.dumps({"pages": manifest_pages}, ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json"
+    )
+
+
+def ingest_pdf(s3_client, bucket, pdf_key):
+    """
+    Returns the per-page artifacts of a PDF in S3, reusing the cached artifacts
+    for the object's current ETag when they exist.
+    """
+    head = s3_client.head_object(Bucket=bucket, Key=pdf_key)
+    prefix = derived_prefix(pdf_key, head["ETag"])
+
+    pages = _load_cached_pages(s3_client, bucket, prefix)
+    if pages is not None:
+        logger.info("Reusing %d cached pages for %s", len(pages), pdf_key)
+        return pages
+
+    response = s3_client.get_object(Bucket=bucket, Key=pdf_key)
+    pages = extract_pages(response["Body"].read())
+    logger.info(
+        "Extracted %s: %d text pages, %d rasterized pages",
+        pdf_key,
+        sum(1 for p in pages if p["type"] == "text"),
+        sum(1 for p in pages if p["type"] == "image")
+    )
+    try:
+        _store_pages(s3_client, bucket, prefix, pages)
+    except Exception:
+        logger.warning("Could not cache derived pages for %s", pdf_key, exc_info=True)
+    return pages
+
+
+def page_blocks(file_name, page):
+    """
+    Returns the Bedrock content blocks for one page, labelled with its source.
+    """
+    label = f"[{file_name} - page {page['page']}]"
+    if page["type"] == "text":
+        return [{"type": "text", "text": f"{label}\n{page['text']}"}]
+    return [
+        {"type": "text", "text": label},
+        {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": page["media_type"],
+                "data": base64.b64encode(page["bytes"]).decode("ascii")
+            }
+        }
+    ]
+
+
+def pdf_documents(s3_client, bucket, patient_id, keys):
+    """
+    Ingests the given PDFs concurrently and returns (file_name, pages) tuples in
+    request order, where pages holds the per-page artifacts of each document.
+    """
+    pdf_keys = [patient_pdf_key(patient_id, key) for key in keys]
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(pdf_keys) or 1)) as executor:
+        documents = list(executor.map(lambda key: ingest_pdf(s3_client, bucket, key), pdf_keys))
+    return [(pdf_key.split("/")[-1], pages) for pdf_key, pages in zip(pdf_keys, documents)]
+
+
+def pdf_content_blocks(s3_client, bucket, patient_id, keys):
+    """
+    Returns Bedrock message content blocks for the given PDFs in document/page
+    order: a text block per text page (labelled with its source) and a label
+    plus an image block per scanned page.
+    """
+    blocks = []
+    for file_name, pages in pdf_documents(s3_client, bucket, patient_id, keys):
+        for page in pages:
+            blocks.extend(page_blocks(file_name, page))
+    return blocks
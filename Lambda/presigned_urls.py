@@ -1,15 +1,86 @@
+import re
 import json
-import boto3
+import base64
 import logging
-import time
+from aws_clients import BUCKET_NAME, get_s3_client
+from instrumentation import instrumented, record, stage
+from patient_manifest import load_manifest, rebuild_manifest
 
 # Configure logging
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)  # Set to DEBUG for verbose logging
+logger.setLevel(logging.INFO)
 
+PRESIGNED_URL_EXPIRES = 900  # 15 minutes
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+
+
+def compile_glob(pattern):
+    """
+    Compiles a glob to a regex over the key relative to the patient folder.
+    "*" and "?" do not cross "/", "**" does and "[...]" is a character class.
+    A pattern without "/" is matched against the file name at any depth
+    (e.g. "*.json" also matches output/transcribe/x.json).
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            parts.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end + 1
+            continue
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    regex = "".join(parts)
+    if "/" not in pattern:
+        regex = "(?:.*/)?" + regex
+    return re.compile(regex + r"\Z", re.DOTALL)
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+
+
+def match_manifest(manifest, patterns, limit, start_after=None):
+    """
+    Matches the patterns against the patient's manifest and returns
+    ([(relative key, entry, matched patterns)], next start_after or None),
+    in key order.
+    """
+    compiled = [(pattern, compile_glob(pattern)) for pattern in patterns]
+    matches = []
+    for relative_key in sorted(manifest["files"]):
+        if start_after is not None and relative_key <= start_after:
+            continue
+        matched = [pattern for pattern, regex in compiled if regex.match(relative_key)]
+        if not matched:
+            continue
+        if len(matches) == limit:
+            # More files follow; the caller continues after the last one returned.
+            return matches, matches[-1][0]
+        matches.append((relative_key, manifest["files"][relative_key], matched))
+    return matches, None
+
+@instrumented("presigned_urls")
 def lambda_handler(event, context):
-    logger.debug("Lambda function started.")
-    logger.debug(f"Received event: {json.dumps(event)}")
     
     try:
         # 1. Parse request parameters (pathParameters or queryStringParameters)
@@ -41,60 +112,62 @@ def lambda_handler(event, context):
         s3_prefix = f"id_{patient_id}/"
         logger.debug(f"Constructed S3 prefix: {s3_prefix}")
         
-        # 3. Create the S3 client
-        s3 = boto3.client('s3', 
-                  region_name='BUCKET_REGION',
-                  endpoint_url='https://s3.eu-west-1.amazonaws.com')
-        bucket_name = 'BUCKET_NAME'
-        logger.debug("S3 client created.")
+        # 3. Get the shared S3 client
+        s3 = get_s3_client()
+        bucket_name = BUCKET_NAME
+        logger.debug("S3 client ready.")
         
         # 4. Check if file_name contains a wildcard
-        if "*" in file_name:
-            logger.debug("Wildcard detected in file_name.")
-            # Extract the suffix to match, e.g., '*.pdf' -> '.pdf'
-            suffix = file_name.replace("*", "")
-            logger.debug(f"Extracted suffix for filtering: {suffix}")
-            
-            # List objects under the patient's folder.
-            logger.debug("Listing objects from S3...")
-            start_time = time.time()
-            response = s3.list_objects_v2(Bucket=bucket_name, Prefix=s3_prefix)
-            elapsed_time = time.time() - start_time
-            logger.debug(f"S3 list_objects_v2 call took {elapsed_time:.2f} seconds")
-            logger.debug(f"S3 response: {json.dumps(response, default=str)}")
-            
-            matching_keys = []
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    key = obj['Key']
-                    if key.endswith(suffix):
-                        matching_keys.append(key)
-                        logger.debug(f"Matched key: {key}")
-            else:
-                logger.debug("No contents found in the S3 response.")
-            
-            if not matching_keys:
+        if "*" in file_name or "?" in file_name:
+            # One or more comma-separated patterns, e.g. '*.mp4,*.mp3'
+            patterns = [pattern.strip() for pattern in file_name.split(",") if pattern.strip()]
+            qs_params = event.get('queryStringParameters') or {}
+            limit = max(1, min(int(qs_params.get('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+            cursor = qs_params.get('cursor')
+            logger.debug(f"Patterns: {patterns}, limit: {limit}, cursor: {cursor}")
+
+            # Listings are served from the patient's manifest (one GET);
+            # refresh=true rebuilds it from a scan of the folder first.
+            with stage("manifest"):
+                if str(qs_params.get('refresh', '')).lower() == 'true':
+                    manifest = rebuild_manifest(s3, bucket_name, patient_id)
+                else:
+                    manifest = load_manifest(s3, bucket_name, patient_id)
+            with stage("match"):
+                matches, next_key = match_manifest(
+                    manifest, patterns, limit,
+                    start_after=decode_cursor(cursor) if cursor else None
+                )
+            record("ManifestFiles", len(manifest["files"]))
+            record("ListedFiles", len(matches))
+
+            if not matches and not cursor:
                 error_msg = "No matching files found"
                 logger.error(error_msg)
                 raise ValueError(error_msg)
-            
+
             # For each matching key, generate a presigned URL and extract the file name.
             files = []
-            for key in matching_keys:
+            for relative_key, entry, matched in matches:
+                key = s3_prefix + relative_key
                 presigned_url = s3.generate_presigned_url(
                     ClientMethod='get_object',
                     Params={'Bucket': bucket_name, 'Key': key},
-                    ExpiresIn=900  # 15 minutes
+                    ExpiresIn=PRESIGNED_URL_EXPIRES
                 )
-                # Assuming key format "id_{patient_id}/fileName", extract fileName
-                file_only = key.split('/')[-1]
-                files.append({
+                file_info = {
                     "url": presigned_url,
-                    "fileName": file_only
-                })
-                logger.debug(f"Generated presigned URL for key {key}: {presigned_url}")
-            
+                    "fileName": key.split('/')[-1],
+                    "key": relative_key,
+                    "patterns": matched
+                }
+                file_info.update(entry)
+                files.append(file_info)
+
             logger.info("Returning list of presigned URLs for wildcard match.")
+            body = {"files": files}
+            if next_key:
+                body["cursor"] = encode_cursor(next_key)
             return {
                 "statusCode": 200,
                 "headers": {
@@ -103,7 +176,7 @@ def lambda_handler(event, context):
                     "Access-Control-Allow-Headers": "Content-Type,Authorization",
                     "Content-Type": "application/json"
                 },
-                "body": json.dumps({"files": files})
+                "body": json.dumps(body)
             }
         
         else:
@@ -117,10 +190,8 @@ def lambda_handler(event, context):
                     'Bucket': bucket_name,
                     'Key': s3_key
                 },
-                ExpiresIn=900  # 15 minutes
+                ExpiresIn=PRESIGNED_URL_EXPIRES
             )
-            logger.debug(f"Generated presigned URL: {presigned_url}")
-            
             logger.info("Returning presigned URL for specific file.")
             # Return in the same format with a single file in the array.
             return {
@@ -0,0 +1,498 @@
+import os
+import re
+import json
+import gzip
+import time
+import random
+import logging
+import unicodedata
+from bisect import bisect_right
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import BUCKET_NAME, get_s3_client
+from audio_transcode import recording_kind
+from file_metadata import ingest_keys
+from incremental_summary import LEDGER_NAME
+from instrumentation import instrumented, record, stage
+from patient_manifest import CONFLICT_ERRORS, load_manifest, split_key
+from transcript_turns import iter_transcript_items
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Full-text search over the transcripts and summaries of a patient. Every
+# patient folder has an inverted index at id_<patient>/.search (gzipped JSON,
+# listed by no one):
+#   {"version", "patientId", "updatedAt", "nextDoc",
+#    "docs": {<doc id>: {"key", "etag", "kind", "date", "recording"?,
+#             "words": [surface words], "times"?: [start, centiseconds,
+#             delta-encoded], "speakers"?: [[first word, label], ...]}},
+#    "terms": {<normalized term>: {<doc id>: [word positions, delta-encoded]}}}
+# Transcripts (id_<patient>/<name>.json), summaries
+# (output/Summary/<name>.txt) and the history summary ledger are indexed as
+# their ObjectCreated/ObjectRemoved events arrive; a document is re-read only
+# when its ETag changed. Queries only read the index, so hits (with the
+# word's time and speaker in the recording, and a snippet) come without
+# downloading the documents.
+INDEX_NAME = ".search"
+INDEX_VERSION = 1
+MAX_UPDATE_ATTEMPTS = 10
+SUMMARY_PREFIX = "output/Summary/"
+SNIPPET_WORDS = 8
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+QUERY_WORKERS = 8
+
+# Hebrew normalization: points and cantillation marks (and Latin accents) are
+# dropped, final letter forms are folded into the regular ones, and geresh /
+# gershayim inside words are removed (צה"ל -> צהל). Maqaf splits words.
+MARKS = re.compile("[\u0300-\u036F\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]")
+FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+TOKEN = re.compile("[^\\W_]+(?:[\"'\u05F3\u05F4][^\\W_]+)*")
+QUOTES = re.compile("[\"'\u05F3\u05F4]")
+HEBREW_WORD = re.compile("[\u05D0-\u05EA]+")
+
+# The prefix letters (ו, ש, כש, מש, לכש, ה, ב, כ, ל, מ and their sequences)
+# are kept in the index; a query word also matches its prefixed forms
+# (כאב matches והכאב, בכאב, שכאב...). Words shorter than MIN_STEM are matched
+# as they are.
+PREFIXES = sorted(
+    {conjunction + relative + preposition
+     for conjunction in ("", "ו")
+     for relative in ("", "ש", "כש", "מש", "לכש")
+     for preposition in ("", "ה", "ב", "כ", "ל", "מ")} - {""}
+)
+MIN_STEM = 2
+
+QUERY_CLAUSE = re.compile('"([^"]+)"(?!\\S)|(\\S+)')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+# Indexes read by this container, {patient: (etag, index)}; revalidated with
+# a conditional GET on every query.
+_indexes = {}
+
+
+def json_response(status_code, body):
+    return {"statusCode": status_code, "headers": CORS_HEADERS, "body": json.dumps(body, ensure_ascii=False)}
+
+
+def index_key(patient_id):
+    return f"id_{patient_id}/{INDEX_NAME}"
+
+
+def terms(text):
+    """
+    Returns the normalized terms of a text, in order.
+    """
+    text = MARKS.sub("", unicodedata.normalize("NFKD", text)).casefold()
+    return [QUOTES.sub("", match.group()).translate(FINAL_LETTERS) for match in TOKEN.finditer(text)]
+
+
+def variants(term):
+    if len(term) < MIN_STEM or not HEBREW_WORD.fullmatch(term):
+        return [term]
+    return [term] + [prefix + term for prefix in PREFIXES]
+
+
+def document_kind(relative_key):
+    """
+    Returns "transcript", "summary" or "history" for the keys that are
+    indexed, or None.
+    """
+    if "/" not in relative_key and relative_key.endswith(".json"):
+        return "transcript"
+    if relative_key == LEDGER_NAME:
+        return "history"
+    if relative_key.startswith(SUMMARY_PREFIX) and relative_key.endswith(".txt") \
+            and "/" not in relative_key[len(SUMMARY_PREFIX):]:
+        return "summary"
+    return None
+
+
+def deltas(values):
+    return [value - previous for value, previous in zip(values, [0] + values[:-1])]
+
+
+def read_document(s3_client, bucket, key, kind):
+    """
+    Reads a transcript (word by word, with times and speakers) or a summary
+    into an index document.
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    document = {"etag": response["ETag"].strip('"'), "kind": kind, "date": response["LastModified"].isoformat()}
+    if kind != "transcript":
+        text = response["Body"].read().decode("utf-8")
+        if kind == "history":
+            text = json.loads(text).get("summary", "")
+        document["words"] = text.split()
+        return document
+
+    words, times, speakers = [], [], []
+    for item in iter_transcript_items(response["Body"]):
+        content = (item.get("alternatives") or [{}])[0].get("content", "")
+        if item.get("type") == "punctuation":
+            if words:
+                words[-1] += content
+            continue
+        speaker = item.get("speaker_label")
+        if not speakers or speakers[-1][1] != speaker:
+            speakers.append([len(words), speaker])
+        times.append(round(float(item["start_time"]) * 100))
+        words.append(content)
+    if not words:
+        # No word items (e.g. an empty recording): index the transcript text.
+        transcript_json = json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+        transcript_list = transcript_json.get("results", {}).get("transcripts", [])
+        document["words"] = (transcript_list[0].get("transcript", "") if transcript_list else "").split()
+        return document
+    document.update(words=words, times=deltas(times), speakers=speakers)
+    return document
+
+
+def document_postings(words):
+    """
+    Returns {term: [word positions]} of a document's words.
+    """
+    postings = {}
+    for position, word in enumerate(words):
+        for term in terms(word):
+            positions = postings.setdefault(term, [])
+            if not positions or positions[-1] != position:
+                positions.append(position)
+    return postings
+
+
+def empty_index(patient_id):
+    return {"version": INDEX_VERSION, "patientId": patient_id, "nextDoc": 0, "docs": {}, "terms": {}}
+
+
+def read_index(s3_client, bucket, patient_id):
+    """
+    Returns (index, etag). The index is empty (and etag None) if the patient
+    has none yet; an index of an older version is returned empty with its etag.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=index_key(patient_id))
+    except s3_client.exceptions.NoSuchKey:
+        return empty_index(patient_id), None
+    index = json.loads(gzip.decompress(response["Body"].read()).decode("utf-8"))
+    if index.get("version") != INDEX_VERSION:
+        return empty_index(patient_id), response["ETag"]
+    return index, response["ETag"]
+
+
+def write_index(s3_client, bucket, patient_id, index, etag):
+    """
+    Writes the index if it is still at etag (or still missing, when etag is
+    None). Returns False if another writer changed it first.
+    """
+    index["updatedAt"] = int(time.time())
+    body = gzip.compress(json.dumps(index, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        response = s3_client.put_object(
+            Bucket=bucket,
+            Key=index_key(patient_id),
+            Body=body,
+            ContentType="application/gzip",
+            **condition
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in CONFLICT_ERRORS:
+            return False
+        raise
+    record("SearchIndexBytes", len(body), "Bytes")
+    _indexes[patient_id] = (response["ETag"], index)
+    return True
+
+
+def remove_document(index, relative_key):
+    for doc_id, document in list(index["docs"].items()):
+        if document["key"] == relative_key:
+            del index["docs"][doc_id]
+            for term in list(index["terms"]):
+                postings = index["terms"][term]
+                if postings.pop(doc_id, None) is not None and not postings:
+                    del index["terms"][term]
+
+
+def add_document(index, relative_key, document):
+    remove_document(index, relative_key)
+    doc_id = str(index["nextDoc"])
+    index["nextDoc"] += 1
+    index["docs"][doc_id] = dict(document, key=relative_key)
+    for term, positions in document_postings(document["words"]).items():
+        index["terms"].setdefault(term, {})[doc_id] = deltas(positions)
+
+
+def recording_of(files, relative_key):
+    """
+    Returns the recording a transcript was made from, by the naming convention
+    (<name>.mp4 -> <name>.json), or None.
+    """
+    base_name = relative_key[:-len(".json")]
+    return next(
+        (key for key in files if "/" not in key and recording_kind(key) and os.path.splitext(key)[0] == base_name),
+        None
+    )
+
+
+def _retry_delay(attempt):
+    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def update_patient_index(s3_client, bucket, patient_id, relative_keys, rebuild=False):
+    """
+    Brings the patient's index up to date with relative_keys: documents that
+    are new or changed are (re-)indexed, documents that no longer exist are
+    removed. With rebuild, the index is replaced by one of relative_keys only.
+    Returns {"added", "removed", "unchanged"}.
+    """
+    index, etag = read_index(s3_client, bucket, patient_id)
+    indexed = {document["key"]: document["etag"] for document in index["docs"].values()}
+    removed, unchanged, documents = [], [], {}
+    files = None
+    for relative_key in dict.fromkeys(relative_keys):
+        kind = document_kind(relative_key)
+        try:
+            head = s3_client.head_object(Bucket=bucket, Key=f"id_{patient_id}/{relative_key}")
+        except s3_client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            removed.append(relative_key)
+            continue
+        if not rebuild and indexed.get(relative_key) == head["ETag"].strip('"'):
+            unchanged.append(relative_key)
+            continue
+        document = read_document(s3_client, bucket, f"id_{patient_id}/{relative_key}", kind)
+        if kind == "transcript":
+            if files is None:
+                files = load_manifest(s3_client, bucket, patient_id)["files"]
+            document["recording"] = recording_of(files, relative_key)
+        documents[relative_key] = document
+
+    result = {"added": sorted(documents), "removed": [key for key in removed if key in indexed], "unchanged": unchanged}
+    if not rebuild and not documents and not result["removed"]:
+        return result
+
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        if rebuild:
+            index = dict(empty_index(patient_id), nextDoc=index.get("nextDoc", 0))
+        for relative_key in removed:
+            remove_document(index, relative_key)
+        for relative_key, document in documents.items():
+            add_document(index, relative_key, document)
+        if write_index(s3_client, bucket, patient_id, index, etag):
+            logger.info("Search index of patient %s updated: %s", patient_id, result)
+            return result
+        _retry_delay(attempt)
+        index, etag = read_index(s3_client, bucket, patient_id)
+    raise RuntimeError(f"Could not update the search index of patient {patient_id}: too many concurrent updates")
+
+
+def index_objects(s3_client, bucket, keys):
+    """
+    Updates the indexes of the patients of keys (full object keys) with the
+    transcripts and summaries among them.
+    """
+    groups = {}
+    for key in keys:
+        patient_id, relative_key = split_key(key)
+        if patient_id is not None and document_kind(relative_key):
+            groups.setdefault(patient_id, []).append(relative_key)
+    return {
+        patient_id: update_patient_index(s3_client, bucket, patient_id, relative_keys)
+        for patient_id, relative_keys in groups.items()
+    }
+
+
+def reindex_patient(s3_client, bucket, patient_id):
+    """
+    Rebuilds the patient's index from the documents in the manifest.
+    """
+    files = load_manifest(s3_client, bucket, patient_id)["files"]
+    relative_keys = [key for key in files if document_kind(key)]
+    # The ledger is written after the manifest entry of a new summary; list it
+    # even if the manifest missed it.
+    if LEDGER_NAME not in relative_keys:
+        relative_keys.append(LEDGER_NAME)
+    return update_patient_index(s3_client, bucket, patient_id, relative_keys, rebuild=True)
+
+
+def cached_index(s3_client, bucket, patient_id):
+    """
+    Returns the patient's index, reusing this container's copy if the index
+    did not change since it was read.
+    """
+    etag, index = _indexes.get(patient_id, (None, None))
+    try:
+        if etag:
+            response = s3_client.get_object(Bucket=bucket, Key=index_key(patient_id), IfNoneMatch=etag)
+        else:
+            response = s3_client.get_object(Bucket=bucket, Key=index_key(patient_id))
+    except s3_client.exceptions.NoSuchKey:
+        _indexes.pop(patient_id, None)
+        return empty_index(patient_id)
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            return index
+        raise
+    index = json.loads(gzip.decompress(response["Body"].read()).decode("utf-8"))
+    if index.get("version") != INDEX_VERSION:
+        return empty_index(patient_id)
+    _indexes[patient_id] = (response["ETag"], index)
+    return index
+
+
+def parse_query(query):
+    """
+    Splits a query into clauses, each a list of terms: a quoted phrase is one
+    clause, every other word is a clause of its own.
+    """
+    clauses = []
+    for phrase, word in QUERY_CLAUSE.findall(query):
+        if phrase:
+            clauses.append(terms(phrase))
+        else:
+            clauses.extend([term] for term in terms(word))
+    return [clause for clause in clauses if clause]
+
+
+def term_positions(index, term):
+    """
+    Returns {doc id: set of positions} of a query term and its prefixed forms.
+    """
+    matches = {}
+    for variant in variants(term):
+        for doc_id, positions in index["terms"].get(variant, {}).items():
+            matches.setdefault(doc_id, set()).update(accumulate(positions))
+    return matches
+
+
+def clause_positions(index, clause):
+    """
+    Returns {doc id: sorted positions of the clause's first word}.
+    """
+    matches = term_positions(index, clause[0])
+    for offset, term in enumerate(clause[1:], start=1):
+        following = term_positions(index, term)
+        matches = {
+            doc_id: {position for position in positions if position + offset in following.get(doc_id, ())}
+            for doc_id, positions in matches.items()
+        }
+    return {doc_id: sorted(positions) for doc_id, positions in matches.items() if positions}
+
+
+def document_hit(document, times, position, length):
+    words = document["words"]
+    hit = {
+        "key": document["key"],
+        "kind": document["kind"],
+        "date": document["date"],
+        "position": position,
+        "snippet": " ".join(words[max(0, position - SNIPPET_WORDS):position + length + SNIPPET_WORDS])
+    }
+    if document.get("recording"):
+        hit["recording"] = document["recording"]
+    if times:
+        hit["start"] = times[position] / 100
+    if document.get("speakers"):
+        starts = [first for first, _ in document["speakers"]]
+        hit["speaker"] = document["speakers"][bisect_right(starts, position) - 1][1]
+    return hit
+
+
+def search_index(index, clauses, kinds=None):
+    """
+    Returns the hits of the clauses in the documents that contain all of
+    them, in chronological order.
+    """
+    matches = [clause_positions(index, clause) for clause in clauses]
+    doc_ids = set.intersection(*(set(match) for match in matches)) if matches else set()
+    hits = []
+    for doc_id in doc_ids:
+        document = index["docs"][doc_id]
+        if kinds and document["kind"] not in kinds:
+            continue
+        times = list(accumulate(document["times"])) if document.get("times") else None
+        for clause, match in zip(clauses, matches):
+            hits.extend(document_hit(document, times, position, len(clause)) for position in match[doc_id])
+    hits.sort(key=lambda hit: (hit["date"], hit["key"], hit["position"]))
+    return hits
+
+
+def search(s3_client, bucket, patient_ids, query, kinds=None, limit=DEFAULT_LIMIT):
+    """
+    Searches the indexes of patient_ids (one patient, or e.g. the patients of
+    a ward). Returns {"query", "total", "hits"}, hits in chronological order.
+    """
+    clauses = parse_query(query)
+    if not clauses:
+        raise ValueError("The query has no searchable words")
+
+    def search_patient(patient_id):
+        hits = search_index(cached_index(s3_client, bucket, patient_id), clauses, kinds)
+        return [dict(hit, patientId=patient_id) for hit in hits]
+
+    with stage("search.query"):
+        with ThreadPoolExecutor(max_workers=min(QUERY_WORKERS, len(patient_ids))) as executor:
+            hits = [hit for patient_hits in executor.map(search_patient, patient_ids) for hit in patient_hits]
+    hits.sort(key=lambda hit: (hit["date"], hit["patientId"], hit["key"], hit["position"]))
+    return {"query": query, "terms": clauses, "total": len(hits), "hits": hits[:limit]}
+
+
+@instrumented("search_index")
+def lambda_handler(event, context):
+    """
+    - S3 ObjectCreated / ObjectRemoved events (notifications or EventBridge)
+      for transcripts and summaries: updates the patient's index.
+    - {"action": "reindex", "patientId"}: rebuilds a patient's index from the
+      manifest (e.g. for folders created before the index existed).
+    - GET ?patientId=&q=[&kind=transcript,summary,history][&limit=]: the hits of
+      the query in chronological order, each with the document key, its
+      recording, the word's start time (seconds) and speaker, and a snippet.
+      patientIds=a,b,c searches several patients (e.g. a ward) at once. Words
+      in quotes must appear as a phrase.
+    """
+    if event.get('httpMethod') == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': ''}
+
+    s3_client = get_s3_client()
+    if event.get('source') == 'aws.s3' or 'Records' in event:
+        result = index_objects(s3_client, BUCKET_NAME, ingest_keys(event))
+        return {'statusCode': 200, 'body': json.dumps(result, ensure_ascii=False)}
+
+    if event.get('action') == 'reindex':
+        patient_id = event.get('patientId')
+        if not patient_id or '/' in patient_id:
+            return json_response(400, {"error": "Missing or invalid patientId"})
+        result = reindex_patient(s3_client, BUCKET_NAME, patient_id)
+        return {'statusCode': 200, 'body': json.dumps(result, ensure_ascii=False)}
+
+    if event.get('httpMethod') != 'GET':
+        return {'statusCode': 405, 'headers': {'Access-Control-Allow-Origin': '*'}, 'body': 'Method Not Allowed'}
+
+    params = event.get('queryStringParameters') or {}
+    patient_ids = [params['patientId']] if params.get('patientId') else []
+    if params.get('patientIds'):
+        patient_ids.extend(value.strip() for value in params['patientIds'].split(',') if value.strip())
+    patient_ids = list(dict.fromkeys(patient_ids))
+    if not patient_ids or any('/' in value for value in patient_ids):
+        return json_response(400, {"error": "Missing or invalid patientId"})
+    if not params.get('q', '').strip():
+        return json_response(400, {"error": "Missing q"})
+    kinds = [kind.strip() for kind in params['kind'].split(',')] if params.get('kind') else None
+
+    try:
+        limit = max(1, min(int(params.get('limit') or DEFAULT_LIMIT), MAX_LIMIT))
+        return json_response(200, search(s3_client, BUCKET_NAME, patient_ids, params['q'], kinds, limit))
+    except ValueError as e:
+        return json_response(400, {"error": str(e)})
+    except Exception as e:
+        logger.exception("Search failed")
+        return json_response(500, {"error": str(e)})
@@ -0,0 +1,363 @@
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+FFMPEG = os.environ.get("FFMPEG_PATH", "ffmpeg")
+
+# Segments are cut at the silence closest to every SEGMENT_SECONDS mark and
+# extended by SEGMENT_OVERLAP_SECONDS on each side, so speakers can be matched
+# across segments on the words both neighbours transcribed.
+SEGMENT_SECONDS = int(os.environ.get("SEGMENT_SECONDS", "600"))
+SEGMENT_OVERLAP_SECONDS = float(os.environ.get("SEGMENT_OVERLAP_SECONDS", "15"))
+SEGMENT_CONCURRENCY = int(os.environ.get("SEGMENT_CONCURRENCY", "8"))
+SILENCE_NOISE = os.environ.get("SILENCE_NOISE", "-35dB")
+SILENCE_MIN_SECONDS = float(os.environ.get("SILENCE_MIN_SECONDS", "0.5"))
+
+
+def run_ffmpeg(args):
+    result = subprocess.run([FFMPEG, "-hide_banner", "-nostdin"] + args, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr[-500:]}")
+    return result.stderr
+
+
+def detect_silences(media_path, noise=SILENCE_NOISE, min_seconds=SILENCE_MIN_SECONDS):
+    """
+    Returns (duration, silences) where silences is a list of (start, end)
+    seconds found by ffmpeg's silencedetect filter.
+    """
+    output = run_ffmpeg(["-i", media_path, "-vn", "-af", f"silencedetect=noise={noise}:d={min_seconds}", "-f", "null", "-"])
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if not match:
+        raise RuntimeError("Could not read media duration")
+    duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+    starts = [float(value) for value in re.findall(r"silence_start: (-?\d+(?:\.\d+)?)", output)]
+    ends = [float(value) for value in re.findall(r"silence_end: (\d+(?:\.\d+)?)", output)]
+    return duration, list(zip(starts, ends))
+
+
+def plan_segments(duration, silences, target_seconds=SEGMENT_SECONDS):
+    """
+    Splits [0, duration] into segments of about target_seconds, cutting at the
+    middle of the silence closest to each target boundary. Returns the list of
+    (start, end) cut points (without overlap).
+    """
+    if duration <= target_seconds * 1.5:
+        return [(0.0, duration)]
+
+    midpoints = [(start + end) / 2 for start, end in silences]
+    cuts = []
+    previous = 0.0
+    target = target_seconds
+    while duration - previous > target_seconds * 1.5:
+        window = [point for point in midpoints if previous + target_seconds / 2 < point < previous + target_seconds * 1.5]
+        cut = min(window, key=lambda point: abs(point - target)) if window else target
+        cuts.append(cut)
+        previous = cut
+        target = cut + target_seconds
+
+    bounds = [0.0] + cuts + [duration]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def extract_segment(media_path, start, end, output_path):
+    """
+    Extracts [start, end) of the audio track as mono 16 kHz FLAC.
+    """
+    run_ffmpeg([
+        "-y", "-ss", f"{start:.3f}", "-i", media_path, "-t", f"{end - start:.3f}",
+        "-vn", "-ac", "1", "-ar", "16000", "-c:a", "flac", output_path
+    ])
+    return output_path
+
+
+def split_recording(media_path, work_dir, target_seconds=SEGMENT_SECONDS, overlap_seconds=SEGMENT_OVERLAP_SECONDS):
+    """
+    Cuts the recording at silences and extracts every segment (with its
+    overlap) to work_dir. Returns (duration, segments), each segment a dict
+    with its "index", its "cutStart" / "cutEnd" and the "offset" where its
+    audio starts in the recording, and the "path" of the extracted file.
+    """
+    duration, silences = detect_silences(media_path)
+    cuts = plan_segments(duration, silences, target_seconds)
+    logger.info("Splitting %.0fs recording into %d segments", duration, len(cuts))
+    segments = []
+    for index, (cut_start, cut_end) in enumerate(cuts):
+        start = max(0.0, cut_start - overlap_seconds) if index > 0 else 0.0
+        end = min(duration, cut_end + overlap_seconds) if index < len(cuts) - 1 else duration
+        segments.append({
+            "index": index,
+            "cutStart": cut_start,
+            "cutEnd": cut_end,
+            "offset": start,
+            "path": extract_segment(media_path, start, end, os.path.join(work_dir, f"segment-{index:03d}.flac"))
+        })
+    return duration, segments
+
+
+def segment_job_name(job_name, index):
+    return f"{job_name}_seg{index:03d}"
+
+
+def parse_segment_job_name(name):
+    """
+    Returns (job_name, index) for the name of a segment job, else None.
+    """
+    match = re.fullmatch(r"(.+)_seg(\d{3})", name or "")
+    return (match.group(1), int(match.group(2))) if match else None
+
+
+def _items_with_speakers(transcript_json):
+    """
+    Returns the items of a Transcribe output with their speaker label set,
+    taken from the item itself or from results.speaker_labels.
+    """
+    results = transcript_json.get("results", {})
+    speakers_by_start = {}
+    for segment in results.get("speaker_labels", {}).get("segments", []):
+        for item in segment.get("items", []):
+            speakers_by_start[item["start_time"]] = item["speaker_label"]
+
+    items = []
+    last_speaker = None
+    for item in results.get("items", []):
+        item = dict(item)
+        if item.get("type") == "pronunciation":
+            item["speaker_label"] = item.get("speaker_label") or speakers_by_start.get(item.get("start_time"))
+            last_speaker = item["speaker_label"]
+        else:
+            item["speaker_label"] = item.get("speaker_label") or last_speaker
+        items.append(item)
+    return items
+
+
+def _speaker_turns(items, window_start, window_end, max_gap=1.5):
+    """
+    Merges consecutive words of the same speaker inside the window into
+    (start, end, speaker) turns, so neighbouring segments can be compared even
+    when their word timings differ slightly.
+    """
+    turns = []
+    for item in items:
+        if item.get("type") != "pronunciation" or not item.get("speaker_label"):
+            continue
+        start, end = float(item["start_time"]), float(item["end_time"])
+        if not window_start <= start < window_end:
+            continue
+        if turns and turns[-1][2] == item["speaker_label"] and start - turns[-1][1] <= max_gap:
+            turns[-1][1] = end
+        else:
+            turns.append([start, end, item["speaker_label"]])
+    return turns
+
+
+def _speaker_overlap(items_a, items_b, window_start, window_end):
+    """
+    Seconds of overlap between each (speaker in a, speaker in b) pair inside
+    the window; a and b are items with absolute times.
+    """
+    overlap = {}
+    for start_a, end_a, speaker_a in _speaker_turns(items_a, window_start, window_end):
+        for start_b, end_b, speaker_b in _speaker_turns(items_b, window_start, window_end):
+            shared = min(end_a, end_b) - max(start_a, start_b)
+            if shared > 0:
+                overlap[(speaker_a, speaker_b)] = overlap.get((speaker_a, speaker_b), 0) + shared
+    return overlap
+
+
+def _shift(items, offset):
+    shifted = []
+    for item in items:
+        item = dict(item)
+        if "start_time" in item:
+            item["start_time"] = f"{float(item['start_time']) + offset:.3f}"
+            item["end_time"] = f"{float(item['end_time']) + offset:.3f}"
+        shifted.append(item)
+    return shifted
+
+
+def _select(items, start, end):
+    """
+    Keeps the pronunciations starting in [start, end) and the punctuation that
+    follows a kept pronunciation.
+    """
+    selected = []
+    keep = False
+    for item in items:
+        if item.get("type") == "pronunciation":
+            keep = start <= float(item["start_time"]) < end
+        if keep:
+            selected.append(item)
+    return selected
+
+
+def stitch_transcripts(parts, job_name="stitched", overlap_seconds=SEGMENT_OVERLAP_SECONDS):
+    """
+    Combines per-segment Transcribe outputs into one Transcribe-compatible
+    JSON. parts is a list of (cut_start, cut_end, offset, transcript_json) in
+    order, where offset is where the transcribed audio started (cut_start minus
+    the overlap). Speaker labels are made consistent by matching the speakers
+    of neighbouring segments on their overlapping audio.
+    """
+    stitched = []
+    previous_items = None
+    previous_cut_end = None
+    for cut_start, cut_end, offset, transcript_json in parts:
+        items = _shift(_items_with_speakers(transcript_json), offset)
+
+        mapping = {}
+        if previous_items is not None:
+            overlap = _speaker_overlap(
+                previous_items, items,
+                previous_cut_end - overlap_seconds, previous_cut_end + overlap_seconds
+            )
+            # Greedily pair the speakers that share the most audio.
+            for (speaker_a, speaker_b), _ in sorted(overlap.items(), key=lambda entry: -entry[1]):
+                if speaker_b not in mapping and speaker_a not in mapping.values():
+                    mapping[speaker_b] = speaker_a
+        # Speakers that were not matched take the remaining known labels (with
+        # two speakers, matching one fixes the other); the first segment
+        # defines the labels.
+        known = {item["speaker_label"] for item in stitched if item.get("speaker_label")}
+        for label in sorted({item["speaker_label"] for item in items if item.get("speaker_label")}):
+            if label in mapping:
+                continue
+            used = set(mapping.values())
+            unused = sorted(known - used)
+            if previous_items is None:
+                mapping[label] = label
+            elif unused:
+                mapping[label] = unused[0]
+            else:
+                number = 0
+                while f"spk_{number}" in known | used:
+                    number += 1
+                mapping[label] = f"spk_{number}"
+        for item in items:
+            if item.get("speaker_label"):
+                item["speaker_label"] = mapping[item["speaker_label"]]
+
+        stitched.extend(_select(items, cut_start, cut_end))
+        previous_items = items
+        previous_cut_end = cut_end
+
+    transcript = ""
+    for item in stitched:
+        content = item["alternatives"][0]["content"]
+        transcript += content if item.get("type") == "punctuation" or not transcript else " " + content
+
+    segments = []
+    for item in stitched:
+        if item.get("type") != "pronunciation":
+            continue
+        entry = {"start_time": item["start_time"], "end_time": item["end_time"], "speaker_label": item["speaker_label"]}
+        if segments and segments[-1]["speaker_label"] == item["speaker_label"]:
+            segments[-1]["end_time"] = item["end_time"]
+            segments[-1]["items"].append(entry)
+        else:
+            segments.append(dict(entry, items=[entry]))
+
+    return {
+        "jobName": job_name,
+        "status": "COMPLETED",
+        "results": {
+            "transcripts": [{"transcript": transcript}],
+            "speaker_labels": {
+                "speakers": len({segment["speaker_label"] for segment in segments}),
+                "segments": segments
+            },
+            "items": stitched
+        }
+    }
+
+
+class TranscribeBackend:
+    """
+    Runs segment jobs with Amazon Transcribe. Segment audio and outputs are
+    kept in S3 under prefix; nothing here waits for a job: its completion
+    arrives as an event (or is found by a status check).
+    """
+
+    def __init__(self, s3_client, transcribe_client, bucket, prefix, language_code, settings):
+        self.s3_client = s3_client
+        self.transcribe_client = transcribe_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.language_code = language_code
+        self.settings = settings
+
+    def media_key(self, job_name):
+        return f"{self.prefix}{job_name}.flac"
+
+    def output_key(self, job_name):
+        return f"{self.prefix}{job_name}.json"
+
+    def upload(self, job_name, segment_path):
+        self.s3_client.upload_file(segment_path, self.bucket, self.media_key(job_name))
+
+    def start(self, job_name):
+        """
+        Starts the job of an uploaded segment. Starting it twice is harmless.
+        """
+        try:
+            self.transcribe_client.start_transcription_job(
+                TranscriptionJobName=job_name,
+                LanguageCode=self.language_code,
+                Media={'MediaFileUri': f"s3://{self.bucket}/{self.media_key(job_name)}"},
+                OutputBucketName=self.bucket,
+                OutputKey=self.output_key(job_name),
+                Settings=self.settings
+            )
+        except self.transcribe_client.exceptions.ConflictException:
+            logger.info("Segment job %s already exists.", job_name)
+
+    def status(self, job_name):
+        """
+        Returns (status, failure_reason) of a started job.
+        """
+        job = self.transcribe_client.get_transcription_job(TranscriptionJobName=job_name)['TranscriptionJob']
+        return job['TranscriptionJobStatus'], job.get('FailureReason')
+
+    def output(self, job_name):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.output_key(job_name))
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def cleanup(self, job_name):
+        for key in (self.media_key(job_name), self.output_key(job_name)):
+            self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+
+def transcribe_segmented(media_path, backend, job_name, work_dir, max_concurrency=SEGMENT_CONCURRENCY,
+                         target_seconds=SEGMENT_SECONDS, overlap_seconds=SEGMENT_OVERLAP_SECONDS):
+    """
+    Splits the recording at silences, transcribes the segments concurrently
+    (at most max_concurrency at a time) and stitches the results, all in this
+    process. backend.transcribe(segment_job_name, segment_path) must return
+    the Transcribe output JSON of that segment. Used by the benchmark;
+    transcribe.py runs segmented jobs asynchronously instead.
+    Returns (transcript_json, stats).
+    """
+    duration, segments = split_recording(media_path, work_dir, target_seconds, overlap_seconds)
+
+    def run(segment):
+        try:
+            transcript_json = backend.transcribe(segment_job_name(job_name, segment["index"]), segment["path"])
+        finally:
+            os.remove(segment["path"])
+        return segment["cutStart"], segment["cutEnd"], segment["offset"], transcript_json
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(segments)))) as executor:
+        parts = list(executor.map(run, segments))
+    stats = {
+        "duration_seconds": duration,
+        "segments": len(segments),
+        "transcribe_ms": int((time.monotonic() - started) * 1000)
+    }
+    return stitch_transcripts(parts, job_name, overlap_seconds), stats
@@ -0,0 +1,461 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from aws_clients import BUCKET_NAME, BUCKET_REGION, get_s3_client
+from audio_transcode import ensure_audio, recording_kind
+from bedrock import INVOKER, MODEL_ID, cached_text_invoke
+from file_metadata import ingest_keys
+from incremental_summary import summarize_sources
+from instrumentation import instrumented, stage
+from patient_manifest import CONFLICT_ERRORS, record_objects
+from transcribe import complete_job, start_job
+from transcript_turns import load_turns, turns_text
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Server-side session pipeline, driven by S3 ObjectCreated events of the
+# patient folders (EventBridge or bucket notifications):
+#   1. a recording lands in id_<patient>/<name>.mp4|.mp3|...: its audio is
+#      extracted if needed and a Transcribe job is started (transcribe.py,
+#      which reuses the transcript of identical recordings);
+#   2. the transcript lands in id_<patient>/<name>.json (written by the
+#      transcribe.py completion handler): the per-session bullet summary is
+#      generated with the transcription prompt of settings.json and stored in
+#      id_<patient>/output/Summary/<name>.session.txt.
+# Each recording's progress is kept in PIPELINES_PREFIX<patient>/<name>.json
+# (conditional writes, so duplicate events do not run a stage twice). Every
+# stage is idempotent; a scheduled {"action": "resume"} invocation retries
+# throttled or failed stages and completes jobs whose events were missed.
+# Finished (COMPLETED or FAILED) records move to DONE_PIPELINES_PREFIX, so
+# resume only lists pipelines that still have work.
+PIPELINES_PREFIX = "session-pipelines/"
+DONE_PIPELINES_PREFIX = "session-pipelines-done/"
+FINISHED_STAGES = ("COMPLETED", "FAILED")
+SESSION_SUMMARY_SUFFIX = ".session.txt"
+MAX_ATTEMPTS = int(os.environ.get("PIPELINE_MAX_ATTEMPTS", "5"))
+RETRY_DELAY = 60
+LEASE_SECONDS = 900
+
+# The prompts are read from the app's settings.json, deployed next to this
+# module (or at SETTINGS_PATH); ../src/settings.json is used in a checkout.
+SETTINGS_PATHS = [
+    os.environ.get("SETTINGS_PATH", ""),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"),
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "settings.json")
+]
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+_settings = None
+
+
+def json_response(status_code, body):
+    return {"statusCode": status_code, "headers": CORS_HEADERS, "body": json.dumps(body, ensure_ascii=False)}
+
+
+def load_settings():
+    """
+    Returns {"system_instructions", "prompt", "max_tokens"} of the session summary.
+    """
+    global _settings
+    if _settings is None:
+        path = next((path for path in SETTINGS_PATHS if path and os.path.exists(path)), None)
+        if path is None:
+            raise RuntimeError("settings.json not found; deploy it with the function or set SETTINGS_PATH")
+        with open(path, encoding="utf-8") as settings_file:
+            settings = json.load(settings_file)
+        _settings = {
+            "system_instructions": settings.get("transcription_system_instructions", ""),
+            "prompt": settings.get("transcription_prompt", ""),
+            "max_tokens": int(settings.get("max_tokens", 4096))
+        }
+    return _settings
+
+
+def settings_digest(settings):
+    text = json.dumps([MODEL_ID, settings["system_instructions"], settings["prompt"]], ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def pipeline_key(patient_id, base_name, prefix=PIPELINES_PREFIX):
+    return f"{prefix}{patient_id}/{base_name}.json"
+
+
+def transcript_key(patient_id, base_name):
+    return f"id_{patient_id}/{base_name}.json"
+
+
+def session_summary_key(patient_id, base_name):
+    return f"id_{patient_id}/output/Summary/{base_name}{SESSION_SUMMARY_SUFFIX}"
+
+
+def read_pipeline(s3_client, patient_id, base_name):
+    """
+    Returns (record, etag), or (None, None) for recordings without a pipeline.
+    A finished record is returned with etag None: a pipeline that is started
+    again is written back to PIPELINES_PREFIX as a new record.
+    """
+    for prefix in (PIPELINES_PREFIX, DONE_PIPELINES_PREFIX):
+        try:
+            response = s3_client.get_object(Bucket=BUCKET_NAME, Key=pipeline_key(patient_id, base_name, prefix))
+        except s3_client.exceptions.NoSuchKey:
+            continue
+        record = json.loads(response["Body"].read().decode("utf-8"))
+        return record, response["ETag"] if prefix == PIPELINES_PREFIX else None
+    return None, None
+
+
+def write_pipeline(s3_client, record, etag):
+    """
+    Writes the record if it is still at etag (or still missing, when etag is
+    None). Returns the new etag, or None if another invocation changed it first.
+    A finished record is then moved to DONE_PIPELINES_PREFIX.
+    """
+    record["updatedAt"] = int(time.time())
+    body = json.dumps(record, ensure_ascii=False).encode("utf-8")
+    key = pipeline_key(record["patientID"], record["baseName"])
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        response = s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=body, ContentType="application/json", **condition)
+    except s3_client.exceptions.ClientError as e:
+        # NoSuchKey: the record was moved to DONE_PIPELINES_PREFIX meanwhile.
+        if e.response.get("Error", {}).get("Code") in CONFLICT_ERRORS + ("NoSuchKey",):
+            return None
+        raise
+    if record["stage"] in FINISHED_STAGES:
+        # Written to the done prefix first, so read_pipeline always finds it.
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=pipeline_key(record["patientID"], record["baseName"], DONE_PIPELINES_PREFIX),
+            Body=body,
+            ContentType="application/json"
+        )
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=key)
+    return response["ETag"]
+
+
+def new_record(patient_id, base_name, file_name=None):
+    now = int(time.time())
+    return {
+        "patientID": patient_id,
+        "baseName": base_name,
+        "fileName": file_name,
+        "stage": "TRANSCRIBING",
+        "attempts": 0,
+        "transcriptKey": transcript_key(patient_id, base_name),
+        "summaryKey": session_summary_key(patient_id, base_name),
+        "createdAt": now,
+        "history": []
+    }
+
+
+def set_stage(record, stage_name, **fields):
+    record.update(stage=stage_name, **fields)
+    record["history"] = (record.get("history", []) + [{"stage": stage_name, "at": int(time.time())}])[-20:]
+
+
+def fail_or_retry(record, error):
+    """
+    Counts a failed attempt: the stage is retried by the next resume, or the
+    pipeline fails after MAX_ATTEMPTS.
+    """
+    record["attempts"] = record.get("attempts", 0) + 1
+    record.update(error=str(error), retryAfter=int(time.time()) + RETRY_DELAY * 2 ** min(record["attempts"], 5))
+    record.pop("claimedAt", None)
+    if record["attempts"] >= MAX_ATTEMPTS:
+        set_stage(record, "FAILED")
+
+
+def transcribe_stage(s3_client, record, etag):
+    """
+    Starts (or reuses) the Transcribe job of the record's recording.
+    Returns (record, etag).
+    """
+    patient_id, file_name = record["patientID"], record["fileName"]
+    try:
+        with stage("pipeline.transcribe"):
+            if recording_kind(file_name) == "video":
+                # Extract the audio here rather than in transcribe.py's
+                # asynchronous worker, which is a different function.
+                record_objects(s3_client, BUCKET_NAME, [ensure_audio(s3_client, BUCKET_NAME, patient_id, file_name)])
+            response = start_job(patient_id, file_name)
+        body = json.loads(response["body"])
+        if response["statusCode"] >= 400:
+            raise RuntimeError(body.get("error", "Could not start transcription"))
+    except Exception as e:
+        logger.warning("Transcription of %s/%s not started: %s", patient_id, file_name, e)
+        fail_or_retry(record, e)
+        return record, write_pipeline(s3_client, record, etag)
+
+    record.update(jobId=body["jobId"], error=None, retryAfter=None)
+    etag = write_pipeline(s3_client, record, etag)
+    if etag is not None and body.get("status") == "COMPLETED":
+        # A transcript of the same recording already existed.
+        return summarize_stage(s3_client, record, etag)
+    return record, etag
+
+
+def summarize_stage(s3_client, record, etag):
+    """
+    Generates and stores the session summary of the record's transcript,
+    unless the stored one was made from this transcript with the current
+    settings. Returns (record, etag).
+    """
+    settings = load_settings()
+    digest = settings_digest(settings)
+    source_key = record["transcriptKey"]
+    source_etag = s3_client.head_object(Bucket=BUCKET_NAME, Key=source_key)["ETag"].strip('"')
+    try:
+        existing = s3_client.head_object(Bucket=BUCKET_NAME, Key=record["summaryKey"]).get("Metadata", {})
+    except s3_client.exceptions.ClientError:
+        existing = {}
+    if existing.get("source-etag") == source_etag and existing.get("settings") == digest:
+        set_stage(record, "COMPLETED", error=None, retryAfter=None)
+        record.pop("claimedAt", None)
+        return record, write_pipeline(s3_client, record, etag)
+
+    # Claim the stage so duplicate events do not summarize the same transcript twice.
+    set_stage(record, "SUMMARIZING", claimedAt=int(time.time()))
+    etag = write_pipeline(s3_client, record, etag)
+    if etag is None:
+        logger.info("Session summary of %s is being generated by another invocation", source_key)
+        return record, None
+
+    try:
+        with stage("pipeline.summarize"):
+            text = turns_text(load_turns(s3_client, BUCKET_NAME, source_key))
+            if not text.strip():
+                raise ValueError("The transcript is empty")
+            invoke = cached_text_invoke(INVOKER, settings["system_instructions"], record["patientID"])
+            summary, stats = summarize_sources(
+                [{"name": record["baseName"], "text": text}], invoke, settings["prompt"], settings["max_tokens"]
+            )
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=record["summaryKey"],
+            Body=summary.encode("utf-8"),
+            ContentType="text/plain; charset=utf-8",
+            Metadata={"source-etag": source_etag, "settings": digest}
+        )
+        record_objects(s3_client, BUCKET_NAME, [record["summaryKey"]])
+    except Exception as e:
+        logger.exception("Session summary of %s failed", source_key)
+        fail_or_retry(record, e)
+        return record, write_pipeline(s3_client, record, etag)
+
+    logger.info("Session summary of %s stored: %s", source_key, stats)
+    set_stage(record, "COMPLETED", error=None, retryAfter=None, transcriptEtag=source_etag)
+    record.pop("claimedAt", None)
+    return record, write_pipeline(s3_client, record, etag)
+
+
+def on_recording(s3_client, patient_id, file_name):
+    """
+    Stage 1 for a recording that was just uploaded.
+    """
+    base_name, _ = os.path.splitext(file_name)
+    recording_etag = s3_client.head_object(Bucket=BUCKET_NAME, Key=f"id_{patient_id}/{file_name}")["ETag"].strip('"')
+    record, etag = read_pipeline(s3_client, patient_id, base_name)
+    if record is not None and record.get("recordingEtag") == recording_etag and record["stage"] != "FAILED":
+        # A duplicate event for a recording that is already in the pipeline.
+        return record
+    record = new_record(patient_id, base_name, file_name)
+    record["recordingEtag"] = recording_etag
+    set_stage(record, "TRANSCRIBING")
+    etag = write_pipeline(s3_client, record, etag)
+    if etag is None:
+        return read_pipeline(s3_client, patient_id, base_name)[0]
+    return transcribe_stage(s3_client, record, etag)[0]
+
+
+def on_transcript(s3_client, patient_id, base_name):
+    """
+    Stage 2 for a transcript that was just written, including transcripts of
+    recordings transcribed on request (without a pipeline record yet).
+    """
+    record, etag = read_pipeline(s3_client, patient_id, base_name)
+    if record is None:
+        record = new_record(patient_id, base_name)
+    elif record["stage"] == "FAILED":
+        # A new transcript gives the stage a fresh set of attempts.
+        record["attempts"] = 0
+    elif record["stage"] == "SUMMARIZING" and record.get("claimedAt", 0) > time.time() - LEASE_SECONDS:
+        return record
+    return summarize_stage(s3_client, record, etag)[0]
+
+
+def resume(s3_client, now=None):
+    """
+    Advances every pipeline that is waiting: stages due for a retry, stale
+    claims, and Transcribe jobs whose completion was not processed yet. Only
+    PIPELINES_PREFIX is listed; finished records found there (written before
+    they were moved on completion) are moved now.
+    Returns the records that changed stage or started their job.
+    """
+    now = now or time.time()
+    advanced = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=PIPELINES_PREFIX):
+        for item in page.get("Contents", []):
+            patient_id, _, name = item["Key"][len(PIPELINES_PREFIX):].partition("/")
+            record, etag = read_pipeline(s3_client, patient_id, name[:-len(".json")])
+            if record is not None and record["stage"] in FINISHED_STAGES and etag is not None:
+                write_pipeline(s3_client, record, etag)
+                continue
+            if record is None or record["stage"] in FINISHED_STAGES or (record.get("retryAfter") or 0) > now:
+                continue
+            before = (record["stage"], record.get("jobId"))
+            try:
+                if record["stage"] == "TRANSCRIBING" and not record.get("jobId"):
+                    record, _ = transcribe_stage(s3_client, record, etag)
+                elif record["stage"] == "TRANSCRIBING":
+                    job = complete_job(record["jobId"])
+                    if job is not None and job["status"] == "COMPLETED":
+                        record, _ = summarize_stage(s3_client, record, etag)
+                    elif job is None or job["status"] == "FAILED":
+                        set_stage(record, "FAILED", error=(job or {}).get("error", "Unknown transcription job"))
+                        write_pipeline(s3_client, record, etag)
+                elif record.get("claimedAt", 0) < now - LEASE_SECONDS:
+                    record, _ = summarize_stage(s3_client, record, etag)
+            except Exception:
+                logger.exception("Could not resume pipeline %s", item["Key"])
+            if (record["stage"], record.get("jobId")) != before:
+                advanced.append(record)
+    return advanced
+
+
+def pipeline_status(s3_client, patient_id, file_name=None):
+    """
+    The pipeline record of one recording (by file or base name), or of all
+    recordings of the patient.
+    """
+    if file_name:
+        record, _ = read_pipeline(s3_client, patient_id, os.path.splitext(file_name)[0])
+        return record
+    names = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for prefix in (PIPELINES_PREFIX, DONE_PIPELINES_PREFIX):
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=f"{prefix}{patient_id}/"):
+            for item in page.get("Contents", []):
+                names.add(item["Key"].rsplit("/", 1)[-1][:-len(".json")])
+    records = [read_pipeline(s3_client, patient_id, name)[0] for name in sorted(names)]
+    return [record for record in records if record is not None]
+
+
+@instrumented("session_pipeline")
+def lambda_handler(event, context):
+    """
+    - S3 ObjectCreated events (notifications or EventBridge) for
+      id_<patient>/<recording> and id_<patient>/<transcript>.json: runs the
+      next stage of the recording's pipeline.
+    - {"action": "resume"} (scheduled): retries waiting stages.
+    - GET ?patientId=&fileName=: the pipeline of one recording;
+      GET ?patientId=: the pipelines of all of the patient's recordings.
+    """
+    if event.get('httpMethod') == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': ''}
+
+    s3_client = get_s3_client()
+    INVOKER.set_deadline(context)
+    if event.get('action') == 'resume':
+        advanced = resume(s3_client)
+        return {'statusCode': 200, 'body': json.dumps({"advanced": len(advanced)})}
+
+    if event.get('httpMethod') == 'GET':
+        params = event.get('queryStringParameters') or {}
+        if not params.get('patientId') or '/' in params['patientId']:
+            return json_response(400, {"error": "Missing or invalid patientId"})
+        result = pipeline_status(s3_client, params['patientId'], params.get('fileName'))
+        if result is None:
+            return json_response(404, {"error": "No pipeline for this recording"})
+        return json_response(200, {"pipelines": result} if isinstance(result, list) else result)
+
+    processed = []
+    for key in ingest_keys(event):
+        parts = key.split("/")
+        if len(parts) != 2 or not parts[0].startswith("id_") or not parts[1]:
+            continue
+        patient_id, name = parts[0][len("id_"):], parts[1]
+        try:
+            if recording_kind(name) is not None:
+                record = on_recording(s3_client, patient_id, name)
+            elif name.endswith(".json"):
+                record = on_transcript(s3_client, patient_id, name[:-len(".json")])
+            else:
+                continue
+            processed.append({"key": key, "stage": record["stage"] if record else None})
+        except Exception:
+            logger.exception("Pipeline stage failed for %s", key)
+            processed.append({"key": key, "error": True})
+    return {'statusCode': 200, 'body': json.dumps({"processed": processed}, ensure_ascii=False)}
+
+
+def main():
+    """
+    Runs the pipeline end to end locally on a recording: S3 and Transcribe
+    are moto's in-memory services (the Transcribe output is the --transcript
+    file, or a stub) and Bedrock is a fake client. Needs moto.
+    """
+    global INVOKER
+    from moto import mock_aws
+    from bedrock_invoke import BedrockInvoker
+    from benchmarks.fake_bedrock import FakeBedrockRuntime
+    import transcribe
+
+    parser = argparse.ArgumentParser(description=main.__doc__.strip().split("\n")[0])
+    parser.add_argument("recording")
+    parser.add_argument("--patient", default="1")
+    parser.add_argument("--transcript", help="Transcribe output JSON to return for the recording")
+    parser.add_argument("--bedrock-latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.transcript:
+        with open(args.transcript, "rb") as transcript_file:
+            output = transcript_file.read()
+    else:
+        text = f"תמלול לדוגמה של {os.path.basename(args.recording)}"
+        output = json.dumps({"results": {"transcripts": [{"transcript": text}], "items": []}}, ensure_ascii=False).encode("utf-8")
+
+    with mock_aws():
+        INVOKER = BedrockInvoker(INVOKER.endpoints, client_factory=lambda region: FakeBedrockRuntime(latency=args.bedrock_latency))
+        s3_client = get_s3_client()
+        if BUCKET_REGION == "us-east-1":
+            s3_client.create_bucket(Bucket=BUCKET_NAME)
+        else:
+            s3_client.create_bucket(Bucket=BUCKET_NAME, CreateBucketConfiguration={"LocationConstraint": BUCKET_REGION})
+        file_name = os.path.basename(args.recording)
+        key = f"id_{args.patient}/{file_name}"
+        s3_client.upload_file(args.recording, BUCKET_NAME, key)
+
+        def deliver(object_key):
+            event = {"Records": [{"s3": {"object": {"key": object_key}}}]}
+            print(json.dumps({"event": object_key, "result": json.loads(lambda_handler(event, None)["body"])}, ensure_ascii=False))
+
+        deliver(key)
+        record = pipeline_status(s3_client, args.patient, file_name)
+        if record.get("jobId") and record["stage"] == "TRANSCRIBING":
+            # Stand-in for Transcribe writing its output and for the completion
+            # event transcribe.py receives.
+            s3_client.put_object(Bucket=BUCKET_NAME, Key=f"{record['jobId']}.json", Body=output)
+            transcribe.complete_job(record["jobId"], "COMPLETED")
+            deliver(record["transcriptKey"])
+        record = pipeline_status(s3_client, args.patient, file_name)
+        print(json.dumps(record, ensure_ascii=False, indent=2))
+        if record["stage"] == "COMPLETED":
+            summary = s3_client.get_object(Bucket=BUCKET_NAME, Key=record["summaryKey"])["Body"].read()
+            print(summary.decode("utf-8"))
+    return 0 if record["stage"] == "COMPLETED" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import json
+import pytest
+from bedrock_batch import LocalBatchBackend, collect_batch, result_counts, submit_batch
+
+BUCKET = "local-bucket"
+
+
+@pytest.fixture
+def s3():
+    moto = pytest.importorskip("moto")
+    import boto3
+
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def put_transcript(s3, patient_id, name, text):
+    body = {"results": {"transcripts": [{"transcript": text}], "items": []}}
+    s3.put_object(Bucket=BUCKET, Key=f"id_{patient_id}/{name}", Body=json.dumps(body).encode("utf-8"))
+
+
+def fake_model(model_input):
+    text = model_input["messages"][0]["content"][-1]["text"]
+    if "unanswerable" in text:
+        raise RuntimeError("ValidationException: input is too long")
+    return {"content": [{"type": "text", "text": "summary of " + text.split("\n")[-1]}]}
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalBatchBackend(str(tmp_path), fake_model)
+
+
+def submit(s3, backend, patient_ids=None):
+    return submit_batch(s3, BUCKET, backend, "nightly", "Be brief.", "Summarize", 512, patient_ids)
+
+
+def summaries(s3):
+    objects = s3.list_objects_v2(Bucket=BUCKET).get("Contents", [])
+    return sorted(obj["Key"] for obj in objects if "/output/Summary/" in obj["Key"])
+
+
+def test_submit_writes_one_record_per_patient_with_sources(s3, backend, tmp_path):
+    put_transcript(s3, "1", "visit.json", "back pain")
+    put_transcript(s3, "2", "visit.json", "headache")
+    s3.put_object(Bucket=BUCKET, Key="id_3/", Body=b"")
+
+    result = submit(s3, backend)
+    assert result == {"job_id": "nightly", "records": 2, "skipped": ["3"]}
+    with open(tmp_path / "nightly.jsonl", encoding="utf-8") as input_file:
+        records = [json.loads(line) for line in input_file]
+    assert [record["recordId"] for record in records] == ["id_1", "id_2"]
+    assert records[0]["modelInput"]["system"] == "Be brief."
+    assert records[0]["modelInput"]["max_tokens"] == 512
+    assert backend.status("nightly") == "Completed"
+
+
+def test_submit_without_sources_fails(s3, backend):
+    with pytest.raises(ValueError):
+        submit(s3, backend, ["missing"])
+
+
+def test_partial_job_writes_the_answered_records(s3, backend):
+    put_transcript(s3, "1", "visit.json", "back pain")
+    put_transcript(s3, "2", "visit.json", "unanswerable")
+    submit(s3, backend)
+    assert backend.status("nightly") == "PartiallyCompleted"
+
+    result = collect_batch(s3, BUCKET, backend, "nightly")
+    assert result == {
+        "status": "PartiallyCompleted",
+        "written": ["id_1/output/Summary/batch-nightly.txt"],
+        "existing": [],
+        "failed": ["id_2"]
+    }
+    assert summaries(s3) == ["id_1/output/Summary/batch-nightly.txt"]
+    body = s3.get_object(Bucket=BUCKET, Key="id_1/output/Summary/batch-nightly.txt")["Body"].read()
+    assert body.decode("utf-8") == "summary of back pain"
+
+
+def test_collecting_again_writes_nothing_new(s3, backend):
+    put_transcript(s3, "1", "visit.json", "back pain")
+    submit(s3, backend)
+    first = collect_batch(s3, BUCKET, backend, "nightly")
+    key = "id_1/output/Summary/batch-nightly.txt"
+    etag = s3.head_object(Bucket=BUCKET, Key=key)["ETag"]
+
+    second = collect_batch(s3, BUCKET, backend, "nightly")
+    assert first["written"] == [key]
+    assert (second["written"], second["existing"]) == ([], [key])
+    assert s3.head_object(Bucket=BUCKET, Key=key)["ETag"] == etag
+
+
+def test_unfinished_jobs_are_not_collected(s3, backend):
+    result = collect_batch(s3, BUCKET, backend, "not-submitted")
+    assert result == {"status": "InProgress", "written": [], "existing": [], "failed": []}
+
+
+def test_logged_results_hold_counts_only():
+    result = {"status": "Completed", "written": ["id_1/output/Summary/batch-x.txt"], "existing": [], "failed": ["id_2"]}
+    assert result_counts(result) == {"status": "Completed", "written": 1, "existing": 0, "failed": 1}
@@ -0,0 +1,197 @@
+import json
+import pytest
+from botocore.exceptions import ClientError
+import bedrock
+from bedrock_invoke import AdaptiveLimiter, BedrockInvoker, BedrockUnavailable
+from benchmarks.fake_bedrock import FakeBedrockRuntime
+
+PRIMARY = ("us-east-1", "model-a")
+SECONDARY = ("eu-central-1", "model-b")
+BODY = json.dumps({"messages": [{"role": "user", "content": "Summarize"}]})
+
+
+class FakeClock:
+    """
+    A monotonic clock that only moves when sleep() is called.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Context:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def make_invoker(clients, clock, endpoints=(PRIMARY,), **kwargs):
+    kwargs.setdefault("delay", lambda attempt: 0.5 * 2 ** attempt)
+    return BedrockInvoker(endpoints, client_factory=clients.__getitem__, sleep=clock.sleep, clock=clock, **kwargs)
+
+
+def recover_after(fake, clock, throttled_sleeps):
+    """
+    Makes fake answer normally once the invoker slept throttled_sleeps times.
+    """
+    sleep = clock.sleep
+
+    def sleep_and_recover(seconds):
+        sleep(seconds)
+        if len(clock.sleeps) >= throttled_sleeps:
+            fake.throttle_rate = 0.0
+
+    clock.sleep = sleep_and_recover
+
+
+def test_throttled_calls_are_retried_with_exponential_backoff():
+    clock = FakeClock()
+    fake = FakeBedrockRuntime(throttle_rate=1.0)
+    recover_after(fake, clock, 2)
+    invoker = make_invoker({"us-east-1": fake}, clock)
+
+    response = invoker.invoke_model(BODY)
+    assert json.loads(response["body"].read())["model"] == "model-a"
+    assert clock.sleeps == [0.5, 1.0]
+    assert (fake.calls, fake.errors) == (3, 2)
+
+
+def test_retry_after_header_sets_the_minimum_wait():
+    clock = FakeClock()
+    fake = FakeBedrockRuntime(throttle_rate=1.0, retry_after=4)
+    recover_after(fake, clock, 1)
+    invoker = make_invoker({"us-east-1": fake}, clock)
+
+    invoker.invoke_model(BODY)
+    assert clock.sleeps == [4.0]
+
+
+def test_retry_budget_gives_up_with_bedrock_unavailable():
+    clock = FakeClock()
+    fake = FakeBedrockRuntime(throttle_rate=1.0)
+    invoker = make_invoker({"us-east-1": fake}, clock, attempts_per_endpoint=10, max_retry_wait=3)
+
+    with pytest.raises(BedrockUnavailable):
+        invoker.invoke_model(BODY)
+    assert sum(clock.sleeps) <= 3
+
+
+def test_limiter_halves_once_per_round_and_grows_while_saturated():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(initial=4, maximum=8, clock=clock)
+    started = [limiter.acquire() for _ in range(4)]
+    clock.now = 1.0
+
+    limiter.on_throttle(started[0])
+    assert limiter.limit == 2
+    # Calls started before the cut do not cut the limit again.
+    limiter.on_throttle(started[1])
+    assert limiter.limit == 2
+    for _ in range(4):
+        limiter.release()
+
+    clock.now = 2.0
+    limiter.on_throttle(limiter.acquire())
+    assert limiter.limit == 1
+    limiter.release()
+
+    limiter.acquire()
+    limiter.on_success()
+    assert limiter.limit == 2
+    limiter.release()
+    # Not saturated: a success does not grow the limit.
+    limiter.acquire()
+    limiter.on_success()
+    assert limiter.limit == 2
+    limiter.release()
+
+
+def test_limiter_gives_up_waiting_for_a_slot_at_the_deadline():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(initial=1, clock=clock)
+    limiter.acquire()
+    with pytest.raises(BedrockUnavailable):
+        limiter.acquire(deadline=0.0)
+
+
+def test_throttles_cut_the_endpoint_limit():
+    clock = FakeClock()
+    fake = FakeBedrockRuntime(throttle_rate=1.0)
+    recover_after(fake, clock, 1)
+    invoker = make_invoker({"us-east-1": fake}, clock)
+
+    invoker.invoke_model(BODY)
+    limiter = invoker.limiters[PRIMARY]
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+
+def test_access_denied_fails_over_to_the_next_endpoint_without_waiting():
+    clock = FakeClock()
+    denied = FakeBedrockRuntime(throttle_rate=1.0, error_code="AccessDeniedException")
+    healthy = FakeBedrockRuntime()
+    invoker = make_invoker({"us-east-1": denied, "eu-central-1": healthy}, clock, endpoints=(PRIMARY, SECONDARY))
+
+    response = invoker.invoke_model(BODY)
+    assert json.loads(response["body"].read())["model"] == "model-b"
+    assert (denied.calls, healthy.calls) == (1, 1)
+    assert clock.sleeps == []
+
+
+def test_an_endpoint_that_keeps_throttling_cools_down():
+    clock = FakeClock()
+    throttled = FakeBedrockRuntime(throttle_rate=1.0)
+    healthy = FakeBedrockRuntime()
+    invoker = make_invoker({"us-east-1": throttled, "eu-central-1": healthy}, clock,
+                           endpoints=(PRIMARY, SECONDARY), attempts_per_endpoint=2)
+
+    invoker.invoke_model(BODY)
+    assert throttled.calls == 2
+    assert invoker.ordered_endpoints() == [SECONDARY, PRIMARY]
+    invoker.invoke_model(BODY)
+    assert (throttled.calls, healthy.calls) == (2, 2)
+
+
+def test_retries_stop_before_the_deadline():
+    clock = FakeClock()
+    fake = FakeBedrockRuntime(throttle_rate=1.0)
+    invoker = make_invoker({"us-east-1": fake}, clock, delay=lambda attempt: 5.0)
+    invoker.set_deadline(Context(remaining_ms=6000), margin=3)
+
+    with pytest.raises(BedrockUnavailable):
+        invoker.invoke_model(BODY)
+    assert fake.calls == 1
+    assert clock.sleeps == []
+
+
+def test_errors_that_no_endpoint_can_serve_are_raised():
+    clock = FakeClock()
+    clients = {
+        "us-east-1": FakeBedrockRuntime(throttle_rate=1.0, error_code="AccessDeniedException"),
+        "eu-central-1": FakeBedrockRuntime(throttle_rate=1.0, error_code="AccessDeniedException")
+    }
+    invoker = make_invoker(clients, clock, endpoints=(PRIMARY, SECONDARY))
+
+    with pytest.raises(ClientError) as raised:
+        invoker.invoke_model(BODY)
+    assert raised.value.response["Error"]["Code"] == "AccessDeniedException"
+    assert clock.sleeps == []
+
+
+def test_handler_answers_500_when_every_endpoint_denies_access(monkeypatch):
+    fake = FakeBedrockRuntime(throttle_rate=1.0, error_code="AccessDeniedException")
+    monkeypatch.setattr(bedrock, "INVOKER", BedrockInvoker([PRIMARY], client_factory=lambda region: fake))
+
+    response = bedrock.lambda_handler({"body": json.dumps({"prompt": "Summarize", "bypass_cache": True})}, None)
+    assert response["statusCode"] == 500
+    assert "AccessDeniedException" in json.loads(response["body"])["error"]
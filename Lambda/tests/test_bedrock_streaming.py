@@ -0,0 +1,123 @@
+import json
+import time
+import threading
+import http.client
+import pytest
+import bedrock
+import bedrock_stream
+from bedrock_invoke import BedrockInvoker
+from benchmarks.fake_bedrock import FakeBedrockRuntime
+
+CHUNK_DELAY = 0.02
+TEXT = " ".join(f"word{i}" for i in range(15))
+PAYLOAD = {
+    "anthropic_version": "bedrock-2023-05-31",
+    "max_tokens": 100,
+    "messages": [{"role": "user", "content": [{"type": "text", "text": "Summarize"}]}]
+}
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeBedrockRuntime(chunk_delay=CHUNK_DELAY, text=TEXT)
+    invoker = BedrockInvoker([("us-east-1", bedrock.MODEL_ID)], client_factory=lambda region: fake)
+    monkeypatch.setattr(bedrock, "INVOKER", invoker)
+    return fake
+
+
+def parse_frame(frame):
+    event_line, data_line = frame.strip().split("\n")
+    return event_line[len("event: "):], json.loads(data_line[len("data: "):])
+
+
+def test_first_frame_is_emitted_before_the_last_chunk_is_read(fake):
+    frames = bedrock.stream_frames(bedrock.INVOKER, PAYLOAD, bypass_cache=True)
+    event, data = parse_frame(next(frames))
+    stream = fake.streams[-1]
+    assert event == "delta"
+    assert data == {"text": "word0 "}
+    assert stream.chunks_read < len(stream.events)
+
+    rest = [parse_frame(frame) for frame in frames]
+    assert stream.chunks_read == len(stream.events)
+    event, done = rest[-1]
+    assert event == "done"
+    result = json.loads(done["result"])
+    assert result["content"][0]["text"] == TEXT + " "
+    assert result["stop_reason"] == "end_turn"
+    assert done["time_to_first_token_ms"] < done["total_ms"] / 4
+
+
+def test_closing_the_stream_early_releases_the_model_call(fake):
+    frames = bedrock.stream_frames(bedrock.INVOKER, PAYLOAD, bypass_cache=True)
+    next(frames)
+    frames.close()
+    limiter = bedrock.INVOKER.limiters[("us-east-1", bedrock.MODEL_ID)]
+    assert fake.streams[-1].closed
+    assert limiter.in_flight == 0
+
+
+def test_server_writes_each_frame_as_it_arrives(fake):
+    server = bedrock_stream.ThreadingHTTPServer(("127.0.0.1", 0), bedrock_stream.StreamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        body = json.dumps({"prompt": "Summarize", "stream": True, "bypass_cache": True})
+        start = time.monotonic()
+        connection.request("POST", "/", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.getheader("Content-Type") == "text/event-stream"
+
+        first_line = response.readline()
+        first_frame_at = time.monotonic() - start
+        stream = fake.streams[-1]
+        assert first_line == b"event: delta\n"
+        assert stream.chunks_read < len(stream.events)
+
+        rest = response.read().decode("utf-8")
+        total = time.monotonic() - start
+        assert "event: done" in rest
+        assert first_frame_at < total / 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_rejects_empty_requests(fake):
+    server = bedrock_stream.ThreadingHTTPServer(("127.0.0.1", 0), bedrock_stream.StreamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        connection.request("POST", "/", json.dumps({"stream": True}), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 400
+        assert "error" in json.loads(response.read())
+        assert fake.calls == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_answers_500_when_the_request_cannot_be_built(fake, monkeypatch):
+    def fail(body):
+        raise RuntimeError("S3 unavailable")
+
+    monkeypatch.setattr(bedrock, "build_request", fail)
+    server = bedrock_stream.ThreadingHTTPServer(("127.0.0.1", 0), bedrock_stream.StreamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        connection.request("POST", "/", json.dumps({"prompt": "Summarize", "stream": True}),
+                           {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 500
+        assert response.getheader("Access-Control-Allow-Origin") == "*"
+        assert json.loads(response.read()) == {"error": "S3 unavailable"}
+        assert fake.calls == 0
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,44 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
+from instrumentation import instrumented, record
+
+
+def emf_records(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+
+
+def test_concurrent_invocations_keep_their_own_metrics(capsys):
+    both_running = threading.Barrier(2)
+
+    @instrumented("handler")
+    def handler(event, context):
+        both_running.wait(timeout=5)
+        record("Items", event["items"])
+        both_running.wait(timeout=5)
+        return {"statusCode": event["status"]}
+
+    threads = [
+        threading.Thread(target=handler, args=({"items": items, "status": status}, None))
+        for items, status in ((1, 200), (10, 404))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = emf_records(capsys.readouterr().out)
+    assert sorted((record["Status"], record["Items"]) for record in records) == [("200", 1), ("404", 10)]
+    assert instrumentation.current_invocation() is None
+
+
+def test_worker_threads_report_to_the_only_active_invocation(capsys):
+    @instrumented("handler")
+    def handler(event, context):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda value: record("Items", value), range(1, 5)))
+        return {"statusCode": 200}
+
+    handler({}, None)
+    assert emf_records(capsys.readouterr().out)[0]["Items"] == 10
@@ -0,0 +1,171 @@
+import pytest
+from transcribe_queue import (
+    BATCHES_PREFIX, DONE_BATCHES_PREFIX, FakeTranscribeBackend, MemoryProgressStore, MemoryQueue,
+    S3ProgressStore, TranscriptionScheduler
+)
+
+JOB_SECONDS = 100
+RETRY_DELAY = 30
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ThrottledAfterQueueing(FakeTranscribeBackend):
+    """
+    Jobs start, then fail as throttled (like a job throttled after its audio
+    was extracted) until `recovers` jobs were started.
+    """
+
+    def __init__(self, recovers, **kwargs):
+        super().__init__(**kwargs)
+        self.recovers = recovers
+
+    def status(self, job_id):
+        if self.started <= self.recovers:
+            return "FAILED", "LimitExceededException", True
+        return super().status(job_id)
+
+
+def make_scheduler(clock, limit=10, quota=3, backend=None):
+    backend = backend or FakeTranscribeBackend(limit=limit, job_seconds=JOB_SECONDS, clock=clock)
+    scheduler = TranscriptionScheduler(
+        MemoryQueue(clock=clock), backend, MemoryProgressStore(), quota=quota,
+        delay=lambda attempt: RETRY_DELAY, clock=clock
+    )
+    return scheduler, backend
+
+
+def statuses(scheduler, batch_id):
+    return [item["status"] for item in scheduler.progress.load(batch_id)["items"]]
+
+
+def test_tick_starts_no_more_than_the_quota():
+    clock = Clock()
+    scheduler, backend = make_scheduler(clock, quota=3)
+    batch = scheduler.submit([("1", f"rec{i}.mp3") for i in range(7)])
+
+    assert scheduler.tick() == {"capacity": 3, "started": 3, "throttled": 0}
+    assert backend.in_flight() == 3
+    # The running jobs use up the quota until they finish.
+    assert scheduler.tick() == {"capacity": 0, "started": 0, "throttled": 0}
+    assert len(scheduler.queue) == 4
+
+    clock.now += JOB_SECONDS
+    assert scheduler.tick()["started"] == 3
+    assert statuses(scheduler, batch["batchId"]).count("COMPLETED") == 3
+    assert backend.started == 6
+
+
+def test_throttled_starts_are_retried_after_their_delay():
+    clock = Clock()
+    scheduler, backend = make_scheduler(clock, limit=2, quota=5)
+    batch = scheduler.submit([("1", f"rec{i}.mp3") for i in range(4)])
+
+    assert scheduler.tick() == {"capacity": 5, "started": 2, "throttled": 1}
+    items = scheduler.progress.load(batch["batchId"])["items"]
+    assert [item["status"] for item in items] == ["IN_PROGRESS", "IN_PROGRESS", "RETRYING", "QUEUED"]
+    assert items[2]["attempts"] == 1
+    assert items[2]["nextAttemptAt"] == int(clock.now + RETRY_DELAY)
+    # The rest of the round waits too instead of hitting the limit again.
+    assert scheduler.queue.receive(10) == []
+
+    clock.now += JOB_SECONDS
+    assert scheduler.tick()["started"] == 2
+    assert statuses(scheduler, batch["batchId"]) == ["COMPLETED", "COMPLETED", "IN_PROGRESS", "IN_PROGRESS"]
+    assert backend.throttled == 1
+
+
+def test_jobs_throttled_after_starting_are_queued_again_with_a_delay():
+    clock = Clock()
+    backend = ThrottledAfterQueueing(recovers=1, limit=10, job_seconds=JOB_SECONDS, clock=clock)
+    scheduler, _ = make_scheduler(clock, quota=5, backend=backend)
+    batch = scheduler.submit([("1", "rec.mp3")])
+
+    assert scheduler.tick()["started"] == 1
+    assert scheduler.tick()["started"] == 0
+    item = scheduler.progress.load(batch["batchId"])["items"][0]
+    assert (item["status"], item["attempts"]) == ("RETRYING", 1)
+    assert len(scheduler.queue) == 1
+
+    clock.now += RETRY_DELAY - 1
+    assert scheduler.tick()["started"] == 0
+    clock.now += 1
+    assert scheduler.tick()["started"] == 1
+    clock.now += JOB_SECONDS
+    scheduler.tick()
+    assert statuses(scheduler, batch["batchId"]) == ["COMPLETED"]
+    assert scheduler.progress.load(batch["batchId"])["done"]
+
+
+def test_items_fail_after_the_last_attempt():
+    clock = Clock()
+    scheduler, backend = make_scheduler(clock, limit=0, quota=5)
+    scheduler.max_attempts = 2
+    batch = scheduler.submit([("1", "rec.mp3")])
+
+    scheduler.tick()
+    clock.now += RETRY_DELAY
+    scheduler.tick()
+    item = scheduler.progress.load(batch["batchId"])["items"][0]
+    assert item["status"] == "FAILED"
+    assert len(scheduler.queue) == 0
+    assert scheduler.progress.active() == []
+
+
+@pytest.fixture
+def s3():
+    moto = pytest.importorskip("moto")
+    import boto3
+
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="local-bucket")
+        yield client
+
+
+def keys(s3, prefix):
+    return [obj["Key"] for obj in s3.list_objects_v2(Bucket="local-bucket", Prefix=prefix).get("Contents", [])]
+
+
+def test_only_active_batches_are_listed(s3):
+    store = S3ProgressStore(s3, "local-bucket")
+    store.save({"batchId": "running", "done": False, "items": []})
+    store.save({"batchId": "finished", "done": True, "items": []})
+
+    assert [batch["batchId"] for batch in store.active()] == ["running"]
+    assert keys(s3, BATCHES_PREFIX) == [f"{BATCHES_PREFIX}running.json"]
+    assert keys(s3, DONE_BATCHES_PREFIX) == [f"{DONE_BATCHES_PREFIX}finished.json"]
+    assert store.load("finished")["done"]
+
+
+def test_done_batches_left_in_the_active_prefix_are_moved(s3):
+    store = S3ProgressStore(s3, "local-bucket")
+    # A done batch written before batches were moved on completion.
+    s3.put_object(Bucket="local-bucket", Key=f"{BATCHES_PREFIX}old.json",
+                  Body=b'{"batchId": "old", "done": true, "items": []}')
+
+    assert store.active() == []
+    assert keys(s3, BATCHES_PREFIX) == []
+    assert store.load("old")["batchId"] == "old"
+
+
+def test_finished_batches_leave_the_active_listing(s3):
+    clock = Clock()
+    backend = FakeTranscribeBackend(limit=10, job_seconds=JOB_SECONDS, clock=clock)
+    scheduler = TranscriptionScheduler(
+        MemoryQueue(clock=clock), backend, S3ProgressStore(s3, "local-bucket"), quota=5, clock=clock
+    )
+    batch = scheduler.submit([("1", "a.mp3"), ("2", "b.mp3")])
+
+    scheduler.tick()
+    assert [active["batchId"] for active in scheduler.progress.active()] == [batch["batchId"]]
+    clock.now += JOB_SECONDS
+    scheduler.tick()
+    assert scheduler.progress.active() == []
+    assert statuses(scheduler, batch["batchId"]) == ["COMPLETED", "COMPLETED"]
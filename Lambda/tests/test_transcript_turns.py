@@ -0,0 +1,46 @@
+import io
+import json
+import pytest
+from transcript_turns import build_turns, iter_transcript_items
+
+pytest.importorskip("ijson")
+
+OUTPUT = {
+    "jobName": "job",
+    "results": {
+        "transcripts": [{"transcript": "שלום \"רב\" \\ 😀"}],
+        "speaker_labels": {"speakers": 2, "segments": [
+            {"start_time": "0.0", "end_time": "1.0", "speaker_label": "spk_0", "items": []},
+            {"start_time": "1.0", "end_time": "2.5", "speaker_label": "spk_1", "items": []}
+        ]},
+        "items": [
+            {"type": "pronunciation", "start_time": "0.1", "end_time": "0.4", "score": 1234567.125e-3,
+             "alternatives": [{"confidence": "0.99", "content": "שלום"}]},
+            {"type": "punctuation", "alternatives": [{"confidence": "0.0", "content": ","}]},
+            {"type": "pronunciation", "start_time": "1.2", "end_time": "1.6",
+             "alternatives": [{"confidence": "0.9", "content": "\"רב\" \\ 😀 א"}]}
+        ]
+    }
+}
+
+
+def encoded(output):
+    # Non-ASCII as \u escapes (the emoji as a surrogate pair) and as raw UTF-8.
+    return [json.dumps(output).encode("utf-8"), json.dumps(output, ensure_ascii=False).encode("utf-8")]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64])
+def test_items_match_json_loads_across_read_boundaries(chunk_size):
+    expected = OUTPUT["results"]["items"]
+    for body in encoded(OUTPUT):
+        items = list(iter_transcript_items(io.BytesIO(body), chunk_size=chunk_size))
+        assert [item.pop("speaker_label", None) for item in items] == ["spk_0", None, "spk_1"]
+        assert items == expected
+
+
+def test_turns_take_speakers_from_segments():
+    turns = build_turns(iter_transcript_items(io.BytesIO(encoded(OUTPUT)[0])))
+    assert [(turn["speaker"], turn["text"]) for turn in turns] == [
+        ("spk_0", "שלום,"),
+        ("spk_1", "\"רב\" \\ \U0001F600 א")
+    ]
@@ -1,192 +1,891 @@
 import json
-import boto3
 import time
+import random
+import hashlib
 import logging
 import uuid
 import os
+import tempfile
+from aws_clients import BUCKET_NAME, get_lambda_client, get_s3_client, get_transcribe_client
+from audio_transcode import ensure_audio, find_audio, recording_kind
+from instrumentation import instrumented
+from patient_manifest import CONFLICT_ERRORS, record_objects
+from segmented_transcribe import (SEGMENT_CONCURRENCY, TranscribeBackend, parse_segment_job_name, segment_job_name,
+                                  split_recording, stitch_transcripts)
+from transcript_turns import load_turns, store_turns, turns_key, turns_text
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Constants for S3 bucket
-S3_BUCKET = 'BUCKET_NAME'
+S3_BUCKET = BUCKET_NAME
 
+# Job records (patient, file, status) are kept under this prefix so the
+# completion handler and the status endpoint can resolve a job by its name.
+JOBS_PREFIX = 'transcribe-jobs/'
+
+# Transcription index: maps (patient, media ETag, Transcribe settings) to the
+# job that transcribed it, so repeated requests reuse or attach to that job.
+INDEX_PREFIX = 'transcribe-index/'
+
+LANGUAGE_CODE = 'he-IL'
+TRANSCRIBE_SETTINGS = {
+    'ShowSpeakerLabels': True,
+    'MaxSpeakerLabels': 2
+}
+
+# Job records are updated with conditional writes; an update that keeps losing
+# to concurrent ones gives up after this many attempts.
+MAX_UPDATE_ATTEMPTS = 10
+
+# A job whose record has not changed for this long (e.g. its worker hit the
+# Lambda timeout) is treated as stuck: duplicate requests start a new job
+# instead of attaching to it.
+STALE_JOB_SECONDS = int(os.environ.get('TRANSCRIBE_STALE_SECONDS', str(4 * 3600)))
+
+# An index entry is claimed just before its job is recorded. A claim whose
+# job still has no record after this many seconds was abandoned (the request
+# failed in between), and the next request for the recording starts a new job.
+INDEX_CLAIM_GRACE_SECONDS = 60
+
+# Error codes Transcribe returns when the concurrent job quota is reached.
+THROTTLING_ERRORS = ('LimitExceededException', 'ThrottlingException', 'TooManyRequestsException')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+def json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(body)
+    }
+
+
+def job_record_key(job_name):
+    return f"{JOBS_PREFIX}{job_name}.json"
+
+
+def s3_object_exists(s3_client, key):
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=key)
+        return True
+    except s3_client.exceptions.ClientError:
+        return False
+
+
+def load_job_record(s3_client, job_name):
+    """
+    Returns (record, etag), or (None, None) for unknown jobs.
+    """
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=job_record_key(job_name))
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+
+def read_job_record(s3_client, job_name):
+    return load_job_record(s3_client, job_name)[0]
+
+
+def write_job_record(s3_client, record, etag=None):
+    """
+    Writes the record; with an etag, only if the record is still at it.
+    Returns the new etag, or None if another invocation changed it first.
+    """
+    record['updatedAt'] = int(time.time())
+    condition = {'IfMatch': etag} if etag else {}
+    try:
+        response = s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=job_record_key(record['jobName']),
+            Body=json.dumps(record).encode('utf-8'),
+            ContentType='application/json',
+            **condition
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in CONFLICT_ERRORS:
+            return None
+        raise
+    return response['ETag']
+
+
+def _retry_delay(attempt):
+    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def update_job_record(s3_client, job_name, mutate):
+    """
+    Applies mutate(record) to the job record with a conditional write,
+    re-reading and re-applying it if another invocation changed the record
+    meanwhile (e.g. a duplicate request attached an alias). mutate returns
+    False to leave the record unchanged. Returns the record, or None for
+    unknown jobs.
+    """
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        record, etag = load_job_record(s3_client, job_name)
+        if record is None or mutate(record) is False:
+            return record
+        if write_job_record(s3_client, record, etag):
+            return record
+        _retry_delay(attempt)
+    raise RuntimeError(f"Could not update transcription job {job_name}: too many concurrent updates")
+
+
+def fail_job(s3_client, record, error, **fields):
+    """
+    Marks a job FAILED (record is updated too).
+    """
+    record.update(status='FAILED', error=error, **fields)
+    update_job_record(s3_client, record['jobName'], lambda latest: latest.update(status='FAILED', error=error, **fields))
+
+
+def job_transcript_keys(record):
+    """
+    The transcript key of the job's recording, then those of the duplicate
+    recordings that attached to it.
+    """
+    return [record['transcriptKey']] + record.get('aliases', [])
+
+
+def is_stale(record):
+    """
+    True for an in-progress job whose record has not changed for STALE_JOB_SECONDS.
+    """
+    return time.time() - record.get('updatedAt', record.get('createdAt', 0)) > STALE_JOB_SECONDS
+
+
+def media_index_key(patient_id, etag):
+    digest = hashlib.sha256(json.dumps({
+        'patientID': patient_id,
+        'etag': etag.strip('"'),
+        'languageCode': LANGUAGE_CODE,
+        'settings': TRANSCRIBE_SETTINGS
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{INDEX_PREFIX}{digest}.json"
+
+
+def claim_index(s3_client, index_key, job_name, overwrite):
+    """
+    Points the index entry at job_name. Unless overwrite is set the write is
+    conditional, so only one of several concurrent requests claims the entry.
+    Returns False if another request claimed it first.
+    """
+    kwargs = {} if overwrite else {'IfNoneMatch': '*'}
+    try:
+        s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=index_key,
+            Body=json.dumps({'jobName': job_name, 'claimedAt': int(time.time())}).encode('utf-8'),
+            ContentType='application/json',
+            **kwargs
+        )
+        return True
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+
+
+def release_index(s3_client, index_key, job_name):
+    """
+    Deletes the index entry if it still points at job_name, for jobs that
+    were never recorded or started.
+    """
+    try:
+        index = s3_client.get_object(Bucket=S3_BUCKET, Key=index_key)
+    except s3_client.exceptions.NoSuchKey:
+        return
+    if json.loads(index['Body'].read().decode('utf-8')).get('jobName') == job_name:
+        s3_client.delete_object(Bucket=S3_BUCKET, Key=index_key)
+
+
+def find_existing_job(s3_client, index_key, transcript_key):
+    """
+    Returns a response for a recording that was already transcribed (or is
+    being transcribed) with the same settings, or None if a new job is needed.
+    """
+    try:
+        index = s3_client.get_object(Bucket=S3_BUCKET, Key=index_key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    entry = json.loads(index['Body'].read().decode('utf-8'))
+    job_name = entry['jobName']
+
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        record, etag = load_job_record(s3_client, job_name)
+        if record is None:
+            if time.time() - entry.get('claimedAt', 0) > INDEX_CLAIM_GRACE_SECONDS:
+                logger.warning("Transcription job %s was claimed but never recorded; starting a new job.", job_name)
+                return None
+            # Claimed by a request that is about to record the job.
+            _retry_delay(attempt)
+            continue
+        if record['status'] != 'IN_PROGRESS':
+            break
+        if record is not None and is_stale(record):
+            logger.warning("Transcription job %s has been in progress since %s; starting a new job.",
+                           job_name, record.get('updatedAt'))
+            return None
+        # Attach to the running job; its transcript is also written to this
+        # recording's transcript key when it completes. The write is
+        # conditional: if the job completes meanwhile, the record is re-read
+        # and the transcript copied below instead.
+        if transcript_key in job_transcript_keys(record) \
+                or write_job_record(s3_client, dict(record, aliases=record.get('aliases', []) + [transcript_key]), etag):
+            logger.info("Attaching to in-flight transcription job %s", job_name)
+            return json_response(202, {"jobId": job_name, "status": "IN_PROGRESS", "deduplicated": True})
+        _retry_delay(attempt)
+    else:
+        if record is None:
+            logger.warning("Transcription job %s is still not recorded; starting a new job.", job_name)
+            return None
+        raise RuntimeError(f"Could not attach to transcription job {job_name}: too many concurrent updates")
+
+    if record['status'] == 'COMPLETED':
+        try:
+            s3_client.head_object(Bucket=S3_BUCKET, Key=record['transcriptKey'])
+        except s3_client.exceptions.ClientError:
+            logger.info("Transcript of job %s no longer exists; transcribing again.", job_name)
+            return None
+        if transcript_key != record['transcriptKey']:
+            s3_client.copy_object(
+                Bucket=S3_BUCKET,
+                CopySource={'Bucket': S3_BUCKET, 'Key': record['transcriptKey']},
+                Key=transcript_key
+            )
+            record_objects(s3_client, S3_BUCKET, [transcript_key])
+        logger.info("Reusing transcript of job %s", job_name)
+        return json_response(200, {"jobId": job_name, "status": "COMPLETED", "deduplicated": True})
+
+    return None
+
+
+@instrumented("transcribe")
 def lambda_handler(event, context):
     """
-    AWS Lambda function that:
-      1. Verifies that the provided file exists in the patient's folder.
-      2. Starts an Amazon Transcribe job on the file.
-      3. Polls for the transcription job to complete.
-      4. Copies the transcript output to the patient's folder,
-         then deletes it from the bucket root.
-      5. Returns the transcript text.
-      
+    AWS Lambda function with four entry points:
+      - POST {patientID, fileName, force?, segmented?, maxConcurrency?}:
+        verifies that the recording exists in the patient's folder, starts an
+        Amazon Transcribe job on it and returns the job ID right away (202).
+        Audio recordings (MP3, M4A, WAV, ...) are transcribed as they are;
+        for video recordings only the extracted audio track is transcribed.
+        A recording that was already transcribed with the same settings
+        returns the existing job instead, unless force is set. With segmented
+        set, the recording is split at silences and the segments are
+        transcribed in parallel.
+      - {action: "run_segmented" | "transcode", jobName}: asynchronous
+        invocations of this function that split segmented jobs and start
+        their segments, and extract the audio of video recordings that were
+        not extracted at upload.
+      - GET ?jobId=... (or POST {jobId}): returns the job status, and the
+        transcript once the job has completed.
+      - Transcribe "Job State Change" events (EventBridge) or S3 ObjectCreated
+        events for the job output: copies the transcript to the patient's
+        folder and deletes it from the bucket root. Events for the segments of
+        a segmented job start its next segments, and the last one stitches
+        the transcript.
+
     Implements CORS and error handling.
     """
+    # --- Completion events (EventBridge / S3) ---
+    if event.get('source') == 'aws.transcribe' or 'Records' in event:
+        return handle_completion_event(event)
+
+    # --- Segmented transcription worker (asynchronous self-invocation) ---
+    if event.get('action') == 'run_segmented':
+        return run_segmented_job(event['jobName'])
+    if event.get('action') == 'transcode':
+        return run_transcode_job(event['jobName'])
+
     # --- CORS Preflight handling ---
     if event.get('httpMethod', '') == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
+            'headers': CORS_HEADERS,
             'body': ''
         }
-    
-    # --- Only allow POST ---
-    if event.get('httpMethod') != 'POST':
+
+    # --- Only allow GET (status) and POST ---
+    if event.get('httpMethod') not in ('GET', 'POST'):
         return {
             'statusCode': 405,
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': 'Method Not Allowed'
         }
-    
+
     try:
-        # --- Parse request body ---
-        body = json.loads(event.get('body', '{}'))
+        # --- Parse request ---
+        if event.get('httpMethod') == 'GET':
+            body = event.get('queryStringParameters') or {}
+        else:
+            body = json.loads(event.get('body') or '{}')
+
+        if body.get('jobId'):
+            return get_job_status(body['jobId'])
+
         patient_id = body.get('patientID')
         file_name = body.get('fileName')  # e.g., "220206-143000.mp4"
-        
+
         if not patient_id or not file_name:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({"error": "Missing patientID and/or fileName"})
-            }
-        
-        # Define the S3 key for the video file.
-        s3_key_video = f"id_{patient_id}/{file_name}"
-        s3_client = boto3.client('s3', region_name='eu-west-1')
-        logger.info("Checking for file in S3: Bucket=%s, Key=%s", S3_BUCKET, s3_key_video)
-
-        # --- Verify that the file exists in S3 ---
-        try:
-            head_response = s3_client.head_object(Bucket=S3_BUCKET, Key=s3_key_video)
-            content_type = head_response.get('ContentType', '')
-            if content_type.lower() != 'video/mp4':
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({"error": "The file in S3 is not a valid MP4 video."})
-                }
-        except s3_client.exceptions.NoSuchKey:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({"error": "File not found in S3."})
-            }
-        except Exception as e:
-            logger.exception("Error reading S3 object metadata")
-            return {
-                'statusCode': 500,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({"error": f"Error checking file: {str(e)}"})
-            }
-        
-        # --- Start Amazon Transcribe Job ---
-        transcribe_client = boto3.client('transcribe', region_name='eu-west-1')
-        # Use a unique job name to avoid conflicts.
-        unique_job_name = f"transcription_{patient_id}_{uuid.uuid4().hex}"
-        media_uri = f"s3://{S3_BUCKET}/{s3_key_video}"
-        logger.info(f"Starting transcription job. Values: {unique_job_name}, {media_uri}")
-        try:
-            transcribe_client.start_transcription_job(
-                TranscriptionJobName=unique_job_name,
-                LanguageCode='he-IL',
-                Media={'MediaFileUri': media_uri},
-                OutputBucketName=S3_BUCKET,  # Transcribe writes output as <unique_job_name>.json in the bucket root.
-                Settings={
-                    'ShowSpeakerLabels': True,
-                    'MaxSpeakerLabels': 2
-                }
-            )
+            return json_response(400, {"error": "Missing patientID and/or fileName"})
+
+        return start_job(
+            patient_id,
+            file_name,
+            force=bool(body.get('force')),
+            segmented=bool(body.get('segmented')),
+            max_concurrency=int(body.get('maxConcurrency') or SEGMENT_CONCURRENCY)
+        )
 
-        except transcribe_client.exceptions.ConflictException:
-            logger.info("Transcribe job already exists. Proceeding to poll status.")
-        except Exception as e:
-            logger.exception("Failed to start transcription job")
-            return {
-                'statusCode': 500,
-                'headers': {'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({"error": f"Failed to start transcription job: {str(e)}"})
-            }
-        
-        # --- Poll for Transcription Job Completion ---
-        timeout_seconds = 840  # 10 minutes timeout
-        poll_interval = 10
-        elapsed = 0
-        
-        while elapsed < timeout_seconds:
-            job = transcribe_client.get_transcription_job(TranscriptionJobName=unique_job_name)
-            status = job['TranscriptionJob']['TranscriptionJobStatus']
-            if status == 'COMPLETED':
-                logger.info("Transcription job completed.")
-                # The transcription output is written as <unique_job_name>.json in the bucket root.
-                actual_output_key = f"{unique_job_name}.json"
-                
-                # Construct the transcript key in the patient folder.
-                base_name, _ = os.path.splitext(file_name)
-                transcript_file_name = f"{base_name}.json"
-                transcript_key = f"id_{patient_id}/{transcript_file_name}"
-                
-                # Copy the transcript to the patient folder.
-                s3_client.copy_object(
-                    Bucket=S3_BUCKET,
-                    CopySource={'Bucket': S3_BUCKET, 'Key': actual_output_key},
-                    Key=transcript_key
-                )
-                
-                # Delete the original transcript file from the bucket root.
-                s3_client.delete_object(Bucket=S3_BUCKET, Key=actual_output_key)
-                
-                # Fetch and return the transcript from the patient folder.
-                return fetch_transcript_from_s3(S3_BUCKET, transcript_key)
-            elif status == 'FAILED':
-                return {
-                    'statusCode': 500,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({"error": "Transcription job failed."})
-                }
-            
-            time.sleep(poll_interval)
-            elapsed += poll_interval
-        
-        # If timeout is reached.
-        return {
-            'statusCode': 504,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({"error": "Transcription job timed out."})
-        }
-    
     except Exception as e:
         logger.exception("Unhandled exception in lambda_handler")
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({"error": str(e)})
+        return json_response(500, {"error": str(e)})
+
+
+def start_job(patient_id, file_name, force=False, segmented=False, max_concurrency=SEGMENT_CONCURRENCY):
+    """
+    Starts the Transcribe job for id_<patient_id>/<file_name> and records it,
+    or returns the job that already transcribed the same content.
+    """
+    # Define the S3 key for the recording.
+    s3_key_recording = f"id_{patient_id}/{file_name}"
+    s3_client = get_s3_client()
+    logger.info("Checking for file in S3: Bucket=%s, Key=%s", S3_BUCKET, s3_key_recording)
+
+    # --- Verify that the file exists in S3 ---
+    try:
+        head_response = s3_client.head_object(Bucket=S3_BUCKET, Key=s3_key_recording)
+        kind = recording_kind(file_name, head_response.get('ContentType', ''))
+        if kind is None:
+            return json_response(400, {"error": "The file in S3 is not a supported recording (MP4, MP3, M4A or WAV)."})
+    except s3_client.exceptions.NoSuchKey:
+        return json_response(400, {"error": "File not found in S3."})
+    except Exception as e:
+        logger.exception("Error reading S3 object metadata")
+        return json_response(500, {"error": f"Error checking file: {str(e)}"})
+
+    # Construct the transcript key in the patient folder.
+    base_name, _ = os.path.splitext(file_name)
+    transcript_key = f"id_{patient_id}/{base_name}.json"
+
+    # --- Reuse an existing transcript or in-flight job for the same content ---
+    index_key = media_index_key(patient_id, head_response.get('ETag', ''))
+    overwrite_index = force
+    if not force:
+        existing = find_existing_job(s3_client, index_key, transcript_key)
+        if existing is not None:
+            return existing
+        # Any index entry left at this point refers to a failed or stale job.
+        overwrite_index = s3_object_exists(s3_client, index_key)
+
+    # Use a unique job name to avoid conflicts.
+    unique_job_name = f"transcription_{patient_id}_{uuid.uuid4().hex}"
+    if not claim_index(s3_client, index_key, unique_job_name, overwrite_index):
+        # A concurrent request started a job for the same content first.
+        existing = find_existing_job(s3_client, index_key, transcript_key)
+        if existing is not None:
+            return existing
+        claim_index(s3_client, index_key, unique_job_name, True)
+
+    try:
+        # --- Transcribe the recording itself, or the audio extracted from a video ---
+        media_key = s3_key_recording
+        if kind == 'video':
+            media_key = find_audio(s3_client, S3_BUCKET, patient_id, file_name, head_response['ETag'])
+
+        # Record the job before starting it so a fast completion event can find it.
+        record = {
+            'jobName': unique_job_name,
+            'patientID': patient_id,
+            'fileName': file_name,
+            'mediaKey': media_key,
+            'transcriptKey': transcript_key,
+            'status': 'IN_PROGRESS',
+            'createdAt': int(time.time())
         }
+        if segmented:
+            record.update(mode='segmented', maxConcurrency=max_concurrency)
+        elif media_key is None:
+            record['stage'] = 'TRANSCODING'
+        write_job_record(s3_client, record)
+    except Exception:
+        release_index(s3_client, index_key, unique_job_name)
+        raise
+
+    try:
+        if segmented:
+            response = start_worker(s3_client, record, 'run_segmented')
+        elif media_key is None:
+            # The audio was not extracted at upload; extract it asynchronously.
+            response = start_worker(s3_client, record, 'transcode')
+        else:
+            response = start_transcribe_job(s3_client, record)
+    except Exception as e:
+        fail_job(s3_client, record, str(e))
+        release_index(s3_client, index_key, unique_job_name)
+        raise
+    if response['statusCode'] >= 400:
+        # The job was never started; do not send duplicates to it.
+        release_index(s3_client, index_key, unique_job_name)
+    return response
+
+
+def start_worker(s3_client, record, action):
+    """
+    Hands a recorded job to an asynchronous invocation of this function.
+    """
+    try:
+        get_lambda_client().invoke(
+            FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+            InvocationType='Event',
+            Payload=json.dumps({'action': action, 'jobName': record['jobName']}).encode('utf-8')
+        )
+    except Exception as e:
+        logger.exception("Failed to start %s worker", action)
+        fail_job(s3_client, record, str(e))
+        return json_response(500, {"error": f"Failed to start transcription job: {str(e)}"})
+    return json_response(202, {"jobId": record['jobName'], "status": "IN_PROGRESS"})
+
+
+def start_transcribe_job(s3_client, record):
+    """
+    Starts the Amazon Transcribe job of a recorded job on its mediaKey.
+    """
+    transcribe_client = get_transcribe_client()
+    media_uri = f"s3://{S3_BUCKET}/{record['mediaKey']}"
+    logger.info(f"Starting transcription job. Values: {record['jobName']}, {media_uri}")
+
+    try:
+        transcribe_client.start_transcription_job(
+            TranscriptionJobName=record['jobName'],
+            LanguageCode=LANGUAGE_CODE,
+            Media={'MediaFileUri': media_uri},
+            OutputBucketName=S3_BUCKET,  # Transcribe writes output as <unique_job_name>.json in the bucket root.
+            Settings=TRANSCRIBE_SETTINGS
+        )
+    except transcribe_client.exceptions.ConflictException:
+        logger.info("Transcribe job already exists.")
+    except transcribe_client.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in THROTTLING_ERRORS:
+            logger.exception("Failed to start transcription job")
+            fail_job(s3_client, record, str(e))
+            return json_response(500, {"error": f"Failed to start transcription job: {str(e)}"})
+        # Over the concurrent job quota. The failed record does not block a
+        # later request for the same recording.
+        logger.warning("Transcription job %s throttled: %s", record['jobName'], e)
+        fail_job(s3_client, record, str(e), throttled=True)
+        return json_response(429, {"error": "Too many transcription jobs are running; try again later.", "throttled": True})
+    except Exception as e:
+        logger.exception("Failed to start transcription job")
+        fail_job(s3_client, record, str(e))
+        return json_response(500, {"error": f"Failed to start transcription job: {str(e)}"})
+
+    return json_response(202, {"jobId": record['jobName'], "status": "IN_PROGRESS"})
+
+
+def run_transcode_job(job_name):
+    """
+    Extracts the audio of a job's video recording, then starts its Transcribe job.
+    """
+    s3_client = get_s3_client()
+    record = read_job_record(s3_client, job_name)
+    if record is None or record['status'] != 'IN_PROGRESS' or record.get('stage') != 'TRANSCODING':
+        logger.warning("Job %s is not waiting for audio extraction; ignoring.", job_name)
+        return {'statusCode': 200, 'body': json.dumps({"jobId": job_name})}
+
+    try:
+        media_key = ensure_audio(s3_client, S3_BUCKET, record['patientID'], record['fileName'])
+    except Exception as e:
+        logger.exception("Audio extraction for job %s failed", job_name)
+        fail_job(s3_client, record, f"Audio extraction failed: {str(e)}")
+        return {'statusCode': 200, 'body': json.dumps({"jobId": job_name})}
+
+    def audio_extracted(latest):
+        latest['mediaKey'] = media_key
+        latest.pop('stage', None)
+
+    record = update_job_record(s3_client, job_name, audio_extracted)
+    result = start_transcribe_job(s3_client, record)
+    return {'statusCode': 200, 'body': result['body']}
+
+
+def store_record_turns(s3_client, record):
+    """
+    Builds the speaker turns of a completed job's transcript(s). Failures are
+    only logged: fetch_transcript_from_s3 builds missing turns on demand.
+    """
+    for transcript_key in job_transcript_keys(record):
+        try:
+            store_turns(s3_client, S3_BUCKET, transcript_key)
+        except Exception:
+            logger.exception("Could not build speaker turns for %s", transcript_key)
+
+
+def record_job_outputs(s3_client, record):
+    """
+    Adds the transcripts, speaker turns and extracted audio of a completed job
+    to the patient's manifest.
+    """
+    transcript_keys = job_transcript_keys(record)
+    keys = transcript_keys + [turns_key(key) for key in transcript_keys]
+    if record.get('mediaKey'):
+        keys.append(record['mediaKey'])
+    record_objects(s3_client, S3_BUCKET, keys)
+
+
+def complete_job(job_name, status=None, failure_reason=None):
+    """
+    Moves the output of a finished job into the patient folder and updates its
+    record. Safe to call more than once for the same job.
+    Returns the updated record, or None for jobs this app did not start.
+    """
+    segment = parse_segment_job_name(job_name)
+    if segment is not None:
+        return complete_segment(segment[0], segment[1], status, failure_reason)
+
+    s3_client = get_s3_client()
+    record, etag = load_job_record(s3_client, job_name)
+    if record is None:
+        logger.warning("No job record for transcription job %s; ignoring.", job_name)
+        return None
+    if record['status'] in ('COMPLETED', 'FAILED'):
+        return record
+    if record.get('mode') == 'segmented':
+        # Completed segment by segment; a status check looks for missed events.
+        return check_segments(s3_client, record)
+    if record.get('stage') == 'TRANSCODING':
+        # Not handed to Transcribe yet.
+        return record
+
+    if status is None:
+        transcribe_client = get_transcribe_client()
+        try:
+            job = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)['TranscriptionJob']
+        except transcribe_client.exceptions.BadRequestException:
+            # The audio was just extracted and the job is being started.
+            logger.info("Transcribe job %s not found yet.", job_name)
+            return record
+        status = job['TranscriptionJobStatus']
+        failure_reason = job.get('FailureReason')
+
+    if status == 'COMPLETED':
+        logger.info("Transcription job %s completed.", job_name)
+        # The transcription output is written as <unique_job_name>.json in the bucket root.
+        actual_output_key = f"{job_name}.json"
+
+        # Copy the transcript to the patient folder (and to the transcript keys
+        # of duplicate recordings that attached to this job), then mark the
+        # job COMPLETED if no duplicate attached meanwhile; otherwise copy to
+        # the new aliases too and try again.
+        copied = set()
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            try:
+                for transcript_key in job_transcript_keys(record):
+                    if transcript_key not in copied:
+                        s3_client.copy_object(
+                            Bucket=S3_BUCKET,
+                            CopySource={'Bucket': S3_BUCKET, 'Key': actual_output_key},
+                            Key=transcript_key
+                        )
+                        copied.add(transcript_key)
+            except s3_client.exceptions.NoSuchKey:
+                # Another invocation (event or status poll) already moved it.
+                return read_job_record(s3_client, job_name)
+            completed = dict(record, status='COMPLETED')
+            if write_job_record(s3_client, completed, etag):
+                record = completed
+                break
+            _retry_delay(attempt)
+            record, etag = load_job_record(s3_client, job_name)
+            if record is None or record['status'] != 'IN_PROGRESS':
+                return record
+        else:
+            raise RuntimeError(f"Could not complete transcription job {job_name}: too many concurrent updates")
+
+        # Delete the original transcript file from the bucket root.
+        s3_client.delete_object(Bucket=S3_BUCKET, Key=actual_output_key)
+        store_record_turns(s3_client, record)
+        record_job_outputs(s3_client, record)
+    elif status == 'FAILED':
+        logger.error("Transcription job %s failed: %s", job_name, failure_reason)
+        fail_job(s3_client, record, failure_reason or "Transcription job failed.")
+    return record
+
+
+def segment_backend(s3_client, patient_id):
+    """
+    The backend of a patient's segment jobs; their audio and outputs are kept
+    under id_<patient>/output/transcribe/segments/.
+    """
+    return TranscribeBackend(
+        s3_client,
+        get_transcribe_client(),
+        S3_BUCKET,
+        f"id_{patient_id}/output/transcribe/segments/",
+        LANGUAGE_CODE,
+        TRANSCRIBE_SETTINGS
+    )
+
+
+def run_segmented_job(job_name):
+    """
+    Downloads the recording of a segmented job to /tmp, splits it at silences,
+    uploads the segments and starts their Transcribe jobs. It does not wait
+    for them: every segment completes from its own event (complete_segment),
+    and the last one stitches the transcript.
+    """
+    s3_client = get_s3_client()
+    record = read_job_record(s3_client, job_name)
+    if record is None or record['status'] != 'IN_PROGRESS' or record.get('segments'):
+        logger.warning("Segmented job %s is not waiting to be split; ignoring.", job_name)
+        return {'statusCode': 200, 'body': json.dumps({"jobId": job_name})}
+
+    backend = segment_backend(s3_client, record['patientID'])
+    try:
+        media_key = record.get('mediaKey') or ensure_audio(s3_client, S3_BUCKET, record['patientID'], record['fileName'])
+        with tempfile.TemporaryDirectory() as work_dir:
+            media_path = os.path.join(work_dir, os.path.basename(media_key))
+            s3_client.download_file(S3_BUCKET, media_key, media_path)
+            duration, segments = split_recording(media_path, work_dir)
+            for segment in segments:
+                backend.upload(segment_job_name(job_name, segment['index']), segment.pop('path'))
+
+        def planned(latest):
+            if latest['status'] != 'IN_PROGRESS' or latest.get('segments'):
+                return False
+            latest.update(mediaKey=media_key, duration=duration,
+                          segments=[dict(segment, status='PENDING') for segment in segments])
+
+        update_job_record(s3_client, job_name, planned)
+        logger.info("Segmented transcription job %s: %d segments of %.0fs", job_name, len(segments), duration)
+        start_segments(s3_client, job_name)
+    except Exception as e:
+        logger.exception("Segmented transcription job %s failed", job_name)
+        fail_job(s3_client, record, str(e))
+    return {'statusCode': 200, 'body': json.dumps({"jobId": job_name})}
+
+
+def start_segments(s3_client, job_name):
+    """
+    Starts the pending segments of a segmented job while fewer than its
+    maxConcurrency are running. Each segment is claimed in the job record
+    before it is started, so concurrent completions never start it twice.
+    Every segment is a Transcribe job of its own and counts against the
+    concurrent job quota: a throttled segment goes back to pending and is
+    started when a running one completes. If none is running, the job fails
+    as throttled, like an unsegmented job over the quota.
+    Returns the record.
+    """
+    record = read_job_record(s3_client, job_name)
+    backend = None
+    while True:
+        claimed = {}
+
+        def claim(latest):
+            claimed.clear()
+            segments = latest.get('segments') or []
+            pending = [segment for segment in segments if segment['status'] == 'PENDING']
+            running = sum(segment['status'] == 'IN_PROGRESS' for segment in segments)
+            if latest['status'] != 'IN_PROGRESS' or not pending \
+                    or running >= latest.get('maxConcurrency', SEGMENT_CONCURRENCY):
+                return False
+            pending[0]['status'] = 'IN_PROGRESS'
+            claimed['index'] = pending[0]['index']
+
+        record = update_job_record(s3_client, job_name, claim)
+        if 'index' not in claimed:
+            return record
+        index = claimed['index']
+        backend = backend or segment_backend(s3_client, record['patientID'])
+        try:
+            backend.start(segment_job_name(job_name, index))
+        except backend.transcribe_client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in THROTTLING_ERRORS:
+                logger.exception("Failed to start segment %d of job %s", index, job_name)
+                fail_job(s3_client, record, f"Failed to start segment {index}: {str(e)}")
+                return record
+            logger.warning("Segment %d of job %s throttled: %s", index, job_name, e)
+
+            def released(latest):
+                latest['segments'][index]['status'] = 'PENDING'
+
+            record = update_job_record(s3_client, job_name, released)
+            if not any(segment['status'] == 'IN_PROGRESS' for segment in record['segments']):
+                fail_job(s3_client, record, str(e), throttled=True)
+            return record
+
+
+def complete_segment(job_name, index, status, failure_reason=None):
+    """
+    Records the end of one segment job of a segmented job: starts the next
+    pending segment, or stitches the transcript once every segment has
+    completed. A failed segment fails the job. Safe to call more than once
+    for the same segment. Returns the job record.
+    """
+    s3_client = get_s3_client()
+    if status == 'FAILED':
+        record = read_job_record(s3_client, job_name)
+        if record is not None and record['status'] == 'IN_PROGRESS':
+            logger.error("Segment %d of transcription job %s failed: %s", index, job_name, failure_reason)
+            fail_job(s3_client, record, f"Segment {index} failed: {failure_reason or 'Transcription job failed.'}")
+        return record
+    if status != 'COMPLETED':
+        return read_job_record(s3_client, job_name)
+
+    def segment_completed(latest):
+        segments = latest.get('segments') or []
+        if latest['status'] != 'IN_PROGRESS' or index >= len(segments) or segments[index]['status'] == 'COMPLETED':
+            return False
+        segments[index]['status'] = 'COMPLETED'
+
+    record = update_job_record(s3_client, job_name, segment_completed)
+    if record is None or record['status'] != 'IN_PROGRESS' or not record.get('segments'):
+        return record
+    if all(segment['status'] == 'COMPLETED' for segment in record['segments']):
+        return stitch_segments(s3_client, record)
+    return start_segments(s3_client, job_name)
+
+
+def stitch_segments(s3_client, record):
+    """
+    Stitches the outputs of a segmented job whose segments have all completed
+    and writes the transcript to the patient folder (and to the transcript
+    keys of duplicate recordings that attached to the job).
+    """
+    job_name = record['jobName']
+    backend = segment_backend(s3_client, record['patientID'])
+    try:
+        parts = [
+            (segment['cutStart'], segment['cutEnd'], segment['offset'],
+             backend.output(segment_job_name(job_name, segment['index'])))
+            for segment in record['segments']
+        ]
+    except s3_client.exceptions.NoSuchKey:
+        # Another invocation already stitched the job and removed the outputs.
+        return read_job_record(s3_client, job_name)
+    body = json.dumps(stitch_transcripts(parts, job_name), ensure_ascii=False).encode('utf-8')
+    written = set()
+
+    # Duplicate requests may attach aliases until the record is COMPLETED;
+    # every attempt writes the transcript to the ones not written yet.
+    def completed(latest):
+        if latest['status'] != 'IN_PROGRESS':
+            return False
+        for transcript_key in job_transcript_keys(latest):
+            if transcript_key not in written:
+                s3_client.put_object(Bucket=S3_BUCKET, Key=transcript_key, Body=body, ContentType='application/json')
+                written.add(transcript_key)
+        latest['status'] = 'COMPLETED'
+
+    record = update_job_record(s3_client, job_name, completed)
+    if record['status'] != 'COMPLETED' or not written:
+        return record
+    logger.info("Segmented transcription job %s completed (%d segments).", job_name, len(record['segments']))
+    for segment in record['segments']:
+        backend.cleanup(segment_job_name(job_name, segment['index']))
+    store_record_turns(s3_client, record)
+    record_job_outputs(s3_client, record)
+    return record
+
+
+def check_segments(s3_client, record):
+    """
+    Checks the running segments of a segmented job with Transcribe and
+    completes the ones whose events have not been processed yet.
+    """
+    job_name = record['jobName']
+    running = [segment['index'] for segment in record.get('segments') or [] if segment['status'] == 'IN_PROGRESS']
+    if not running:
+        return record
+    backend = segment_backend(s3_client, record['patientID'])
+    for index in running:
+        try:
+            status, failure_reason = backend.status(segment_job_name(job_name, index))
+        except backend.transcribe_client.exceptions.BadRequestException:
+            # Claimed but not started yet.
+            continue
+        if status in ('COMPLETED', 'FAILED'):
+            record = complete_segment(job_name, index, status, failure_reason) or record
+    return record
+
+
+def handle_completion_event(event):
+    """
+    Handles Transcribe job state change events (EventBridge) and S3
+    ObjectCreated events for <job_name>.json written to the bucket root (or
+    for segment outputs under id_<patient>/output/transcribe/segments/).
+    """
+    if event.get('source') == 'aws.transcribe':
+        detail = event.get('detail', {})
+        jobs = [(detail.get('TranscriptionJobName'), detail.get('TranscriptionJobStatus'), detail.get('FailureReason'))]
+    else:
+        jobs = []
+        for s3_record in event['Records']:
+            key = s3_record['s3']['object']['key']
+            if '/' not in key and key.endswith('.json'):
+                jobs.append((key[:-len('.json')], 'COMPLETED', None))
+            elif '/output/transcribe/segments/' in key and key.endswith('.json'):
+                # Output of a segment job of a segmented job.
+                jobs.append((key.rsplit('/', 1)[1][:-len('.json')], 'COMPLETED', None))
+
+    for job_name, status, failure_reason in jobs:
+        if job_name and status in ('COMPLETED', 'FAILED'):
+            complete_job(job_name, status, failure_reason)
+    return {'statusCode': 200, 'body': json.dumps({"processed": [job[0] for job in jobs]})}
+
+
+def get_job_status(job_name):
+    """
+    Returns the status of a transcription job, with the transcript once it has
+    completed. If the completion event has not been processed yet, the job is
+    checked with Transcribe and completed inline.
+    """
+    s3_client = get_s3_client()
+    record = read_job_record(s3_client, job_name)
+    if record is None:
+        return json_response(404, {"error": "Unknown transcription job."})
+
+    if record['status'] == 'IN_PROGRESS':
+        record = complete_job(job_name)
+
+    if record['status'] == 'FAILED':
+        return json_response(200, {"jobId": job_name, "status": "FAILED", "error": record.get('error')})
+    if record['status'] != 'COMPLETED':
+        return json_response(200, {"jobId": job_name, "status": record['status']})
+
+    result = fetch_transcript_from_s3(S3_BUCKET, record['transcriptKey'])
+    if result['statusCode'] == 200:
+        body = json.loads(result['body'])
+        body.update(jobId=job_name, status='COMPLETED', transcriptKey=record['transcriptKey'])
+        result['body'] = json.dumps(body)
+    return result
+
 
 def fetch_transcript_from_s3(bucket_name, object_key):
     """
-    Fetches the transcript JSON file from S3 and returns the transcript text.
+    Returns the transcript text and its speaker turns
+    ({"speaker", "start", "end", "text"}). The turns are read from the compact
+    file stored next to the transcript JSON, which is built by streaming the
+    JSON the first time it is needed.
     """
-    s3_client = boto3.client('s3')
-    
+    s3_client = get_s3_client()
+
     try:
-        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-        transcript_json = json.loads(response['Body'].read().decode('utf-8'))
-        transcript_list = transcript_json.get('results', {}).get('transcripts', [])
-        transcript_text = transcript_list[0]['transcript'] if transcript_list else ""
-        
+        turns = load_turns(s3_client, bucket_name, object_key)
+
         return {
             'statusCode': 200,
             'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({"transcript": transcript_text})
+            'body': json.dumps({"transcript": turns_text(turns), "turns": turns})
         }
-    
+
     except Exception as e:
         logger.exception("Error retrieving transcript from S3")
         return {
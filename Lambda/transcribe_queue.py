@@ -0,0 +1,490 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from aws_clients import BUCKET_NAME, get_s3_client, get_sqs_client, get_transcribe_client
+from audio_transcode import recording_kind
+from instrumentation import instrumented
+from transcribe import complete_job, start_job
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Transcription requests are queued in SQS and started by a scheduled
+# invocation ({"action": "tick"}, e.g. an EventBridge rule every minute) that
+# keeps the number of running Transcribe jobs under MAX_IN_FLIGHT. Give the
+# function a reserved concurrency of 1 so ticks do not overlap.
+QUEUE_URL = os.environ.get("TRANSCRIBE_QUEUE_URL", "")
+MAX_IN_FLIGHT = int(os.environ.get("TRANSCRIBE_MAX_IN_FLIGHT", "50"))
+MAX_ATTEMPTS = int(os.environ.get("TRANSCRIBE_MAX_ATTEMPTS", "8"))
+BASE_DELAY = 10
+MAX_DELAY = 900
+
+# Per-batch progress is kept under this prefix while the batch has unfinished
+# items, and moved to DONE_BATCHES_PREFIX when it is done, so a tick lists only
+# the active batches.
+BATCHES_PREFIX = "transcribe-batches/"
+DONE_BATCHES_PREFIX = "transcribe-batches-done/"
+
+# Longest delay SQS accepts for a message (DelaySeconds).
+MAX_SQS_DELAY = 900
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+class Throttled(Exception):
+    """Raised by a backend when a job cannot be started because of the quota."""
+
+
+def backoff_delay(attempt, base=BASE_DELAY, maximum=MAX_DELAY):
+    """
+    Exponential backoff with full jitter, in seconds.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class SqsQueue:
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def send(self, bodies, delay=0):
+        """
+        Sends the bodies, which become visible after delay seconds.
+        """
+        for start in range(0, len(bodies), 10):
+            self.sqs_client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {"Id": str(index), "MessageBody": json.dumps(body), "DelaySeconds": int(min(delay, MAX_SQS_DELAY))}
+                    for index, body in enumerate(bodies[start:start + 10])
+                ]
+            )
+
+    def receive(self, max_messages):
+        """
+        Returns up to max_messages visible messages as (handle, body).
+        """
+        messages = []
+        while len(messages) < max_messages:
+            response = self.sqs_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=min(10, max_messages - len(messages)),
+                VisibilityTimeout=60
+            )
+            batch = response.get("Messages", [])
+            if not batch:
+                break
+            messages.extend((message["ReceiptHandle"], json.loads(message["Body"])) for message in batch)
+        return messages
+
+    def delete(self, handle):
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=handle)
+
+    def release(self, handle, delay):
+        """
+        Makes a received message visible again after delay seconds.
+        """
+        self.sqs_client.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=handle,
+            VisibilityTimeout=int(min(delay, 43200))
+        )
+
+
+class MemoryQueue:
+    """
+    In-memory stand-in for SqsQueue, for tests and local runs. clock() returns
+    the current time in seconds.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._messages = {}
+        self._lock = threading.Lock()
+
+    def send(self, bodies, delay=0):
+        visible_at = self.clock() + min(delay, MAX_SQS_DELAY) if delay else 0.0
+        with self._lock:
+            for body in bodies:
+                self._messages[uuid.uuid4().hex] = [visible_at, json.loads(json.dumps(body))]
+
+    def receive(self, max_messages, visibility_timeout=60):
+        now = self.clock()
+        with self._lock:
+            visible = [handle for handle, (visible_at, _) in self._messages.items() if visible_at <= now]
+            received = []
+            for handle in visible[:max_messages]:
+                self._messages[handle][0] = now + visibility_timeout
+                received.append((handle, self._messages[handle][1]))
+            return received
+
+    def delete(self, handle):
+        with self._lock:
+            self._messages.pop(handle, None)
+
+    def release(self, handle, delay):
+        with self._lock:
+            if handle in self._messages:
+                self._messages[handle][0] = self.clock() + delay
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class S3ProgressStore:
+    """
+    Keeps batch progress as transcribe-batches/<batch_id>.json, moved to
+    transcribe-batches-done/<batch_id>.json once the batch is done.
+    """
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def _read(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read().decode("utf-8"))
+
+    def load(self, batch_id):
+        batch = self._read(f"{BATCHES_PREFIX}{batch_id}.json")
+        return batch if batch is not None else self._read(f"{DONE_BATCHES_PREFIX}{batch_id}.json")
+
+    def save(self, batch):
+        batch["updatedAt"] = int(time.time())
+        prefix = DONE_BATCHES_PREFIX if batch.get("done") else BATCHES_PREFIX
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{prefix}{batch['batchId']}.json",
+            Body=json.dumps(batch).encode("utf-8"),
+            ContentType="application/json"
+        )
+        if batch.get("done"):
+            # Written to the done prefix first, so load always finds the batch.
+            self.s3_client.delete_object(Bucket=self.bucket, Key=f"{BATCHES_PREFIX}{batch['batchId']}.json")
+
+    def active(self):
+        """
+        Returns the batches that still have unfinished items. Only the active
+        prefix is listed; done batches found there (written before they were
+        moved on completion) are moved now.
+        """
+        batches = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=BATCHES_PREFIX):
+            for obj in page.get("Contents", []):
+                batch = self._read(obj["Key"])
+                if batch is None:
+                    continue
+                if batch.get("done"):
+                    self.save(batch)
+                else:
+                    batches.append(batch)
+        return batches
+
+
+class MemoryProgressStore:
+    def __init__(self):
+        self.batches = {}
+
+    def load(self, batch_id):
+        batch = self.batches.get(batch_id)
+        return json.loads(json.dumps(batch)) if batch else None
+
+    def save(self, batch):
+        self.batches[batch["batchId"]] = json.loads(json.dumps(batch))
+
+    def active(self):
+        return [self.load(batch_id) for batch_id, batch in self.batches.items() if not batch.get("done")]
+
+
+class TranscribeJobBackend:
+    """
+    Starts and tracks jobs through transcribe.py, so that queued jobs get the
+    same de-duplication, job records and transcript handling as interactive ones.
+    """
+
+    def __init__(self, transcribe_client):
+        self.transcribe_client = transcribe_client
+
+    def in_flight(self):
+        """
+        Number of running Transcribe jobs in the account (the quota is per account).
+        """
+        count = 0
+        kwargs = {"Status": "IN_PROGRESS", "MaxResults": 100}
+        while True:
+            response = self.transcribe_client.list_transcription_jobs(**kwargs)
+            count += len(response.get("TranscriptionJobSummaries", []))
+            if not response.get("NextToken"):
+                return count
+            kwargs["NextToken"] = response["NextToken"]
+
+    def start(self, patient_id, file_name):
+        """
+        Returns (job_id, status), raising Throttled when over the quota.
+        """
+        response = start_job(patient_id, file_name)
+        body = json.loads(response["body"])
+        if response["statusCode"] == 429:
+            raise Throttled(body.get("error"))
+        if response["statusCode"] >= 400:
+            raise RuntimeError(body.get("error", "Failed to start transcription job"))
+        return body["jobId"], body["status"]
+
+    def status(self, job_id):
+        """
+        Returns (status, error, throttled) for a started job.
+        """
+        record = complete_job(job_id)
+        if record is None:
+            return "FAILED", "Unknown transcription job.", False
+        return record["status"], record.get("error"), bool(record.get("throttled"))
+
+
+class FakeTranscribeBackend:
+    """
+    Local stand-in for TranscribeJobBackend: at most `limit` jobs run at once
+    (further starts raise Throttled, like Transcribe's quota) and every job
+    completes job_seconds after it started. clock() returns the current time.
+    """
+
+    def __init__(self, limit, job_seconds, clock=time.time):
+        self.limit = limit
+        self.job_seconds = job_seconds
+        self.clock = clock
+        self.jobs = {}
+        self.started = 0
+        self.throttled = 0
+
+    def _running(self):
+        now = self.clock()
+        return [job_id for job_id, finished_at in self.jobs.items() if finished_at > now]
+
+    def in_flight(self):
+        return len(self._running())
+
+    def start(self, patient_id, file_name):
+        if len(self._running()) >= self.limit:
+            self.throttled += 1
+            raise Throttled("LimitExceededException: too many concurrent jobs")
+        job_id = f"transcription_{patient_id}_{uuid.uuid4().hex}"
+        self.jobs[job_id] = self.clock() + self.job_seconds
+        self.started += 1
+        return job_id, "IN_PROGRESS"
+
+    def status(self, job_id):
+        done = self.jobs[job_id] <= self.clock()
+        return ("COMPLETED" if done else "IN_PROGRESS"), None, False
+
+
+class TranscriptionScheduler:
+    """
+    Starts queued (patientID, fileName) items while keeping the number of
+    running jobs under quota, retrying throttled starts with backoff, and
+    records per-item progress (QUEUED, RETRYING, IN_PROGRESS, COMPLETED or
+    FAILED) in the progress store.
+    """
+
+    def __init__(self, queue, backend, progress, quota=MAX_IN_FLIGHT, max_attempts=MAX_ATTEMPTS,
+                 delay=backoff_delay, clock=time.time):
+        self.queue = queue
+        self.backend = backend
+        self.progress = progress
+        self.quota = quota
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.clock = clock
+
+    def submit(self, items, batch_id=None):
+        """
+        Queues [(patient_id, file_name)] as one batch. Returns the batch.
+        """
+        batch = {
+            "batchId": batch_id or uuid.uuid4().hex,
+            "createdAt": int(self.clock()),
+            "items": [
+                {"patientID": patient_id, "fileName": file_name, "status": "QUEUED", "attempts": 0}
+                for patient_id, file_name in items
+            ]
+        }
+        batch["done"] = not batch["items"]
+        self.progress.save(batch)
+        self.queue.send([
+            {"batchId": batch["batchId"], "index": index}
+            for index in range(len(batch["items"]))
+        ])
+        return batch
+
+    def _retry(self, item, error):
+        """
+        Schedules another attempt of a throttled item, or fails it.
+        Returns the delay, or None if the item failed.
+        """
+        item["attempts"] += 1
+        if item["attempts"] >= self.max_attempts:
+            item.update(status="FAILED", error=f"Still throttled after {item['attempts']} attempts: {error}")
+            return None
+        delay = self.delay(item["attempts"])
+        item.update(status="RETRYING", error=error, nextAttemptAt=int(self.clock() + delay))
+        return delay
+
+    def refresh(self, batches):
+        """
+        Updates the status of started items. Items whose job was throttled
+        after it was queued (e.g. after audio extraction) are queued again,
+        delayed by their backoff.
+        """
+        for batch in batches:
+            for index, item in enumerate(batch["items"]):
+                if item["status"] != "IN_PROGRESS":
+                    continue
+                status, error, throttled = self.backend.status(item["jobId"])
+                if status == "FAILED" and throttled:
+                    delay = self._retry(item, error)
+                    if delay is not None:
+                        self.queue.send([{"batchId": batch["batchId"], "index": index}], delay)
+                elif status in ("COMPLETED", "FAILED"):
+                    item.update(status=status, error=error)
+
+    def tick(self):
+        """
+        One scheduling round: refreshes running items, then starts queued
+        items until the quota is reached or Transcribe throttles.
+        Returns a summary of the round.
+        """
+        batches = {batch["batchId"]: batch for batch in self.progress.active()}
+        self.refresh(batches.values())
+
+        capacity = max(0, self.quota - self.backend.in_flight())
+        started = throttled = 0
+        messages = self.queue.receive(capacity) if capacity else []
+        for position, (handle, body) in enumerate(messages):
+            batch = batches.get(body["batchId"])
+            if batch is None:
+                self.queue.delete(handle)
+                continue
+            item = batch["items"][body["index"]]
+            if throttled:
+                # Transcribe is at its limit; do not try the rest of this round.
+                self.queue.release(handle, self.delay(item["attempts"]))
+                continue
+            try:
+                job_id, status = self.backend.start(item["patientID"], item["fileName"])
+            except Throttled as e:
+                throttled += 1
+                delay = self._retry(item, str(e))
+                if delay is None:
+                    self.queue.delete(handle)
+                else:
+                    self.queue.release(handle, delay)
+                continue
+            except Exception as e:
+                logger.exception("Could not start transcription of %s/%s", item["patientID"], item["fileName"])
+                item.update(status="FAILED", error=str(e))
+                self.queue.delete(handle)
+                continue
+            item.update(status=status, jobId=job_id, error=None)
+            started += 1
+            self.queue.delete(handle)
+
+        for batch in batches.values():
+            batch["done"] = all(item["status"] in ("COMPLETED", "FAILED") for item in batch["items"])
+            self.progress.save(batch)
+        return {"capacity": capacity, "started": started, "throttled": throttled}
+
+
+def batch_report(batch):
+    counts = {}
+    for item in batch["items"]:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    return {"batchId": batch["batchId"], "done": batch.get("done", False), "counts": counts, "items": batch["items"]}
+
+
+def untranscribed_recordings(s3_client, bucket, patient_id):
+    """
+    Returns the recordings directly under the patient folder that have no
+    transcript (<name>.json) yet.
+    """
+    prefix = f"id_{patient_id}/"
+    names = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            names.add(obj["Key"][len(prefix):])
+    transcripts = {os.path.splitext(name)[0] for name in names if name.endswith(".json")}
+    return sorted(
+        name for name in names
+        if recording_kind(name) is not None
+        and os.path.splitext(name)[0] not in transcripts
+    )
+
+
+def json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(body)
+    }
+
+
+@instrumented("transcribe_queue")
+def lambda_handler(event, context):
+    """
+    Batch transcription:
+      - POST {items: [{patientID, fileName}], patients: [patientID]}: queues
+        the items and every untranscribed recording of the listed patients;
+        returns the batch ID (202).
+      - GET ?batchId=...: per-item progress of a batch.
+      - {action: "tick"} or a scheduled EventBridge event: starts queued jobs.
+    """
+    if event.get('httpMethod', '') == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': ''}
+
+    try:
+        s3_client = get_s3_client()
+        scheduler = TranscriptionScheduler(
+            SqsQueue(get_sqs_client(), QUEUE_URL),
+            TranscribeJobBackend(get_transcribe_client()),
+            S3ProgressStore(s3_client, BUCKET_NAME)
+        )
+
+        if event.get('action') == 'tick' or event.get('source') == 'aws.events':
+            result = scheduler.tick()
+            logger.info("Scheduler round: %s", result)
+            return {'statusCode': 200, 'body': json.dumps(result)}
+
+        if event.get('httpMethod') == 'GET':
+            batch_id = (event.get('queryStringParameters') or {}).get('batchId')
+            batch = scheduler.progress.load(batch_id) if batch_id else None
+            if batch is None:
+                return json_response(404, {"error": "Unknown batch."})
+            return json_response(200, batch_report(batch))
+
+        if event.get('httpMethod') != 'POST':
+            return json_response(405, {"error": "Method Not Allowed"})
+
+        body = json.loads(event.get('body') or '{}')
+        items = [(str(item['patientID']), item['fileName']) for item in body.get('items', [])]
+        for patient_id in body.get('patients', []):
+            items.extend((str(patient_id), name) for name in untranscribed_recordings(s3_client, BUCKET_NAME, patient_id))
+        if not items:
+            return json_response(400, {"error": "Nothing to transcribe."})
+
+        batch = scheduler.submit(items)
+        return json_response(202, {"batchId": batch["batchId"], "items": len(batch["items"])})
+
+    except Exception as e:
+        logger.exception("Unhandled exception in lambda_handler")
+        return json_response(500, {"error": str(e)})
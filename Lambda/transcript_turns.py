@@ -0,0 +1,136 @@
+import json
+import logging
+from bisect import bisect_right
+
+logger = logging.getLogger()
+
+# Speaker turns are stored next to the Transcribe output as JSON Lines:
+# id_<patient>/<name>.json -> id_<patient>/<name>.turns.jsonl (one turn per
+# line). The suffix keeps them out of "*.json" transcript listings.
+TURNS_SUFFIX = ".turns.jsonl"
+CHUNK_SIZE = 64 * 1024
+
+# ijson prefixes of the word items and speaker segments of a Transcribe output.
+ITEMS_PREFIX = "results.items.item"
+SEGMENTS_PREFIX = "results.speaker_labels.segments.item"
+SEGMENT_FIELDS = {f"{SEGMENTS_PREFIX}.{field}": field for field in ("start_time", "end_time", "speaker_label")}
+
+
+def iter_transcript_items(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yields the results.items of a Transcribe output JSON read incrementally
+    from a binary stream (a file or an S3 StreamingBody) with ijson; only the
+    current item is built in memory. Items without a speaker_label get one
+    from results.speaker_labels.segments, which Transcribe writes before the
+    items (only the times and labels of the segments are read).
+    """
+    import ijson  # provided by the Lambda layer
+
+    starts, spans = [], []
+    segment, builder = {}, None
+    for prefix, event, value in ijson.parse(stream, buf_size=chunk_size, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix != ITEMS_PREFIX or event != "end_map":
+                continue
+            item, builder = builder.value, None
+            if "speaker_label" not in item and "start_time" in item and spans:
+                index = bisect_right(starts, float(item["start_time"])) - 1
+                if index >= 0 and float(item["start_time"]) < spans[index][0]:
+                    item["speaker_label"] = spans[index][1]
+            yield item
+        elif prefix == ITEMS_PREFIX and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix in SEGMENT_FIELDS:
+            segment[SEGMENT_FIELDS[prefix]] = value
+        elif prefix == SEGMENTS_PREFIX and event == "end_map":
+            starts.append(float(segment["start_time"]))
+            spans.append((float(segment["end_time"]), segment.get("speaker_label")))
+            segment = {}
+
+
+def build_turns(items):
+    """
+    Groups transcript items into speaker turns:
+    [{"speaker", "start", "end", "text"}]. Punctuation is attached to the
+    preceding word.
+    """
+    turns = []
+    turn = None
+    words = []
+    for item in items:
+        alternatives = item.get("alternatives") or [{}]
+        content = alternatives[0].get("content", "")
+        if item.get("type") == "punctuation":
+            if words:
+                words[-1] += content
+            continue
+
+        speaker = item.get("speaker_label")
+        if turn is None or speaker != turn["speaker"]:
+            if turn is not None:
+                turn["text"] = " ".join(words)
+                turns.append(turn)
+            turn = {"speaker": speaker, "start": float(item["start_time"]), "end": None, "text": ""}
+            words = []
+        turn["end"] = float(item["end_time"])
+        words.append(content)
+
+    if turn is not None:
+        turn["text"] = " ".join(words)
+        turns.append(turn)
+    return turns
+
+
+def turns_text(turns):
+    return " ".join(turn["text"] for turn in turns)
+
+
+def turns_key(transcript_key):
+    base = transcript_key[:-len(".json")] if transcript_key.endswith(".json") else transcript_key
+    return base + TURNS_SUFFIX
+
+
+def store_turns(s3_client, bucket, transcript_key):
+    """
+    Streams the Transcribe output at transcript_key into speaker turns and
+    writes them next to it. Returns the turns.
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=transcript_key)
+    turns = build_turns(iter_transcript_items(response["Body"]))
+    if not turns:
+        # No word items (e.g. an empty recording); such outputs are small, so
+        # fall back to the transcript text.
+        transcript_json = json.loads(
+            s3_client.get_object(Bucket=bucket, Key=transcript_key)["Body"].read().decode("utf-8")
+        )
+        transcript_list = transcript_json.get("results", {}).get("transcripts", [])
+        if transcript_list and transcript_list[0].get("transcript"):
+            turns = [{"speaker": None, "start": 0.0, "end": 0.0, "text": transcript_list[0]["transcript"]}]
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=turns_key(transcript_key),
+        Body="".join(json.dumps(turn, ensure_ascii=False) + "\n" for turn in turns).encode("utf-8"),
+        ContentType="application/x-ndjson; charset=utf-8",
+        Metadata={"source-etag": response["ETag"].strip('"')}
+    )
+    return turns
+
+
+def load_turns(s3_client, bucket, transcript_key):
+    """
+    Returns the speaker turns of a transcript, building and storing them if
+    they are missing or were built from an older version of the transcript.
+    """
+    etag = s3_client.head_object(Bucket=bucket, Key=transcript_key)["ETag"].strip('"')
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=turns_key(transcript_key))
+    except s3_client.exceptions.NoSuchKey:
+        response = None
+
+    if response is not None and response.get("Metadata", {}).get("source-etag") == etag:
+        return [json.loads(line) for line in response["Body"].iter_lines() if line]
+
+    logger.info("Building speaker turns for %s", transcript_key)
+    return store_turns(s3_client, bucket, transcript_key)
@@ -1,18 +1,231 @@
 import json
-import boto3
+import time
 import base64
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from aws_clients import BUCKET_NAME, get_s3_client
+from instrumentation import instrumented, record
+from patient_manifest import CONFLICT_ERRORS, record_objects
 
 # Set up logging to only output INFO level logs
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3', region_name='BUCKET_REGION')
-BUCKET_NAME = "BUCKET_NAME"
+CONTENT_TYPE_EXTENSIONS = {
+    "application/pdf": "pdf",
+    "video/mp4": "mp4",
+    "audio/mpeg": "mp3",
+    "audio/mp4": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/wav": "wav",
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "application/json": "json"
+}
 
+# Multipart uploads: the browser uploads the parts straight to S3 with
+# presigned URLs. S3 requires parts of at least 5 MiB (except the last one)
+# and at most 10,000 parts.
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+PRESIGNED_URL_EXPIRES = 3600
+MULTIPART_ACTIONS = ("initiate", "presign_parts", "complete", "abort")
+
+# Bulk provisioning creates the folder markers of many patients in parallel and
+# stops starting new patients when the invocation is about to time out.
+PATIENT_MARKERS = ("", "output/", "output/Summary/", "output/transcribe/")
+PROVISION_WORKERS = 32
+PROVISION_TIME_MARGIN_MS = 5000
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "POST,OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type,Authorization"
+}
+
+
+def json_response(status_code, body):
+    headers = dict(CORS_HEADERS)
+    if status_code == 200:
+        headers["Content-Type"] = "application/json"
+    return {"statusCode": status_code, "headers": headers, "body": json.dumps(body)}
+
+
+def upload_key(id_value, body):
+    """
+    Returns the S3 key for an uploaded file: id_<id>/<fileName> when overwrite
+    is set, otherwise id_<id>/<timestamp>.<extension>.
+    """
+    # Determine the file extension if possible.
+    extension = None
+    provided_file_name = body.get('fileName')
+    if provided_file_name:
+        # If a period is present, we assume the file name includes its extension.
+        if '.' in provided_file_name:
+            extension = provided_file_name.split('.')[-1]
+    if not extension and 'contentType' in body:
+        extension = CONTENT_TYPE_EXTENSIONS.get(body['contentType'], None)
+    if not extension:
+        extension = "bin"
+
+    # Determine if the file should be overwritten.
+    overwrite = body.get("overwrite", False)
+    if overwrite and provided_file_name:
+        # Use the exact provided filename for overwriting.
+        return f"id_{id_value}/{provided_file_name}"
+    if overwrite:
+        # If no fileName is provided, fallback to timestamped name.
+        logger.info("Overwrite flag is true but no fileName provided; using timestamp instead.")
+    tz = timezone(timedelta(hours=2))  # GMT+2, Israel time.
+    timestamp = datetime.now(tz).strftime("%Y-%m-%d-%H:%M:%S")
+    return f"id_{id_value}/{timestamp}.{extension}"
+
+
+def presign_parts(s3_client, s3_key, upload_id, part_numbers):
+    return {
+        str(part_number): s3_client.generate_presigned_url(
+            'upload_part',
+            Params={'Bucket': BUCKET_NAME, 'Key': s3_key, 'UploadId': upload_id, 'PartNumber': int(part_number)},
+            ExpiresIn=PRESIGNED_URL_EXPIRES
+        )
+        for part_number in part_numbers
+    }
+
+
+def handle_multipart(s3_client, id_value, body):
+    """
+    Multipart upload operations, selected by body["action"]:
+      - initiate {fileName, contentType, overwrite, size?, partSize?}: starts
+        the upload and returns {uploadId, s3_key, partSize}, plus the
+        presigned part URLs ({urls}) when the file size is given.
+      - presign_parts {s3_key, uploadId, partNumbers}: returns {urls} (part number -> URL).
+      - complete {s3_key, uploadId, parts?: [{PartNumber, ETag}]}: assembles
+        the file; without parts, the uploaded parts are listed from S3.
+      - abort {s3_key, uploadId}: discards the uploaded parts.
+    """
+    action = body['action']
+    if action == "initiate":
+        s3_key = upload_key(id_value, body)
+        content_type = body.get("contentType", "application/octet-stream")
+        response = s3_client.create_multipart_upload(Bucket=BUCKET_NAME, Key=s3_key, ContentType=content_type)
+        result = {"uploadId": response['UploadId'], "s3_key": s3_key}
+
+        part_size = max(MIN_PART_SIZE, int(body.get("partSize") or DEFAULT_PART_SIZE))
+        if body.get("size") is not None:
+            # An empty file is still uploaded as one (empty) part.
+            size = int(body["size"])
+            # Grow the parts for very large files to stay under the part limit.
+            part_size = max(part_size, -(-size // MAX_PARTS))
+            part_count = max(1, -(-size // part_size))
+            result["urls"] = presign_parts(s3_client, s3_key, response['UploadId'], range(1, part_count + 1))
+        result["partSize"] = part_size
+        logger.info(f"Initiated multipart upload {response['UploadId']} for {s3_key}")
+        return json_response(200, result)
+
+    s3_key = body.get("s3_key", "")
+    upload_id = body.get("uploadId")
+    if not upload_id or not s3_key.startswith(f"id_{id_value}/") or ".." in s3_key:
+        raise ValueError("Missing uploadId or invalid s3_key for this id.")
+
+    if action == "presign_parts":
+        part_numbers = [int(number) for number in body.get("partNumbers", [])]
+        if not part_numbers or min(part_numbers) < 1 or max(part_numbers) > MAX_PARTS:
+            raise ValueError(f"partNumbers must be between 1 and {MAX_PARTS}.")
+        return json_response(200, {"urls": presign_parts(s3_client, s3_key, upload_id, part_numbers)})
+
+    if action == "complete":
+        parts = body.get("parts")
+        if not parts:
+            parts = []
+            paginator = s3_client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=BUCKET_NAME, Key=s3_key, UploadId=upload_id):
+                parts.extend(page.get('Parts', []))
+        parts = sorted(
+            ({"PartNumber": int(part["PartNumber"]), "ETag": part["ETag"]} for part in parts),
+            key=lambda part: part["PartNumber"]
+        )
+        s3_client.complete_multipart_upload(
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+        record_objects(s3_client, BUCKET_NAME, [s3_key])
+        logger.info(f"File uploaded successfully to {s3_key} ({len(parts)} parts)")
+        return json_response(200, {"message": f"File uploaded successfully to {s3_key}", "s3_key": s3_key})
+
+    s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=s3_key, UploadId=upload_id)
+    logger.info(f"Aborted multipart upload {upload_id} for {s3_key}")
+    return json_response(200, {"message": f"Upload to {s3_key} aborted", "s3_key": s3_key})
+
+
+def create_marker(s3_client, key):
+    """
+    Writes the empty folder marker at key unless it already exists.
+    Returns True if it was created.
+    """
+    try:
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body="", IfNoneMatch="*")
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in CONFLICT_ERRORS:
+            return False
+        raise
+    return True
+
+
+def provision_patients(s3_client, ids, context=None):
+    """
+    Creates the directory structure of every patient in ids. Every marker is
+    written only if it does not exist yet, so a patient whose folder exists
+    without its markers (e.g. files were uploaded to it directly) gets the
+    missing ones.
+    Returns {id: "created" | "exists" | "repaired" | "invalid" | "pending" |
+    "error: ..."}; "repaired" patients already had their root marker but
+    missed other folders, and "pending" patients were not started before the
+    time budget ran out and can be sent again.
+    """
+    results = {}
+    valid_ids = []
+    for raw_id in ids:
+        id_value = str(raw_id).strip()
+        if id_value in results:
+            continue
+        if not id_value or "/" in id_value:
+            results[id_value] = "invalid"
+        else:
+            results[id_value] = "pending"
+            valid_ids.append(id_value)
+
+    def out_of_time():
+        return context is not None and context.get_remaining_time_in_millis() < PROVISION_TIME_MARGIN_MS
+
+    def create(id_value):
+        if out_of_time():
+            return id_value, "pending"
+        try:
+            # The root marker is written last, so a patient only shows up as
+            # existing once all of its folders are in place.
+            created = [create_marker(s3_client, f"id_{id_value}/{marker}") for marker in reversed(PATIENT_MARKERS)]
+        except Exception as e:
+            logger.error(f"Could not create directory structure for {id_value}: {e}")
+            return id_value, f"error: {e}"
+        if created[-1]:
+            return id_value, "created"
+        return id_value, "repaired" if any(created) else "exists"
+
+    with ThreadPoolExecutor(max_workers=PROVISION_WORKERS) as executor:
+        for id_value, result in executor.map(create, valid_ids):
+            results[id_value] = result
+    return results
+
+
+@instrumented("upload")
 def lambda_handler(event, context):
     try:
+        s3_client = get_s3_client()
+
         # Parse the request body. API Gateway usually sends it as a JSON string in 'body'.
         if 'body' in event:
             body = event['body']
@@ -21,6 +234,19 @@ def lambda_handler(event, context):
         else:
             body = event  # In case the event is already a dict.
 
+        # --- Case: Bulk provisioning of many patients ---
+        if 'ids' in body:
+            if not isinstance(body['ids'], list):
+                raise ValueError("'ids' must be a list of patient IDs.")
+            started = time.time()
+            results = provision_patients(s3_client, body['ids'], context)
+            counts = {}
+            for result in results.values():
+                status = result.split(":")[0]
+                counts[status] = counts.get(status, 0) + 1
+            logger.info(f"Provisioned {len(results)} patients in {time.time() - started:.2f}s: {counts}")
+            return json_response(200, {"counts": counts, "results": results})
+
         # Validate that an 'id' is provided.
         if 'id' not in body:
             logger.error("Missing 'id' in the request body.")
@@ -28,6 +254,9 @@ def lambda_handler(event, context):
         id_value = str(body['id'])
         logger.info(f"Processing request for id: {id_value}")
 
+        if body.get('action') in MULTIPART_ACTIONS:
+            return handle_multipart(s3_client, id_value, body)
+
         if 'file' in body and body['file']:
             # --- Case: Upload file ---
             logger.info("File upload detected.")
@@ -37,43 +266,9 @@ def lambda_handler(event, context):
             except Exception as decode_error:
                 logger.error("Failed to decode Base64 file content.", exc_info=True)
                 raise ValueError("Invalid Base64 file content.") from decode_error
+            record("UploadBytes", len(file_bytes), "Bytes")
 
-            # Determine the file extension if possible.
-            extension = None
-            provided_file_name = body.get('fileName')
-            if provided_file_name:
-                # If a period is present, we assume the file name includes its extension.
-                if '.' in provided_file_name:
-                    extension = provided_file_name.split('.')[-1]
-            if not extension and 'contentType' in body:
-                content_type = body['contentType']
-                content_type_mapping = {
-                    "application/pdf": "pdf",
-                    "video/mp4": "mp4",
-                    "image/jpeg": "jpg",
-                    "image/png": "png",
-                    "application/json": "json"
-                }
-                extension = content_type_mapping.get(content_type, None)
-            if not extension:
-                extension = "bin"
-
-            # Determine if the file should be overwritten.
-            overwrite = body.get("overwrite", False)
-            if overwrite:
-                if provided_file_name:
-                    # Use the exact provided filename for overwriting.
-                    s3_key = f"id_{id_value}/{provided_file_name}"
-                else:
-                    # If no fileName is provided, fallback to timestamped name.
-                    logger.info("Overwrite flag is true but no fileName provided; using timestamp instead.")
-                    tz = timezone(timedelta(hours=2))
-                    timestamp = datetime.now(tz).strftime("%Y-%m-%d-%H:%M:%S")
-                    s3_key = f"id_{id_value}/{timestamp}.{extension}"
-            else:
-                tz = timezone(timedelta(hours=2))  # GMT+2, Israel time.
-                timestamp = datetime.now(tz).strftime("%Y-%m-%d-%H:%M:%S")
-                s3_key = f"id_{id_value}/{timestamp}.{extension}"
+            s3_key = upload_key(id_value, body)
             logger.info(f"Constructed S3 key for file upload: {s3_key}")
 
             # Set the content type based on the request, defaulting to 'application/octet-stream' if not provided.
@@ -87,6 +282,7 @@ def lambda_handler(event, context):
                 Body=file_bytes,
                 ContentType=content_type
             )
+            record_objects(s3_client, BUCKET_NAME, [s3_key])
             logger.info(f"File uploaded successfully to {s3_key}")
             message = f"File uploaded successfully to {s3_key}"
         else:
@@ -112,30 +308,13 @@ def lambda_handler(event, context):
             s3_key = root_key  # Return the root directory key as a reference.
 
         # Return a success response with CORS headers.
-        return {
-            "statusCode": 200,
-            "headers": {
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST,OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type,Authorization",
-                "Content-Type": "application/json"
-            },
-            "body": json.dumps({
-                "message": message,
-                "s3_key": s3_key
-            })
-        }
+        return json_response(200, {
+            "message": message,
+            "s3_key": s3_key
+        })
 
     except Exception as e:
         logger.error("An error occurred in lambda_handler.", exc_info=True)
-        return {
-            "statusCode": 500,
-            "headers": {
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST,OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type,Authorization"
-            },
-            "body": json.dumps({
-                "message": str(e)
-            })
-        }
+        return json_response(500, {
+            "message": str(e)
+        })
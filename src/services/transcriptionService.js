@@ -64,8 +64,29 @@ export async function uploadRecording(file, patientID) {
   }
 }
 
+const TRANSCRIPTION_POLL_INTERVAL_MS = 5000;
+const TRANSCRIPTION_TIMEOUT_MS = 60 * 60 * 1000;
+
+export async function getTranscriptionStatus(jobId) {
+  const response = await fetch(buildUrl(API_ENDPOINTS.TRANSCRIBE, { jobId }), {
+    method: 'GET',
+    headers: {
+      'Content-Type': 'application/json',
+      'x-api-key': API_KEY
+    }
+  });
+
+  if (!response.ok) {
+    const errorText = await response.text();
+    throw new Error(`Failed to get transcription status: ${errorText}`);
+  }
+
+  return response.json();
+}
+
 export async function startTranscription(patientID, fileName) {
   try {
+    // Start the job; the API returns a job ID right away
     const response = await fetch(API_ENDPOINTS.TRANSCRIBE, {
       method: 'POST',
       headers: {
@@ -83,8 +104,21 @@ export async function startTranscription(patientID, fileName) {
       throw new Error(`Failed to start transcription: ${errorText}`);
     }
 
-    const data = await response.json();
-    return data.transcript || '';
+    const { jobId } = await response.json();
+
+    // Poll the status endpoint until the transcript is ready
+    const deadline = Date.now() + TRANSCRIPTION_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+      const status = await getTranscriptionStatus(jobId);
+      if (status.status === 'COMPLETED') {
+        return status.transcript || '';
+      }
+      if (status.status === 'FAILED') {
+        throw new Error(status.error || 'Transcription job failed');
+      }
+      await new Promise(resolve => setTimeout(resolve, TRANSCRIPTION_POLL_INTERVAL_MS));
+    }
+    throw new Error('Transcription job timed out');
   } catch (error) {
     console.error('Error starting transcription:', error);
     throw error;
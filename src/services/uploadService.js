@@ -0,0 +1,96 @@
+import { API_ENDPOINTS, API_KEY } from '../config';
+
+const PART_UPLOAD_CONCURRENCY = 4;
+const PART_UPLOAD_RETRIES = 3;
+
+async function callUpload(body) {
+  const response = await fetch(API_ENDPOINTS.UPLOAD, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'x-api-key': API_KEY
+    },
+    body: JSON.stringify(body)
+  });
+
+  if (!response.ok) {
+    const errorText = await response.text();
+    throw new Error(`Upload request failed (${body.action}): ${errorText}`);
+  }
+
+  return response.json();
+}
+
+async function uploadPart(url, blob) {
+  let lastError;
+  for (let attempt = 0; attempt < PART_UPLOAD_RETRIES; attempt++) {
+    try {
+      const response = await fetch(url, { method: 'PUT', body: blob });
+      if (response.ok) {
+        // The bucket's CORS configuration must expose the ETag header
+        return response.headers.get('ETag');
+      }
+      lastError = new Error(`Part upload failed: ${response.status}`);
+    } catch (error) {
+      lastError = error;
+    }
+  }
+  throw lastError;
+}
+
+/**
+ * Uploads a file to the patient's folder with an S3 multipart upload: the
+ * parts are sent in parallel straight to S3 through presigned URLs.
+ * Resolves to the S3 key of the uploaded file.
+ */
+export async function uploadFileMultipart(patientID, file, { contentType, overwrite = false, onProgress } = {}) {
+  const { uploadId, s3_key: s3Key, partSize, urls: initialUrls } = await callUpload({
+    action: 'initiate',
+    id: patientID,
+    fileName: file.name,
+    contentType: contentType || file.type || 'application/octet-stream',
+    overwrite,
+    size: file.size
+  });
+
+  const parts = [];
+  let urls = initialUrls;
+  let partNumbers = [];
+  let uploadedBytes = 0;
+  let next = 0;
+
+  const worker = async () => {
+    while (next < partNumbers.length) {
+      const partNumber = partNumbers[next++];
+      const blob = file.slice((partNumber - 1) * partSize, partNumber * partSize);
+      const etag = await uploadPart(urls[partNumber], blob);
+      parts.push({ PartNumber: partNumber, ETag: etag });
+      uploadedBytes += blob.size;
+      if (onProgress) {
+        onProgress(file.size ? uploadedBytes / file.size : 1);
+      }
+    }
+  };
+
+  try {
+    if (!urls) {
+      // The initiate response has no part URLs when the backend did not get the size.
+      const partCount = Math.max(1, Math.ceil(file.size / partSize));
+      const numbers = Array.from({ length: partCount }, (_, index) => index + 1);
+      ({ urls } = await callUpload({
+        action: 'presign_parts', id: patientID, s3_key: s3Key, uploadId, partNumbers: numbers
+      }));
+    }
+    partNumbers = Object.keys(urls).map(Number).sort((a, b) => a - b);
+    await Promise.all(
+      Array.from({ length: Math.min(PART_UPLOAD_CONCURRENCY, partNumbers.length) }, worker)
+    );
+    await callUpload({ action: 'complete', id: patientID, s3_key: s3Key, uploadId, parts });
+  } catch (error) {
+    console.error('Multipart upload failed, aborting:', error);
+    await callUpload({ action: 'abort', id: patientID, s3_key: s3Key, uploadId }).catch(() => {});
+    throw error;
+  }
+
+  return s3Key;
+}
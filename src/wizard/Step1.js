@@ -20,10 +20,39 @@ import {
 import RecordingControls from '../components/RecordingControls';
 import TranscriptionSection from '../components/TranscriptionSection';
 import { startTranscription } from '../services/transcriptionService';
+import { uploadFileMultipart } from '../services/uploadService';
 import { convertPdfToImages } from '../components/pdfHelper';
 import settings from '../settings.json';
 import { API_ENDPOINTS, API_KEY, buildUrl } from '../config';
 
+// Lists the patient's files for several patterns in one request (following
+// the cursor for large folders) and groups them by the pattern they matched.
+const fetchFilesByPattern = async (id, patterns) => {
+  const byPattern = Object.fromEntries(patterns.map(pattern => [pattern, []]));
+  let cursor;
+  do {
+    const url = buildUrl(API_ENDPOINTS.FILES, {
+      patientId: id,
+      fileName: patterns.join(','),
+      ...(cursor ? { cursor } : {})
+    });
+    const response = await fetch(url, {
+      headers: {
+        'Content-Type': 'application/json',
+        'x-api-key': API_KEY,
+        'Accept': 'application/json'
+      }
+    });
+    // The endpoint answers 500 when nothing matches
+    const data = await response.json();
+    (data.files || []).forEach(file => {
+      (file.patterns || []).forEach(pattern => byPattern[pattern]?.push(file));
+    });
+    cursor = response.ok ? data.cursor : undefined;
+  } while (cursor);
+  return byPattern;
+};
+
 const FileList = ({ files }) => {
   return (
     <div style={{ marginTop: '8px' }}>
@@ -406,41 +435,16 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
     }
   };
 
-  const convertUrlToFile = async (url, fileName, fileType) => {
-    try {
-      const response = await fetch(url);
-      const blob = await response.blob();
-      const file = new File([blob], fileName, { type: fileType });
-      
-      Object.defineProperties(file, {
-        url: {
-          value: url,
-          writable: false,
-          enumerable: true
-        },
-        name: {
-          value: fileName,
-          writable: false,
-          enumerable: true
-        },
-        size: {
-          value: blob.size,
-          writable: false,
-          enumerable: true
-        },
-        lastModified: {
-          value: new Date().getTime(),
-          writable: false,
-          enumerable: true
-        }
-      });
-      
-      return file;
-    } catch (error) {
-      console.error('Error converting URL to file:', error);
-      return null;
-    }
-  };
+  // Existing files are described by their listing entries instead of being
+  // downloaded; page counts and durations come from the metadata extracted
+  // when they were uploaded.
+  const describeListedFile = (file) => ({
+    url: file.url,
+    name: file.fileName,
+    size: file.size,
+    lastModified: file.lastModified ? new Date(file.lastModified).getTime() : new Date().getTime(),
+    metadata: file.metadata || {}
+  });
 
   const checkExistingFiles = async (id) => {
     console.log('Checking existing files for ID:', id);
@@ -474,39 +478,9 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
       }
 
       // Directory exists, now check for specific file types
-      const mp4Url = buildUrl(API_ENDPOINTS.FILES, {
-        patientId: id,
-        fileName: '*.mp4'
-      });
-      
-      const pdfUrl = buildUrl(API_ENDPOINTS.FILES, {
-        patientId: id,
-        fileName: '*.pdf'
-      });
-      
-      const [mp4Response, pdfResponse] = await Promise.all([
-        fetch(mp4Url, {
-          method: 'GET',
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': API_KEY,
-            'Accept': 'application/json'
-          }
-        }),
-        fetch(pdfUrl, {
-          method: 'GET',
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': API_KEY,
-            'Accept': 'application/json'
-          }
-        })
-      ]);
-
-      const [mp4Data, pdfData] = await Promise.all([
-        mp4Response.json(),
-        pdfResponse.json()
-      ]);
+      const byPattern = await fetchFilesByPattern(id, ['*.mp4', '*.pdf']);
+      const mp4Data = { files: byPattern['*.mp4'] };
+      const pdfData = { files: byPattern['*.pdf'] };
 
       // Directory exists but no files yet
       if (!mp4Data.files?.length && !pdfData.files?.length) {
@@ -519,21 +493,11 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
 
       // Update state with found files
       if (pdfData.files?.length > 0) {
-        const pdfFiles = await Promise.all(
-          pdfData.files.map(async file => 
-            await convertUrlToFile(file.url, file.fileName, 'application/pdf')
-          )
-        );
-        setExistingFiles(pdfFiles.filter(Boolean));
+        setExistingFiles(pdfData.files.map(describeListedFile));
       }
 
       if (mp4Data.files?.length > 0) {
-        const mp4Files = await Promise.all(
-          mp4Data.files.map(async file => 
-            await convertUrlToFile(file.url, file.fileName, 'video/mp4')
-          )
-        );
-        setExistingAudioFiles(mp4Files.filter(Boolean));
+        setExistingAudioFiles(mp4Data.files.map(describeListedFile));
         setAvailableRecordings(mp4Data.files);
       }
 
@@ -594,36 +558,14 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
 
     try {
       console.log('Starting audio file upload...', file);
-      const reader = new FileReader();
-      reader.onload = async () => {
-        const base64File = reader.result.split(',')[1];
-        
-        console.log('Sending upload request for audio file...');
-        const response = await fetch(API_ENDPOINTS.UPLOAD, {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': API_KEY,
-          },
-          body: JSON.stringify({
-            id: patientID,
-            file: base64File,
-            fileName: file.name,
-            contentType: 'video/mp4',
-            overwrite: true
-          })
-        });
-
-        if (!response.ok) {
-          throw new Error('Failed to upload audio file');
-        }
-
-        console.log('Audio file uploaded successfully');
-        await fetchAvailableRecordings();  // Refresh the recordings list
-        setStatus({ type: 'success', message: 'הקלטה הועלתה בהצלחה' });
-      };
+      await uploadFileMultipart(patientID, file, {
+        contentType: file.type || 'video/mp4',
+        overwrite: true
+      });
 
-      reader.readAsDataURL(file);
+      console.log('Audio file uploaded successfully');
+      await fetchAvailableRecordings();  // Refresh the recordings list
+      setStatus({ type: 'success', message: 'הקלטה הועלתה בהצלחה' });
     } catch (error) {
       console.error('Error uploading audio file:', error);
       setAudioFileError('שגיאה בהעלאת הקובץ');
@@ -655,43 +597,23 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
   const uploadFile = async (file) => {
     setIsLoading(true);
     try {
-      const reader = new FileReader();
-      reader.onload = async () => {
-        const base64Data = reader.result.split(',')[1];
-        
-        // Determine if the file extension is .pdf or .mp4 (case-insensitive)
-        const lowerCaseName = file.name.toLowerCase();
-        const preserveOriginal = lowerCaseName.endsWith('.pdf') || lowerCaseName.endsWith('.mp4');
-        
-        const response = await fetch(API_ENDPOINTS.UPLOAD, {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': API_KEY
-          },
-          // If the file is a PDF or MP4, we set overwrite to true to preserve the original name.
-          body: JSON.stringify({
-            id: patientID,
-            fileName: file.name,
-            file: base64Data,
-            contentType: file.type,
-            overwrite: preserveOriginal  // true for PDFs/MP4s, false for other file types
-          })
-        });
-        
-        if (!response.ok) {
-          throw new Error('Failed to upload file');
-        }
-        
-        setStatus({ type: 'success', message: 'הקובץ הועלה בהצלחה' });
-        setSelectedFiles([]);
-        
-        // Refresh the file list after successful upload
-        setTimeout(() => {
-          checkExistingFiles(patientID);
-        }, 1000);  // Give the server a moment to process the upload
-      };
-      reader.readAsDataURL(file);
+      // Determine if the file extension is .pdf or .mp4 (case-insensitive)
+      const lowerCaseName = file.name.toLowerCase();
+      const preserveOriginal = lowerCaseName.endsWith('.pdf') || lowerCaseName.endsWith('.mp4');
+
+      // If the file is a PDF or MP4, we set overwrite to true to preserve the original name.
+      await uploadFileMultipart(patientID, file, {
+        contentType: file.type,
+        overwrite: preserveOriginal  // true for PDFs/MP4s, false for other file types
+      });
+
+      setStatus({ type: 'success', message: 'הקובץ הועלה בהצלחה' });
+      setSelectedFiles([]);
+
+      // Refresh the file list after successful upload
+      setTimeout(() => {
+        checkExistingFiles(patientID);
+      }, 1000);  // Give the server a moment to process the upload
     } catch (error) {
       console.error('Error:', error);
       setStatus({ type: 'error', message: 'שגיאה בהעלאת הקובץ' });
@@ -865,45 +787,31 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
   };
 
   // Update the AI summary generation handler
-  const handleGenerateAISummary = async () => {
+  const handleGenerateAISummary = async (rebuild = false) => {
     setIsGeneratingSummary(true);
     setError('');
     
     try {
       console.log('Starting AI summary generation for PDFs:', selectedPDFsForSummary);
 
-      // Convert each PDF to images
-      const pdfImagesPromises = selectedPDFsForSummary.map(async (pdfFile) => {
-        console.log('Fetching PDF:', pdfFile.url);
-        const response = await fetch(pdfFile.url);
-        const blob = await response.blob();
-        console.log('Converting PDF to images:', pdfFile.name);
-        return convertPdfToImages(blob);
-      });
-
-      const pdfImagesArrays = await Promise.all(pdfImagesPromises);
-      const allImages = pdfImagesArrays.flat();
-      
-      console.log(`Converted ${selectedPDFsForSummary.length} PDFs into ${allImages.length} images`);
-
-      // Format images array like Step3
-      const images = allImages.map(base64Image => ({
-        data: base64Image,
-        media_type: 'image/jpeg'
-      }));
-
-      // Construct payload exactly like Step3
+      // The PDFs are read server-side from the patient folder: text layers are
+      // extracted and only scanned pages are rasterized. In incremental mode
+      // only PDFs the patient's stored summary does not include yet are sent
+      // to the model, together with that summary; rebuild regenerates it.
       const payload = {
+        mode: 'incremental',
+        rebuild,
         system_instructions: settings.summary_system_instructions,
         prompt: settings.summary_prompt,
-        images: images,
+        patientID: patientID,
+        pdf_keys: selectedPDFsForSummary.map(file => file.name),
         max_tokens: settings.max_tokens
       };
 
       console.log('Sending payload structure:', {
         system_instructions_length: payload.system_instructions.length,
         prompt_length: payload.prompt.length,
-        number_of_images: images.length,
+        number_of_pdfs: payload.pdf_keys.length,
         max_tokens: payload.max_tokens
       });
 
@@ -925,7 +833,7 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
       }
 
       const data = await response.json();
-      console.log('Received AI summary response:', data);
+      console.log('Received AI summary response:', data.incremental);
       
       const parsedResult = JSON.parse(data.result);
       const summaryText = parsedResult.content[0].text;
@@ -960,7 +868,7 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
     const fetchPageCounts = async () => {
       const counts = {};
       for (const file of existingFiles) {
-        const count = await getPDFPageCount(file.url);
+        const count = file.metadata?.pageCount || await getPDFPageCount(file.url);
         if (count) {
           counts[file.url] = count;
         }
@@ -990,7 +898,7 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
     const fetchDurations = async () => {
       const durations = {};
       for (const file of existingAudioFiles) {
-        const duration = await getDuration(file.url);
+        const duration = file.metadata?.duration || await getDuration(file.url);
         if (duration) {
           durations[file.url] = duration;
         }
@@ -1208,37 +1116,9 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
       const directoryData = await directoryResponse.json();
       
       // Directory exists, now check for specific file types
-      const mp4Url = buildUrl(API_ENDPOINTS.FILES, {
-        patientId: id,
-        fileName: '*.mp4'
-      });
-      
-      const pdfUrl = buildUrl(API_ENDPOINTS.FILES, {
-        patientId: id,
-        fileName: '*.pdf'
-      });
-      
-      const [mp4Response, pdfResponse] = await Promise.all([
-        fetch(mp4Url, {
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': API_KEY,
-            'Accept': 'application/json'
-          }
-        }),
-        fetch(pdfUrl, {
-          headers: {
-            'Content-Type': 'application/json',
-            'x-api-key': API_KEY,
-            'Accept': 'application/json'
-          }
-        })
-      ]);
-
-      const [mp4Data, pdfData] = await Promise.all([
-        mp4Response.json(),
-        pdfResponse.json()
-      ]);
+      const byPattern = await fetchFilesByPattern(id, ['*.mp4', '*.pdf']);
+      const mp4Data = { files: byPattern['*.mp4'] };
+      const pdfData = { files: byPattern['*.pdf'] };
 
       // Directory exists but no files yet
       if (!mp4Data.files?.length && !pdfData.files?.length) {
@@ -1251,21 +1131,11 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
 
       // Update state with found files
       if (pdfData.files?.length > 0) {
-        const pdfFiles = await Promise.all(
-          pdfData.files.map(async file => 
-            await convertUrlToFile(file.url, file.fileName, 'application/pdf')
-          )
-        );
-        setExistingFiles(pdfFiles.filter(Boolean));
+        setExistingFiles(pdfData.files.map(describeListedFile));
       }
 
       if (mp4Data.files?.length > 0) {
-        const mp4Files = await Promise.all(
-          mp4Data.files.map(async file => 
-            await convertUrlToFile(file.url, file.fileName, 'video/mp4')
-          )
-        );
-        setExistingAudioFiles(mp4Files.filter(Boolean));
+        setExistingAudioFiles(mp4Data.files.map(describeListedFile));
         setAvailableRecordings(mp4Data.files);
       }
 
@@ -1466,14 +1336,22 @@ export default function Step1({ patientID, setPatientID, onValidationChange, onE
                     />
                   )}
 
-                  <Button
-                    variant="primary"
-                    onClick={handleGenerateAISummary}
-                    disabled={selectedPDFsForSummary.length === 0}
-                    loading={isGeneratingSummary}
-                  >
-                    סכם רקע באמצעות AI
-                  </Button>
+                  <SpaceBetween direction="horizontal" size="xs">
+                    <Button
+                      variant="primary"
+                      onClick={() => handleGenerateAISummary(false)}
+                      disabled={selectedPDFsForSummary.length === 0}
+                      loading={isGeneratingSummary}
+                    >
+                      סכם רקע באמצעות AI
+                    </Button>
+                    <Button
+                      onClick={() => handleGenerateAISummary(true)}
+                      disabled={isGeneratingSummary || (selectedPDFsForSummary.length === 0 && !aiSummary)}
+                    >
+                      בנה סיכום מחדש
+                    </Button>
+                  </SpaceBetween>
 
                   {aiSummary && (
                     <Container>
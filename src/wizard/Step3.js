@@ -102,7 +102,7 @@ export default function Step3({ patientID }) {
     const fetchPageCounts = async () => {
       const counts = {};
       for (const file of existingFiles) {
-        const count = await getPDFPageCount(file.url);
+        const count = file.metadata?.pageCount || await getPDFPageCount(file.url);
         if (count) {
           counts[file.url] = count;
         }